@@ -9,6 +9,7 @@ from osp.wrappers.simcfd.cfdsession import CFDSession
 from osp.wrappers.simnanodome.nanosession import NanoDOMESession
 from osp.wrappers.simelenbaas.elenbaassession import ElenbaasSession
 from osp.wrappers.simcoupledreactor.coupledreactorsession import CoupledReactorSession
+from osp.wrappers.pipeline import NanoFOAMPipeline
 
 from osp.core.namespaces import nanofoam as onto
 from osp.core.utils import pretty_print
@@ -16,7 +17,8 @@ from osp.core.utils import pretty_print
 # Engine settings
 #####################################################################
 # modes supported: elenbaas (elenbaas only), nanodome (nanodome only),
-# cfd (openfoam and elenbaas), linked (nanofoam), coupled (nanocouplefoam)
+# cfd (openfoam and elenbaas), linked (nanofoam), coupled (nanocouplefoam),
+# pipeline (nanofoam through NanoFOAMPipeline, in memory handoff)
 mode = 'coupled'
 
 # Create the computational mesh, boundary conditions and properties
@@ -427,6 +429,26 @@ elif mode == 'linked':
 
                 plot_distributions([primaries,particles])
 
+elif mode == 'pipeline':
+
+    # Set thermodynamic conditions
+    tcond = onto.ThermoCond()
+    pressure = onto.Pressure(value=101325, unit='m^2/s^2', name = 'Pressure')
+    tcond.add(pressure, rel = onto.hasPart)
+
+    reactor.add(tcond, comp, rel = onto.hasPart)
+    source.add(reactor, rel = onto.hasProperty)
+
+    # nanoDOME runs on the streamlines as soon as they are available
+    pipeline = NanoFOAMPipeline(source, accuracy_level, workers=multiprocessing.cpu_count())
+    results = pipeline.run()
+
+    # Number density weighted diameters of the particles on each streamline
+    for idx,res in enumerate(results,start=1):
+        parts = res['Particles']
+        print('Streamline', idx, 'mean particles diameter [nm]:',
+              np.average(parts[:,0], weights=parts[:,1]) if np.sum(parts[:,1]) > 0 else 0.)
+
 elif mode == 'coupled':
 
     if not accuracy_level.is_a(onto.MediumAccuracyLevel):
@@ -547,4 +569,4 @@ elif mode == 'coupled':
         print("")
 
 else:
-    raise SystemExit('No valid mode selected. Available modes are: elenbaas, cfd, nanodome, linked and coupled')
+    raise SystemExit('No valid mode selected. Available modes are: elenbaas, cfd, nanodome, linked, pipeline and coupled')
@@ -0,0 +1,247 @@
+"""
+@author: Giorgio La Civita, UNIBO DIN
+"""
+
+import multiprocessing
+import numpy as np
+
+from osp.core.namespaces import nanofoam as onto
+
+from osp.wrappers.simelenbaas.elenbaassession import ElenbaasSession
+from osp.wrappers.simcfd.cfdsession import CFDSession
+from osp.wrappers.simnanodome.nanosession import NanoDOMESession
+
+
+class NanoFOAMPipeline:
+    """Elenbaas, CFD and nanoDOME run one after the other on a PlasmaSource.
+
+    The source needs the nanoReactor with its dimensions, GasComposition and
+    ThermoCond (Pressure), as in the cfd and linked examples. The Plasma
+    computed by Elenbaas and the TemperatureStreamline of the CFD are added
+    to the source, the streamlines replacing those of the previous run,
+    while the tables and the streamlines themselves are handed to the next
+    session in memory (plasma_data and stream_data), not read back from
+    their files.
+
+    Each streamline is solved by its own nanoDOME run or, at Low accuracy
+    with ensemble, all of them by one run of the moment ensemble, whose
+    results deviate from the nanoDOME ones (see MomentEnsemble) and are
+    written in Bins named MomentEnsemble.BIN_NAME. With
+    workers, the single runs are started in up to workers forked processes
+    as soon as the CFD session converts each streamline, overlapping the
+    conversion of the remaining ones. The CFD session then converts the
+    tracks in this process, the nanoDOME runs taking the other CPUs, since
+    no process is forked while a conversion pool runs. The keyword
+    arguments of each session are given in elenbaas, cfd and nanodome.
+    After run(), results holds one dictionary per streamline with the
+    Particles and Primaries distributions as arrays, one row per bin:
+    diameter [nm], number density [#/m3] and volume percentage (Low) or
+    fractal dimension (Medium, High) if any. weights holds the inlet area
+    fraction represented by each streamline, see CFDSession.stream_weights,
+    and aggregated the distributions of all of them weighted accordingly.
+    """
+
+    def __init__(self, source, accuracy_level, elenbaas=None, cfd=None, nanodome=None,
+                 workers=None, ensemble=False):
+        self.source = source
+        self.accuracy_level = accuracy_level
+        self.elenbaas = elenbaas or {}
+        self.cfd = cfd or {}
+        self.nanodome = nanodome or {}
+        self.workers = workers
+        self.ensemble = ensemble
+
+        self.reactor = source.get(oclass=onto.nanoReactor)[0]
+        self.tcond = self.reactor.get(oclass=onto.ThermoCond)[0]
+
+        self.plasma_data = {}
+        self.stream_data = {}
+        self.streams = []
+        self.weights = np.empty(0)
+        self.results = []
+        self.aggregated = {}
+
+        # nanoDOME processes (process, connection, streamline index) and
+        # their results by streamline index
+        self._running = []
+        self._done = {}
+
+    def run(self):
+        """Run the three stages, returns the results"""
+        ensemble = self.ensemble and self.accuracy_level.is_a(onto.LowAccuracyLevel)
+        self._streaming = bool(self.workers) and not ensemble
+        self._done = {}
+
+        self._run_elenbaas()
+        try:
+            self._run_cfd()
+            while self._running:
+                self._collect(self._running.pop(0))
+        finally:
+            for proc, _, _ in self._running:
+                proc.terminate()
+            self._running = []
+
+        if ensemble:
+            self.results = self._run_ensemble()
+        elif self._streaming:
+            self.results = [self._done[idx] for idx in range(len(self.streams))]
+        else:
+            self.results = [self._run_nanodome(stream) for stream in self.streams]
+        self.aggregated = self.aggregate()
+        return self.results
+
+    def aggregate(self):
+        """Particles and Primaries distributions of all the streamlines, with
+        the number density of their bins weighted by the streamline weights"""
+        aggregated = dict()
+        for name in ("Particles", "Primaries"):
+            rows = [result[name]*[1., weight, 1.] \
+                    for result, weight in zip(self.results, self.weights)]
+            aggregated[name] = np.concatenate(rows) if rows else np.empty((0, 3))
+        return aggregated
+
+    def _run_elenbaas(self):
+        with ElenbaasSession(**self.elenbaas) as elen:
+            wrapper = onto.NanoFOAMWrapper(session=elen)
+            wrapper.add(self.source)
+            elen.run()
+
+            plasma = wrapper.get(self.source.uid).get(oclass=onto.Plasma)[0]
+            self.source.add(plasma, rel=onto.hasPart)
+            self.plasma_data = elen.results
+
+    def _run_cfd(self):
+        self._clear_streams()
+        cfd_kwargs = dict(self.cfd, on_stream=self._add_stream)
+        if self._streaming:
+            # Serial conversion, overlapped with the nanoDOME processes
+            cfd_kwargs["stream_workers"] = 1
+        with CFDSession(**cfd_kwargs) as cfd:
+            wrapper = onto.NanoFOAMWrapper(session=cfd)
+            cfd.plasma_data = self.plasma_data
+            wrapper.add(self.source)
+            cfd.run()
+
+            weights = [cfd.stream_weights.get(stream.path) for stream in self.streams]
+            for stream, weight in zip(self.streams, weights):
+                if weight is not None:
+                    stream.add(CFDSession.weight_quantity(weight), rel=onto.hasProperty)
+
+        # Normalized over the streamlines found, equal if the seeds are unknown
+        if self.streams and None not in weights:
+            self.weights = np.array(weights)/np.sum(weights)
+        else:
+            self.weights = np.full(len(self.streams), 1./max(len(self.streams), 1))
+
+    def _clear_streams(self):
+        """Remove the streamlines of the previous run from the ThermoCond"""
+        if self.streams:
+            self.tcond.remove(*self.streams)
+        self.stream_data = {}
+        self.streams = []
+
+    def _add_stream(self, path, streamline):
+        """Streamline converted by the CFD session, in the order of the seeds"""
+        self.stream_data[path] = streamline
+        stream = onto.TemperatureStreamline(path=path, name=path, unit='K')
+        self.tcond.add(stream, rel=onto.hasProperty)
+        self.streams.append(stream)
+
+        if self._streaming:
+            # Bounded number of processes, wait for the oldest one
+            if len(self._running) >= self.workers:
+                self._collect(self._running.pop(0))
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            # Forked, the process gets the CUDS and streamlines as they are now
+            proc = multiprocessing.get_context("fork").Process(
+                target=self._nanodome_worker, args=(stream, sender))
+            proc.start()
+            sender.close()
+            self._running.append((proc, receiver, len(self.streams) - 1))
+
+    def _nanodome_worker(self, stream, conn):
+        try:
+            conn.send(self._run_nanodome(stream))
+        except BaseException as error:
+            conn.send(error)
+        finally:
+            conn.close()
+
+    def _collect(self, job):
+        proc, receiver, idx = job
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = RuntimeError("nanoDOME process of streamline %d died" % (idx + 1))
+        proc.join()
+        if isinstance(result, BaseException):
+            raise result
+        self._done[idx] = result
+
+    def _nano_session(self, **kwargs):
+        session = NanoDOMESession(**dict(self.nanodome, **kwargs))
+        session.stream_data = self.stream_data
+        session.plasma_data = self.plasma_data
+        return session
+
+    def _run_ensemble(self):
+        with self._nano_session(ensemble=True) as nano:
+            wrapper = onto.NanoFOAMWrapper(session=nano)
+            particles, primaries = self._distributions()
+            wrapper.add(self.source, self.accuracy_level)
+            nano.run()
+
+            # One Bin per streamline, matched through its streamline copy
+            bins = {}
+            for item in wrapper.get(self.source.uid).get(self.reactor.uid) \
+                               .get(particles.uid).get(oclass=onto.Bin):
+                path = item.get(oclass=onto.TemperatureStreamline)[0].path
+                bins[path] = self._bin_data(item)
+            self.reactor.remove(particles, primaries)
+
+        return [{"Particles": np.array([bins[stream.path]]),
+                 "Primaries": np.empty((0, 3))} for stream in self.streams]
+
+    def _run_nanodome(self, stream):
+        with self._nano_session() as nano:
+            wrapper = onto.NanoFOAMWrapper(session=nano)
+            # The nanoDOME session runs the streamline named after its wrapper
+            stream.name = str(wrapper.uid)
+            particles, primaries = self._distributions()
+            wrapper.add(self.source, self.accuracy_level)
+            nano.run()
+            stream.name = stream.path
+
+            reactor = wrapper.get(self.source.uid).get(self.reactor.uid)
+            result = {"Particles": self._distribution_data(reactor.get(particles.uid)),
+                      "Primaries": self._distribution_data(reactor.get(primaries.uid))}
+            self.reactor.remove(particles, primaries)
+
+        return result
+
+    def _distributions(self):
+        particles = onto.NanoParticleSizeDistribution(name='Particles')
+        primaries = onto.NanoParticleSizeDistribution(name='Primaries')
+        self.reactor.add(particles, primaries, rel=onto.hasPart)
+        return particles, primaries
+
+    @classmethod
+    def _distribution_data(cls, dist):
+        return np.array([cls._bin_data(item) for item in dist.get(oclass=onto.Bin)]) \
+               .reshape(-1, 3)
+
+    @staticmethod
+    def _bin_data(item):
+        """Diameter, number density and volume percentage or fractal
+        dimension of a Bin"""
+        row = [np.nan, np.nan, np.nan]
+        for prop in item.get(rel=onto.hasProperty):
+            if prop.is_a(onto.ParticleDiameter):
+                row[0] = prop.value
+            elif prop.is_a(onto.ParticleNumberDensity):
+                row[1] = prop.value
+            elif prop.is_a(onto.ParticleVolumePercentage) or \
+                 prop.is_a(onto.ParticleFractalDimension):
+                row[2] = prop.value
+        return row
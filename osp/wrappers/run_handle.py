@@ -0,0 +1,61 @@
+"""
+@author: Giorgio La Civita, UNIBO DIN
+"""
+
+import threading
+from concurrent.futures import CancelledError
+
+
+class RunHandle:
+    """Handle of a simulation started with run_async().
+
+    work() is executed on a background thread and must not touch the CUDS,
+    finish() gathers the results into the CUDS and is executed once, in the
+    thread calling result(). cancel() stops the work.
+    """
+
+    def __init__(self, work, finish, cancel):
+        self._finish = finish
+        self._cancel = cancel
+
+        self._error = None
+        self._cancelled = False
+        self._finished = False
+
+        self._thread = threading.Thread(target=self._work, args=(work,), daemon=True)
+        self._thread.start()
+
+    def _work(self, work):
+        try:
+            work()
+        except BaseException as error:
+            self._error = error
+
+    def poll(self):
+        """True once the simulation is over"""
+        return not self._thread.is_alive()
+
+    def cancel(self):
+        """Stop the simulation, False if it was already over"""
+        if self.poll():
+            return False
+        self._cancelled = True
+        self._cancel()
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def result(self, timeout=None):
+        """Wait for the simulation and gather its results into the CUDS"""
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise TimeoutError("Simulation still running")
+        if self._cancelled:
+            raise CancelledError("Simulation cancelled")
+        if self._error is not None:
+            raise self._error
+
+        if not self._finished:
+            self._finished = True
+            self._finish()
@@ -2,26 +2,92 @@
 @author: Giorgio La Civita, UNIBO DIN
 """
 
-import os, subprocess, psutil, sys, shutil
+import os, subprocess, psutil, sys, shutil, re, multiprocessing, hashlib, tempfile, time, signal
 import numpy as np
-from distutils import dir_util
 
 from osp.core.session import SimWrapperSession
 from osp.core.namespaces import nanofoam as onto
+from osp.wrappers.run_handle import RunHandle
+from osp.wrappers.workspace import DEFAULT_WORKSPACE
+from .residuals import ResidualMonitor
+from .templates import load_template
 
 class CFDSession(SimWrapperSession):
     """
     Session class for cfd wrapper.
     """
 
+    # Below this number of tracks the conversion is done serially
+    POOL_MIN_TRACKS = 16
+
+    # Minimum number of axial cells per subdomain of the simple decomposition
+    MIN_SLAB_CELLS = 20
+
+    # Seconds between two reads of the solver log
+    POLL_INTERVAL = 1.
+
+    # Whether run() returns before the end of the simulation, see run_async
+    _async = False
+
     def __init__(self, engine="rhoSimpleFoam", case="nanodome",
-    delete_simulation_files=True, **kwargs):
+    delete_simulation_files=True, stream_format="csv", stream_workers=None,
+    seeds=5, seeds_pattern="linear", nprocs=None, cells_per_rank=8000,
+    mesh_cache=None, warm_start=None, warm_start_cases=20, residual_control=None,
+    progress=None, workspace=None, on_stream=None, **kwargs):
         super().__init__(engine, **kwargs)
         # Whether or not to store the generated files by the simulation engine
         self._delete_simulation_files = delete_simulation_files
+        # Workspace placing and removing the case directory, see Workspace
+        self._workspace = workspace or DEFAULT_WORKSPACE
+        # Streamlines export format, "csv" or binary "npy"
+        if stream_format not in ("csv", "npy"):
+            raise ValueError("Stream format can be csv or npy")
+        self._stream_format = stream_format
+        # Processes converting the streamlines, defaults to the available cores
+        self._stream_workers = stream_workers or psutil.cpu_count()
+        # Streamline seeds on the inlet: number of seeds and their radial
+        # distribution, "linear", "area" (equal area) or a list of (x, y) points
+        if isinstance(seeds_pattern, str) and seeds_pattern not in ("linear", "area"):
+            raise ValueError("Seeds pattern can be linear, area or a list of points")
+        self._seeds = seeds
+        self._seeds_pattern = seeds_pattern
+        self._seeds_weights = None
+        # Parallel ranks, by default estimated from the mesh size
+        self._nprocs = nprocs
+        self._cells_per_rank = cells_per_rank
+        # Directory of prepared meshes shared between sessions, None to disable
+        self._mesh_cache = mesh_cache
+        if mesh_cache and not os.path.exists(mesh_cache):
+            os.makedirs(mesh_cache)
+        # Directory of the final fields of previous cases, the closest one
+        # is mapped as initial condition, None to start from 0/, and the
+        # number of cases kept there, None for no limit
+        self._warm_start = warm_start
+        self._warm_start_cases = warm_start_cases
+        if warm_start and not os.path.exists(warm_start):
+            os.makedirs(warm_start)
+        # Operating points of the stored cases read so far {entry: point}
+        self._warm_points = {}
+        # Initial residuals {field: value} stopping the solver once all met,
+        # and callable receiving (iteration, residuals) while running
+        self._residual_control = residual_control
+        self._progress = progress
+        self.residuals = None
+        # In memory plasma property tables {file name: array}, e.g. the
+        # elen_run results, replacing the files of the PlasmaProperty CUDS
+        self.plasma_data = {}
+        # In memory streamlines {path: array} of the last run, and callable
+        # receiving (path, array) as soon as each of them is converted. It is
+        # never called while the conversion pool runs, so it may fork
+        self.stream_data = {}
+        self._on_stream = on_stream
+        # Inlet area fraction represented by the seed of each streamline of
+        # the last run {path: fraction}, see _seed_points
+        self.stream_weights = {}
 
         # Engine specific initializations
         self._initialized = False
+        self._cancelled = False
         self._case_dir = None
         self._case_files = os.path.join(
             os.path.dirname(__file__),
@@ -38,7 +104,7 @@ class CFDSession(SimWrapperSession):
     def close(self):
         """Invoked, when the session is being closed"""
         if self._delete_simulation_files and self._case_dir:
-            dir_util.remove_tree(self._case_dir)
+            self._workspace.release(self._case_dir)
         # Close the running instance of the OpenFOAM
         if self._initialized:
             self._initialized = False
@@ -49,25 +115,93 @@ class CFDSession(SimWrapperSession):
 
         if self._initialized:
 
-            # Run the CFD simulation
+            # Run the CFD simulation, in its own process group when not
+            # blocking so that it can be cancelled as a whole
             os.chmod(os.path.join(self._case_dir,"Allrun"), 0o744)
-            subprocess.call(os.path.join(self._case_dir,"Allrun"))
-
-            # Collect and manipulate stream files
-            stream_paths = self._create_stream_files(self._case_dir,os.path.join(self._case_dir,"streams"))
-
-            # Add the steamlines CUDS objects to the engine's registry
-            tcond = self._reactor.get(oclass=onto.ThermoCond)[0]
-
-            for idx,stream in enumerate(stream_paths):
-                t_stream = onto.TemperatureStreamline(path=stream, \
-                                              name=str(root_cuds_object.uid), \
-                                              unit = 'K')
-                tcond.add(t_stream,rel=onto.hasProperty)
+            proc = subprocess.Popen(os.path.join(self._case_dir,"Allrun"),
+                                    start_new_session=self._async)
+            self._cancelled = False
+
+            if self._async:
+                self._handle = RunHandle(lambda: self._complete_run(proc),
+                                         lambda: self._create_CUDS(root_cuds_object),
+                                         lambda: self._cancel_run(proc))
+            else:
+                self._complete_run(proc)
+                self._create_CUDS(root_cuds_object)
 
         else:
             raise ValueError("Session not initialized")
 
+    def run_async(self):
+        """Start the simulation without blocking. Returns a RunHandle to poll
+        or cancel it, its result() gathers the results into the CUDS."""
+        self._async = True
+        try:
+            self.run()
+        finally:
+            self._async = False
+        return self._handle
+
+    def _cancel_run(self, proc):
+        """Kill the simulation, its fields are not post-processed nor stored"""
+        self._cancelled = True
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            # Already over, the post-processing stops at the next check
+            pass
+
+    def _complete_run(self, proc):
+        """Follow the solver residuals until the end of the simulation and
+        post-process the case files, only if it completed successfully"""
+        self.residuals = ResidualMonitor(os.path.join(self._case_dir,"log.rhoSimpleFoam"),
+                                         self._residual_control, self._progress)
+        stopped = False
+        while proc.poll() is None:
+            time.sleep(self.POLL_INTERVAL)
+            self.residuals.poll()
+            if self.residuals.converged and not stopped:
+                self._stop_solver()
+                stopped = True
+        self.residuals.close()
+        self.residuals.write(os.path.join(self._case_dir,"residuals.csv"))
+
+        # Partial fields of a cancelled or failed simulation are discarded
+        if self._cancelled:
+            return
+        if proc.returncode != 0:
+            raise RuntimeError("CFD simulation failed with exit code %s" % proc.returncode)
+
+        # Keep the final fields as a warm start for the next cases
+        if self._warm_start and not self._cancelled:
+            self._store_fields()
+
+        # Cancelled meanwhile
+        if self._cancelled:
+            return
+
+        # Collect and manipulate stream files
+        self._stream_paths = self._create_stream_files(self._case_dir,os.path.join(self._case_dir,"streams"))
+
+    def _create_CUDS(self, root_cuds_object):
+        """Save the residuals history and the streamlines in CUDS"""
+        self._reactor.add(onto.Path(path=os.path.join(self._case_dir,"residuals.csv"),
+                                    name="Residuals", unit="~"),
+                          rel=onto.hasProperty)
+
+        # Add the steamlines CUDS objects to the engine's registry
+        tcond = self._reactor.get(oclass=onto.ThermoCond)[0]
+
+        for idx,stream in enumerate(self._stream_paths):
+            t_stream = onto.TemperatureStreamline(path=stream, \
+                                          name=str(root_cuds_object.uid), \
+                                          unit = 'K')
+            if stream in self.stream_weights:
+                t_stream.add(self.weight_quantity(self.stream_weights[stream]),
+                             rel=onto.hasProperty)
+            tcond.add(t_stream,rel=onto.hasProperty)
+
     # OVERRIDE
     def _load_from_backend(self, uids,expired=None):
         """Loads the cuds object from the simulation engine"""
@@ -96,9 +230,8 @@ class CFDSession(SimWrapperSession):
     def _initialize(self, root_cuds_object, added):
 
         # Initialize the solver
-        self._case_dir = os.path.join(os.getcwd(),
-                            "cfd-%s" % root_cuds_object.uid)
-        dir_util.copy_tree(self._case_files, self._case_dir)
+        self._case_dir = self._workspace.create("cfd-%s" % root_cuds_object.uid)
+        shutil.copytree(self._case_files, self._case_dir, dirs_exist_ok=True)
 
         # Get the base CUDS
         self._source = root_cuds_object.get(oclass=onto.PlasmaSource)[0]
@@ -121,6 +254,11 @@ class CFDSession(SimWrapperSession):
         # Create the input file for the blockMesh
         self._create_blockmesh(diameter, length, inlet_diameter)
 
+        # Operating point of the case, used to select warm start fields
+        power, flow_rate = self._get_property(self._source,["Input Power","Flow Rate"])
+        self._point = np.array([diameter, length, inlet_diameter, p,
+                                power, flow_rate, arf, h2f, n2f, o2f], dtype=float)
+
         # Create controlDict
         params = dict()
         try:
@@ -142,10 +280,10 @@ class CFDSession(SimWrapperSession):
         # Create the streamlines set files
         self._create_stream_sets(inlet_diameter)
 
-        # Set serial or parallel execution based on available threads
-        available_threads = psutil.cpu_count()
+        # Set serial or parallel execution based on mesh size and available threads
+        nnp, method = self._decomposition()
 
-        if available_threads == 1:
+        if nnp == 1:
             par_switch = 0
             self._create_launcher(par_switch)
         else:
@@ -153,12 +291,8 @@ class CFDSession(SimWrapperSession):
             # Create the input file for decomposePar
             # Parameters for parallel execution
             par_params = dict()
-            # Set parameters for parallel execution
-            # Parallel execution has been limited to 4 due to mesh size
-            if available_threads - 1 > 4:
-                par_params["nnp"] = 4
-            else:
-                par_params["nnp"] = available_threads - 1
+            par_params["nnp"] = nnp
+            par_params["method"] = method
             self._write_dict(par_params,
                              "decomposeParDict_template",
                              "decomposeParDict",
@@ -169,70 +303,251 @@ class CFDSession(SimWrapperSession):
         plasma = self._source.get(oclass=onto.Plasma)[0]
 
         # Write the OpenFOAM compliant thermodynamic property files
+        self._write_properties(plasma)
+
+        # Prepare mesh and decomposition if needed, reusing a cached mesh
+        # prepared for the same blockMesh and decomposition dictionaries
+        mesh_key = self._mesh_key(par_switch) if self._mesh_cache else None
+
+        if mesh_key and self._restore_mesh(mesh_key):
+            if par_switch:
+                # Existing decomposition, only the fields are distributed
+                self._run_utility(["decomposePar", "-fields", "-latestTime"])
+        else:
+            os.chmod(os.path.join(self._case_dir,"Allprep"), 0o744)
+            subprocess.call(os.path.join(self._case_dir,"Allprep"))
+            if mesh_key:
+                self._store_mesh(mesh_key)
+
+        # Initial fields mapped from the closest previously run case
+        self._par_switch = par_switch
+        if self._warm_start:
+            source = self._closest_case()
+            if source:
+                self._run_utility(["mapFields", source, "-consistent",
+                                   "-sourceTime", "latestTime"])
+                if par_switch:
+                    self._run_utility(["decomposePar", "-fields", "-latestTime"])
+
+        self._initialized = True
+
+    def _decomposition(self):
+        """Number of subdomains and decomposition method for the mesh"""
+        if self._nprocs is not None:
+            nnp = max(1, int(self._nprocs))
+        else:
+            # One rank per cells_per_rank cells, keeping a thread free
+            available_threads = psutil.cpu_count()
+            nnp = int(round(self._mesh_cells/self._cells_per_rank))
+            nnp = max(1, min(nnp, available_threads - 1))
+
+        # Slabs along the reactor axis while they stay thick enough,
+        # graph partitioning otherwise
+        if self._zcells/nnp >= self.MIN_SLAB_CELLS:
+            method = "simple"
+        else:
+            method = "scotch"
+
+        return nnp, method
+
+    def _mesh_key(self, par_switch):
+        """Content hash of the dictionaries defining the prepared mesh"""
+        key = hashlib.sha256()
+        dicts = ["blockMeshDict"] + (["decomposeParDict"] if par_switch else [])
+        for name in dicts:
+            with open(os.path.join(self._case_dir,"system",name),"rb") as file:
+                key.update(file.read())
+        return key.hexdigest()
+
+    def _mesh_dirs(self, root):
+        """Mesh directories of the serial and decomposed cases under root"""
+        dirs = [os.path.join("constant","polyMesh")]
+        for name in sorted(os.listdir(root)):
+            if name.startswith("processor"):
+                dirs.append(os.path.join(name,"constant","polyMesh"))
+        return dirs
+
+    def _restore_mesh(self, mesh_key):
+        """Hardlink, or copy across filesystems, a cached mesh into the case"""
+        entry = os.path.join(self._mesh_cache, mesh_key)
+        if not os.path.isdir(entry):
+            return False
+
+        def link_or_copy(src, dst):
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+
+        for mesh_dir in self._mesh_dirs(entry):
+            dest = os.path.join(self._case_dir, mesh_dir)
+            if os.path.isdir(dest):
+                shutil.rmtree(dest)
+            shutil.copytree(os.path.join(entry, mesh_dir), dest,
+                            copy_function=link_or_copy)
+        return True
+
+    def _store_mesh(self, mesh_key):
+        """Add the case mesh to the cache, entries appear atomically"""
+        entry = os.path.join(self._mesh_cache, mesh_key)
+        if os.path.isdir(entry):
+            return
+
+        tmp = tempfile.mkdtemp(dir=self._mesh_cache)
+        for mesh_dir in self._mesh_dirs(self._case_dir):
+            shutil.copytree(os.path.join(self._case_dir, mesh_dir),
+                            os.path.join(tmp, mesh_dir))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Stored meanwhile by a concurrent session
+            shutil.rmtree(tmp)
+
+    def _stop_solver(self):
+        """Ask the running solver to write the fields and stop"""
+        control_path = os.path.join(self._case_dir,"system","controlDict")
+        with open(control_path,"r") as control:
+            text = control.read()
+        # runTimeModifiable, the solver rereads controlDict at the next iteration
+        with open(control_path,"w") as control:
+            control.write(re.sub(r"^stopAt\s+\w+;", "stopAt writeNow;", text, flags=re.M))
+
+    def _run_utility(self, args, log_name=None):
+        """Run an OpenFOAM utility on the case, logging as runApplication"""
+        log_name = log_name or "log." + args[0]
+        with open(os.path.join(self._case_dir, log_name), "w") as log:
+            return subprocess.call(args + ["-case", self._case_dir],
+                                   stdout=log, stderr=log)
+
+    def _closest_case(self):
+        """Stored case with the operating point closest to the current one.
+        Entries are named after their point, which is read once per session"""
+        best = None
+        best_dist = np.inf
+        names = set()
+        for name in os.listdir(self._warm_start):
+            if len(name) != 64:
+                continue
+            if name not in self._warm_points:
+                point_file = os.path.join(self._warm_start, name, "point")
+                if not os.path.isfile(point_file):
+                    continue
+                self._warm_points[name] = np.loadtxt(point_file)
+            names.add(name)
+            point = self._warm_points[name]
+            if point.shape != self._point.shape:
+                continue
+            # Relative distance, null components (e.g. absent gases) allowed
+            scale = np.maximum(np.maximum(np.abs(point), np.abs(self._point)), 1e-12)
+            dist = np.sum(((point - self._point)/scale)**2)
+            if dist < best_dist:
+                best, best_dist = os.path.join(self._warm_start, name), dist
+
+        # Entries evicted meanwhile
+        for name in set(self._warm_points) - names:
+            del self._warm_points[name]
+        # Most recently used entries are evicted last
+        if best:
+            os.utime(best)
+        return best
+
+    def _store_fields(self):
+        """Store mesh and last time fields of the case as a serial case"""
+        if self._par_switch:
+            self._run_utility(["reconstructPar", "-latestTime"])
+
+        times = [name for name in os.listdir(self._case_dir) \
+                 if re.match(r"^[0-9]*\.?[0-9]+(e[+-]?[0-9]+)?$", name) and float(name) > 0]
+        if not times:
+            return
+        latest = max(times, key=float)
+
+        tmp = tempfile.mkdtemp(dir=self._warm_start)
+        shutil.copytree(os.path.join(self._case_dir, "system"), os.path.join(tmp, "system"))
+        shutil.copytree(os.path.join(self._case_dir, "constant", "polyMesh"),
+                        os.path.join(tmp, "constant", "polyMesh"))
+        shutil.copytree(os.path.join(self._case_dir, latest), os.path.join(tmp, latest),
+                        ignore=shutil.ignore_patterns("uniform"))
+        np.savetxt(os.path.join(tmp, "point"), self._point)
+
+        # Same operating point, same entry: the newer fields replace it
+        key = hashlib.sha256(self._point.tobytes()).hexdigest()
+        entry = os.path.join(self._warm_start, key)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+
+        if self._warm_start_cases is not None:
+            self._evict_fields()
+
+    def _evict_fields(self):
+        """Remove the least recently used stored cases above the count limit"""
+        entries = []
+        for entry in os.scandir(self._warm_start):
+            if entry.is_dir() and len(entry.name) == 64:
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    continue
+
+        excess = len(entries) - self._warm_start_cases
+        for _, path in sorted(entries)[:max(excess, 0)]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _write_properties(self, plasma):
+        """Write the plasma properties as OpenFOAM tables in constant/.
+        Tables found in plasma_data, by file name, are used without
+        reading back the files."""
         for prop in plasma.get(oclass=onto.PlasmaProperty):
-            # file_util.copy_file(prop.path, self._case_dir+'/constant/')
-            with open(prop.path,'r') as file:
-                if 'densRef' in prop.path:
-                    pass
-                elif 'radial profile' in prop.name or 'radiative' in prop.name:
-                    with open(self._case_dir+'/constant/' + str(prop.path.rsplit('/', 1)[-1]), 'a') as out:
-                        for line in file.readlines():
-                            row = line.split(',')
-                            out.write(row[0] + ' ' + row[1])
-                    out.close()
+            if 'densRef' in prop.path:
+                continue
+
+            f_name = str(prop.path.rsplit('/', 1)[-1])
+            if f_name in self.plasma_data:
+                data = np.asarray(self.plasma_data[f_name], dtype=float)
+            else:
+                data = np.loadtxt(prop.path, delimiter=",", ndmin=2)
+            data = data[:,:2]
+
+            if 'radial profile' in prop.name or 'radiative' in prop.name:
+                self._write_table(f_name, data, "%.18e %.18e\n", False)
+            else:
+                derivative = True
+                if 'entropy' in prop.name:
+                    f_name = 'S'
+                elif 'enthalpy' in prop.name:
+                    f_name = 'H'
+                elif 'capacity' in prop.name:
+                    f_name = 'Cp'
                 else:
-                    f_name = str(prop.path.rsplit('/', 1)[-1])
-
-                    if 'entropy' in prop.name or 'capacity' in prop.name or 'enthalpy' in prop.name:
-                        if 'entropy' in prop.name:
-                            f_name = 'S'
-                        elif 'enthalpy' in prop.name:
-                            f_name = 'H'
-                        elif 'capacity' in prop.name:
-                            f_name = 'Cp'
-
-                    with open(self._case_dir+'/constant/' + f_name, 'a') as out:
-                        out.write('(' + '\n')
-                        data = []
-                        for line in file.readlines():
-                            row = line.split(',')
-                            data.append([float(row[0]),float(row[1])])
-                            out.write('(' + row[0] + ' ' + row[1].strip() + ')' + '\n')
-                        out.write(')')
-
-                    if 'entropy' in prop.name or 'capacity' in prop.name or 'enthalpy' in prop.name:
-                        der = self._derivate(data)
-                        with open(self._case_dir+'/constant/' \
-                                  + 'd' + f_name + 'dT' \
-                                  , 'a') as out_der:
-                            out_der.write('(' + '\n')
-                            for item in der:
-                                out_der.write('(' + str(item[0]) + ' ' + str(item[1]) + ')' + '\n')
-                            out_der.write(')')
-                        out_der.close()
-
-                    out.close()
-            file.close()
-
-        # Prepare mesh and decomposition if needed
-        os.chmod(os.path.join(self._case_dir,"Allprep"), 0o744)
-        subprocess.call(os.path.join(self._case_dir,"Allprep"))
+                    derivative = False
 
-        self._initialized = True
+                self._write_table(f_name, data, "(%.18e %.18e)\n", True)
+                if derivative:
+                    self._write_table('d' + f_name + 'dT', self._derivate(data),
+                                      "(%r %r)\n", True)
+
+    def _write_table(self, file_name, data, fmt, brackets):
+        """Format a two columns table at once and write it in constant/"""
+        text = (fmt*len(data)) % tuple(data.ravel().tolist())
+        if brackets:
+            text = '(' + '\n' + text + ')'
+        with open(os.path.join(self._case_dir,'constant',file_name),'w') as out:
+            out.write(text)
 
     def _derivate(self,prop):
-        """Calculates the numerical derivative of a list using the finite difference method"""
-        der = []
-
-        for i in range(0,len(prop)):
-            if i == 0:
-                der.append([prop[i][0], (prop[i+1][1]-prop[i][1])/(prop[i+1][0]-prop[i][0])])
-            elif i == len(prop)-1:
-                der.append([prop[i][0], (prop[i][1]-prop[i-1][1])/(prop[i][0]-prop[i-1][0])])
-            else:
-                der.append([prop[i][0], (prop[i+1][1]-prop[i-1][1])/(prop[i+1][0]-prop[i-1][0])])
+        """Calculates the numerical derivative of a table using the finite difference method"""
+        prop = np.asarray(prop, dtype=float)
+        x = prop[:,0]
+        y = prop[:,1]
 
-        return der
+        # Central differences, one sided at the ends
+        der = np.empty(len(x))
+        der[1:-1] = (y[2:] - y[:-2])/(x[2:] - x[:-2])
+        der[0] = (y[1] - y[0])/(x[1] - x[0])
+        der[-1] = (y[-1] - y[-2])/(x[-1] - x[-2])
+
+        return np.column_stack((x, der))
 
     def _create_launcher(self, par_switch):
         run_params = dict()
@@ -326,6 +641,10 @@ class CFDSession(SimWrapperSession):
         mesh_params["r2c_"] = -fr*np.cos(angle)
         mesh_params["r2s_"] = -fr*np.sin(angle)
 
+        # Cells of the four wedge blocks, used to size the decomposition
+        self._zcells = mesh_params["zcells"]
+        self._mesh_cells = 2*(mesh_params["xcells0"] + mesh_params["xcells1"])*self._zcells
+
         # Write the blockMesh input dictionary
         self._write_dict(mesh_params,
                          "blockMeshDict_template",
@@ -333,159 +652,164 @@ class CFDSession(SimWrapperSession):
                          "system")
 
     def _create_stream_files(self,basepath,destpath):
-        strct = 1
-        stream_paths = []
-
         if not os.path.exists(destpath):
             os.makedirs(destpath)
 
+        # Track directories in streamSets order (stream1, stream2, ..., stream10)
+        tracks = []
         for dirname, dirs, files in os.walk(os.path.join(basepath,"postProcessing")):
+            if "track0_T.csv" in files and "track0_U.csv" in files:
+                tracks.append(dirname)
+        tracks.sort(key=lambda path: [int(tok) if tok.isdigit() else tok \
+                                      for tok in re.split(r"(\d+)", path)])
+
+        jobs = [(dirname, destpath + "/streamline_" + str(idx) + "." + self._stream_format,
+                 self._stream_format) for idx, dirname in enumerate(tracks, start=1)]
+
+        # Weight of each streamline from the number of its seed (streamN)
+        self.stream_weights = dict()
+        if self._seeds_weights is not None:
+            for dirname, job in zip(tracks, jobs):
+                seed = re.search(r"stream(\d+)", os.path.relpath(dirname, basepath))
+                if seed and 0 < int(seed.group(1)) <= len(self._seeds_weights):
+                    self.stream_weights[job[1]] = float(self._seeds_weights[int(seed.group(1)) - 1])
+
+        # Convert the tracks on a process pool, map keeps the tracks order
+        workers = min(self._stream_workers, len(jobs))
+        self.stream_data = dict()
+        if workers > 1 and len(jobs) >= self.POOL_MIN_TRACKS:
+            with multiprocessing.Pool(workers) as pool:
+                converted = pool.map(self._convert_track, jobs)
+            # Handed over once the threads of the pool are joined
+            for path, streamline in converted:
+                self._add_stream(path, streamline)
+        else:
+            for job in jobs:
+                self._add_stream(*self._convert_track(job))
 
-            T_found = False
-            U_found = False
-            for filename in files:
-                filepath = os.path.join(dirname, filename)
-
-                if filename == "track0_T.csv":
-                    Tdat = self._import_stream_file(filepath)
-                    T_found = True
-                elif filename == "track0_U.csv":
-                    Udat = self._import_stream_file(filepath)
-                    U_found = True
-
-            if T_found is True & U_found is True:
-                temp_evo = []
-                for idx in range(0,len(Udat)):
-                    if Udat[idx,0] == 0:
-                        temp_evo.append(0.0)
-                    else:
-                        umag = pow((pow(Udat[idx-1,1],2)+pow(Udat[idx-1,2],2)+pow(Udat[idx-1,3],2)),0.5)
-                        temp_evo.append(temp_evo[idx-1] + (Udat[idx,0] - Udat[idx-1,0])/umag)
-
-                streamline = []
-                idx = 0
-                for step in Udat:
-                    streamline.append([temp_evo[idx],Tdat[idx,1]])
-                    idx += 1
-                # Export the streamline file in CSV format
-                outname = destpath + "/streamline_" + str(strct) + ".csv"
-                stream_paths.append(outname)
-                np.savetxt(outname,np.asarray(streamline), delimiter = ',')
-                strct += 1
-                T_found = False
-                U_found = False
+        stream_paths = list(self.stream_data)
 
         if len(stream_paths) != 0:
             return stream_paths
         else:
             raise ValueError("CFD simulation crashed or streamline not found. No streamfiles exported.")
 
-    def _import_stream_file(self,filename):
+    @staticmethod
+    def weight_quantity(weight):
+        """PhysicalQuantity of the inlet area fraction of a streamline"""
+        return onto.PhysicalQuantity(value=weight, unit='~', name='Inlet area fraction')
+
+    def _add_stream(self, path, streamline):
+        self.stream_data[path] = streamline
+        if self._on_stream is not None:
+            self._on_stream(path, streamline)
+
+    @staticmethod
+    def _convert_track(job):
+        """Convert the OpenFOAM T and U tracks in dirname to a streamline file,
+        returns its path and data"""
+        dirname, outname, stream_format = job
+
+        Tdat = CFDSession._import_stream_file(os.path.join(dirname,"track0_T.csv"))
+        Udat = CFDSession._import_stream_file(os.path.join(dirname,"track0_U.csv"))
+
+        streamline = np.column_stack((CFDSession._time_of_flight(Udat), Tdat[:,1]))
+
+        # Export the streamline file in CSV or binary (npy) format
+        if stream_format == "npy":
+            np.save(outname, streamline)
+        else:
+            np.savetxt(outname, streamline, delimiter = ',')
+
+        return outname, streamline
+
+    @staticmethod
+    def _time_of_flight(Udat):
+        """Residence time along a track from the distance and velocity columns.
+        Each segment is crossed at the mean velocity magnitude of its two
+        points (trapezoidal rule), segments at rest at both ends take no time."""
+        umag = np.sqrt(Udat[:,1]*Udat[:,1] + Udat[:,2]*Udat[:,2] + Udat[:,3]*Udat[:,3])
+        umean = 0.5*(umag[:-1] + umag[1:])
+
+        dt = np.zeros(len(umean))
+        np.divide(np.diff(Udat[:,0]), umean, out=dt, where=umean > 0.)
+
+        tof = np.zeros(len(Udat))
+        tof[1:] = np.cumsum(dt)
+        return tof
+
+    @staticmethod
+    def _import_stream_file(filename):
         "Imports a series of streamlines data from an OpenFOAM CFD simulation."
         "Datas must be in CSV format style following this format: variable1,variable2"
         try:
             fl = open(filename,"r")
         except IOError:
-            print("File not found")
-        finally:
-            datas = []
-            for line in fl:
-                lnstr = np.array(line.split(","))
-                if lnstr[0]=="distance":
-                    pass
-                elif lnstr[0]=="\n":
-                    pass
-                else:
-                    datas.append(lnstr.astype(float))
-            fl.close()
-        return np.asarray(datas)
+            raise ValueError("Stream file " + filename + " not found")
+
+        with fl:
+            # Skip the OpenFOAM header line, if any
+            skip = 1 if fl.readline().split(",")[0] == "distance" else 0
+            fl.seek(0)
+            datas = np.loadtxt(fl, delimiter=",", skiprows=skip, ndmin=2)
+
+        return datas
+
+    def _seed_points(self, inlet_diameter):
+        """Radial coordinates of the streamline seeds on the inlet and the
+        fraction of the inlet area represented by each of them"""
+        R = 0.5*inlet_diameter
+
+        if self._seeds_pattern == "linear":
+            radii = np.linspace(1e-6, R-1e-6, num=self._seeds)
+        elif self._seeds_pattern == "area":
+            # Seeds in the middle (in area) of equal area annuli
+            radii = R*np.sqrt((np.arange(self._seeds) + 0.5)/self._seeds)
+            return np.clip(radii, 1e-6, R-1e-6), np.full(self._seeds, 1./self._seeds)
+        else:
+            # User defined 2D inlet points, the case is axisymmetric so each
+            # point is rotated onto the wedge by its radius
+            points = np.asarray(self._seeds_pattern, dtype=float).reshape(-1, 2)
+            radii = np.hypot(points[:,0], points[:,1])
+        radii = np.clip(radii, 1e-6, R-1e-6)
+
+        # Each seed represents the annulus up to the midpoints with its neighbours
+        order = np.argsort(radii)
+        edges = np.concatenate(([0.], 0.5*(radii[order][1:] + radii[order][:-1]), [R]))
+        weights = np.empty(len(radii))
+        weights[order] = np.diff(edges*edges)/(R*R)
+
+        return radii, weights
 
     def _create_stream_sets(self, inlet_diameter):
-        coords = np.linspace(1e-6,0.5*inlet_diameter-1e-6,num=5)
-        for ii,xcoo in enumerate(coords, start=1):
-            point = str((xcoo, 0, 1e-6)).replace(',', '')
-            # Parameters for streamSets file
-            stream_params = dict()
-            stream_params["stream"] = "stream" + str(ii)
-            stream_params["points"] = "(" + point + ")"
-
-            # Write the streamSets input file
-            self._write_set(stream_params,
-                             "streamSets_template",
-                             "streamSets",
-                             "system")
+        radii, self._seeds_weights = self._seed_points(inlet_diameter)
+        template = self._template("streamSets_template")
+
+        # Fill in one streamSets entry per seed
+        entries = []
+        for ii,xcoo in enumerate(radii, start=1):
+            point = str((float(xcoo), 0, 1e-6)).replace(',', '')
+            entries.append(template.render({"stream": "stream" + str(ii),
+                                            "points": "(" + point + ")"},
+                                           bare=("stream",)))
+
+        # Write the streamSets input file at once
+        with open(os.path.join(self._case_dir, "system", "streamSets"), "w") as f:
+            f.write("".join(entries))
+
+    def _template(self, template_name):
+        """Parsed template of the case"""
+        return load_template(os.path.join(self._case_dir, "templates", template_name))
 
     def _write_script(self, params, template_name, file_name, folder):
-        """Fill in a templated dictionary file with provided parameters"""
-        # Path to the template file
-        template_path = os.path.join(
-            self._case_dir,
-            "templates",
-            template_name)
-        # Path to the file for the case
-        file_path = os.path.join(
-            self._case_dir,
-            folder,
-            file_name)
-
-        with open(template_path, "r") as template:
-            with open(file_path, "w") as f:
-                for line in template:
-                    key = line.split()[0] if line.split() else None
-                    if key in params:
-                        line = "%s='%s'" % (key, params[key])
-                        del params[key]
-                    print(line.strip(), file=f)
-                for key, value in params.items():
-                    print("%s = %s" % (key, value), file=f)
+        """Fill in a templated script file with provided parameters"""
+        text = self._template(template_name).render(params, "%s='%s'", "%s = %s")
+        with open(os.path.join(self._case_dir, folder, file_name), "w") as f:
+            f.write(text)
 
     def _write_dict(self, params, template_name, file_name, folder):
         """Fill in a templated dictionary file with provided parameters"""
-        # Path to the template file
-        template_path = os.path.join(
-            self._case_dir,
-            "templates",
-            template_name)
-        # Path to the file for the case
-        file_path = os.path.join(
-            self._case_dir,
-            folder,
-            file_name)
-
-        with open(template_path, "r") as template:
-            with open(file_path, "w") as f:
-                for line in template:
-                    key = line.split()[0] if line.split() else None
-                    if key in params:
-                        line = "%s %s;" % (key, params[key])
-                        del params[key]
-                    print(line.strip(), file=f)
-                for key, value in params.items():
-                    print("%s %s;" % (key, value), file=f)
-
-    def _write_set(self, params, template_name, file_name, folder):
-        """Fill in a templated dictionary file with provided parameters"""
-        # Path to the template file
-        template_path = os.path.join(
-            self._case_dir,
-            "templates",
-            template_name)
-        # Path to the file for the case
-        file_path = os.path.join(
-            self._case_dir,
-            folder,
-            file_name)
-
-        with open(template_path, "r") as template:
-            with open(file_path, "a+") as f:
-                for line in template:
-                    key = line.split()[0] if line.split() else None
-                    if key in params:
-                        if key == "stream":
-                            line = "%s" % (params[key])
-                        else:
-                            line = "%s %s;" % (key, params[key])
-                        del params[key]
-                    print(line.strip(), file=f)
-                for key, value in params.items():
-                    print("%s %s;" % (key, value), file=f)
+        text = self._template(template_name).render(params)
+        with open(os.path.join(self._case_dir, folder, file_name), "w") as f:
+            f.write(text)
+
@@ -0,0 +1,96 @@
+"""
+@author: Giorgio La Civita, UNIBO DIN
+"""
+
+import os, re
+
+TIME_LINE = re.compile(r"^Time = (\S+)")
+RESIDUAL_LINE = re.compile(r"Solving for (\w+), Initial residual = ([0-9.eE+-]+)")
+
+
+class ResidualMonitor:
+    """Follows the log of a running OpenFOAM solver.
+
+    Every poll() parses the lines appended to the log since the previous
+    call. The initial residual of the first solution of each field is
+    collected per iteration in history, a list of (time, {field: residual}).
+    Each completed iteration is passed to progress(time, residuals), if
+    given, and compared with the thresholds {field: residual}: the run is
+    converged once all of them are met.
+    """
+
+    def __init__(self, log_path, thresholds=None, progress=None):
+        self.log_path = log_path
+        self.thresholds = thresholds or {}
+        self.progress = progress
+
+        self.history = []
+        self.converged = False
+
+        self._offset = 0
+        self._partial = ""
+        self._time = None
+        self._residuals = {}
+
+    def poll(self):
+        """Parse the lines written since the last call"""
+        if not os.path.isfile(self.log_path):
+            return
+
+        with open(self.log_path, "r") as log:
+            log.seek(self._offset)
+            text = self._partial + log.read()
+            self._offset = log.tell()
+
+        lines = text.split("\n")
+        # The last line may still be being written
+        self._partial = lines.pop()
+
+        for line in lines:
+            match = TIME_LINE.match(line)
+            if match:
+                self._end_iteration()
+                self._time = float(match.group(1))
+                continue
+
+            match = RESIDUAL_LINE.search(line)
+            if match and self._time is not None:
+                self._residuals.setdefault(match.group(1), float(match.group(2)))
+
+    def close(self):
+        """Parse the remaining log and the last iteration"""
+        self.poll()
+        if self._partial:
+            self._partial += "\n"
+            self.poll()
+        self._end_iteration()
+
+    def _end_iteration(self):
+        if self._time is None or not self._residuals:
+            return
+
+        self.history.append((self._time, self._residuals))
+        if self.progress is not None:
+            self.progress(self._time, self._residuals)
+
+        if self.thresholds and \
+           all(field in self._residuals and self._residuals[field] <= value \
+               for field, value in self.thresholds.items()):
+            self.converged = True
+
+        self._time = None
+        self._residuals = {}
+
+    def write(self, file_path):
+        """Export the history in CSV format, one column per field"""
+        fields = []
+        for _, residuals in self.history:
+            for field in residuals:
+                if field not in fields:
+                    fields.append(field)
+
+        with open(file_path, "w") as out:
+            out.write(",".join(["Time"] + fields) + "\n")
+            for time, residuals in self.history:
+                out.write(",".join([repr(time)] + [repr(residuals[field]) \
+                          if field in residuals else "" for field in fields]) + "\n")
@@ -0,0 +1,67 @@
+"""
+@author: Giorgio La Civita, UNIBO DIN
+"""
+
+import os
+from collections import OrderedDict
+
+# Parsed templates by (path, modification time, size), the least recently
+# used beyond MAX_TEMPLATES are dropped, see load_template
+_TEMPLATES = OrderedDict()
+MAX_TEMPLATES = 64
+
+
+class Template:
+    """Template of an OpenFOAM case file, parsed once.
+
+    A line is keyed by its first word: rendering replaces the first line
+    of each key given in the parameters and appends the keys which are not
+    found in the template, as the previous line by line filling did.
+    """
+
+    def __init__(self, text):
+        self.lines = [line.strip() for line in text.splitlines()]
+
+        # Index of the first line of each key
+        self.index = dict()
+        for ii, line in enumerate(self.lines):
+            words = line.split()
+            if words and words[0] not in self.index:
+                self.index[words[0]] = ii
+
+    def render(self, params, fmt="%s %s;", tail_fmt=None, bare=()):
+        """Text of the file for the given parameters.
+
+        fmt formats (key, value) of the replaced lines, tail_fmt (fmt by
+        default) the appended ones. The lines of the keys in bare are
+        replaced by the value only.
+        """
+        lines = list(self.lines)
+        tail = []
+        for key, value in params.items():
+            if key not in self.index:
+                tail.append((tail_fmt or fmt) % (key, value))
+            elif key in bare:
+                lines[self.index[key]] = "%s" % (value,)
+            else:
+                lines[self.index[key]] = fmt % (key, value)
+
+        return "".join(line + "\n" for line in lines + tail)
+
+
+def load_template(path):
+    """Parsed template at path, read and parsed again only when its
+    modification time or size change."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    template = _TEMPLATES.get(key)
+    if template is None:
+        with open(path, "r") as file:
+            template = Template(file.read())
+        _TEMPLATES[key] = template
+        if len(_TEMPLATES) > MAX_TEMPLATES:
+            _TEMPLATES.popitem(last=False)
+    else:
+        _TEMPLATES.move_to_end(key)
+    return template
@@ -345,40 +345,28 @@ def elen_run(elen_dict,prop_dir,out_dir):
         rad = np.insert(rad,0,0)
 
         ## Save data
-        # Save all profile for boundary conditions and radiation sink
-        np.savetxt(str(os.path.join(out_dir,'VR')),np.transpose((r,V)), delimiter=',') # velocity
-
-        np.savetxt(str(os.path.join(out_dir,'TR')),np.transpose((r,T)), delimiter=',') # temperature
-
-        np.savetxt(str(os.path.join(out_dir,'epsR')),np.transpose((r[:-1],eps)), delimiter=',') # epsilon
-
-        np.savetxt(str(os.path.join(out_dir,'kR')),np.transpose((r[:-1],k)), delimiter=',') # k
-
-        # Write radiation source file
-        np.savetxt(str(os.path.join(out_dir,'radiation.rad')),np.c_[Trad,rad], delimiter = ',') # radiation
-
-        # Save all thermophysical properties datas
-        # rho
-        np.savetxt(str(os.path.join(out_dir,'rho')),np.c_[T1,rho], delimiter = ',')
-
-        # Cp
-        np.savetxt(str(os.path.join(out_dir,'Cp')),np.c_[T1,Cp], delimiter = ',')
-
-        # H
-        np.savetxt(str(os.path.join(out_dir,'enthalpy')),np.c_[T1,H], delimiter = ',')
-
-        # mu
-        np.savetxt(str(os.path.join(out_dir,'mu')),np.c_[T1,mu], delimiter = ',')
-
-        # kappa
-        np.savetxt(str(os.path.join(out_dir,'kappa')),np.c_[T1,kappa], delimiter = ',')
-
-        # sigma
-        np.savetxt(str(os.path.join(out_dir,'sigmaE')),np.c_[T1,sigmaE], delimiter = ',')
-
-        # S
-        np.savetxt(str(os.path.join(out_dir,'entropy')),np.c_[T1,S], delimiter = ',')
+        # Profiles for boundary conditions and radiation sink and mixture
+        # thermophysical properties, keyed by their file name
+        results = dict()
+        results['VR'] = np.transpose((r,V)) # velocity
+        results['TR'] = np.transpose((r,T)) # temperature
+        results['epsR'] = np.transpose((r[:-1],eps)) # epsilon
+        results['kR'] = np.transpose((r[:-1],k)) # k
+        results['radiation.rad'] = np.c_[Trad,rad] # radiation
+        results['rho'] = np.c_[T1,rho]
+        results['Cp'] = np.c_[T1,Cp]
+        results['enthalpy'] = np.c_[T1,H]
+        results['mu'] = np.c_[T1,mu]
+        results['kappa'] = np.c_[T1,kappa]
+        results['sigmaE'] = np.c_[T1,sigmaE]
+        results['entropy'] = np.c_[T1,S]
+
+        for name, table in results.items():
+            np.savetxt(str(os.path.join(out_dir,name)),table, delimiter=',')
 
         # Save reference density value for nanoDOME
+        results['densRef'] = np.c_[Tref,_density(Tref, data_thd)]
         np.savetxt(str(os.path.join(out_dir,'densRef')), \
-                   np.c_[Tref,_density(Tref, data_thd)], delimiter=' ')
\ No newline at end of file
+                   results['densRef'], delimiter=' ')
+
+        return results
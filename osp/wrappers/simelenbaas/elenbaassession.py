@@ -2,24 +2,59 @@
 @author: Giorgio La Civita, UNIBO DIN
 """
 
-import os
-from distutils import dir_util
+import os, multiprocessing, hashlib, json, shutil, tempfile, functools
+import numpy as np
 
 from osp.core.session import SimWrapperSession
 from osp.core.namespaces import nanofoam as onto
+from osp.wrappers.run_handle import RunHandle
+from osp.wrappers.workspace import DEFAULT_WORKSPACE
 
 from .elenbaasengine import elen_run
 
+# Tables written by elen_run, see ElenbaasSession.results
+RESULT_TABLES = ["VR", "TR", "epsR", "kR", "radiation.rad", "rho", "Cp", "enthalpy",
+                 "mu", "kappa", "sigmaE", "entropy", "densRef"]
+
+
+@functools.lru_cache(maxsize=None)
+def solver_version(prop_dir):
+    """Hash of the Elenbaas solver and of its property data"""
+    version = hashlib.sha256()
+    for path in (os.path.join(os.path.dirname(__file__), "elenbaasengine.py"),
+                 os.path.join(prop_dir, "properties.mat")):
+        with open(path, "rb") as file:
+            version.update(file.read())
+    return version.hexdigest()
+
 class ElenbaasSession(SimWrapperSession):
     """
     Session class for Elenbaas wrapper.
     """
 
+    # Whether run() returns before the end of the simulation, see run_async
+    _async = False
+
     def __init__(self, engine="elenbaas", case="",
-    delete_simulation_files=True, **kwargs):
+    delete_simulation_files=True, workspace=None, result_cache=None,
+    cache_size=None, surrogate=None, **kwargs):
         super().__init__(engine, **kwargs)
         # Whether or not to store the generated files by the simulation engine
         self._delete_simulation_files = delete_simulation_files
+        # Workspace placing and removing the case directory, see Workspace
+        self._workspace = workspace or DEFAULT_WORKSPACE
+        # Directory of the solutions of previous operating points, None to
+        # disable, and its size limit in bytes
+        self._result_cache = result_cache
+        self._cache_size = cache_size
+        if result_cache and not os.path.exists(result_cache):
+            os.makedirs(result_cache)
+        # Interpolated solutions inside its trust region, see ElenbaasSurrogate,
+        # and their estimated errors by table name, None when solved
+        self._surrogate = surrogate
+        self.error_estimate = None
+        # Tables of the last solution {file name: array}, see elen_run
+        self.results = {}
 
         # Engine specific initializations
         self._initialized = False
@@ -32,7 +67,7 @@ class ElenbaasSession(SimWrapperSession):
     def close(self):
         """Invoked, when the session is being closed"""
         if self._delete_simulation_files and self._case_dir:
-            dir_util.remove_tree(self._case_dir)
+            self._workspace.release(self._case_dir)
 
         if self._initialized:
             self._initialized = False
@@ -41,11 +76,131 @@ class ElenbaasSession(SimWrapperSession):
     def _run(self, root_cuds_object):
         """Call the run command of the engine."""
         if self._initialized:
-            elen_run(self._elen_dict,self._case_files,self._case_dir)
-            self._create_CUDS()
+            # Solution of the surrogate, or of the same operating point from
+            # the result cache
+            key = self._cache_key() if self._result_cache else None
+            if self._apply_surrogate() or (key and self._restore_results(key)):
+                if self._async:
+                    self._handle = RunHandle(lambda: None, self._create_CUDS, lambda: None)
+                else:
+                    self._create_CUDS()
+            elif self._async:
+                # Elenbaas solution in a separate process, it can be terminated
+                proc = multiprocessing.Process(target=elen_run,
+                            args=(self._elen_dict,self._case_files,self._case_dir))
+                proc.start()
+                self._handle = RunHandle(lambda: self._join(proc, key),
+                                         self._create_CUDS, proc.terminate)
+            else:
+                # Tables kept in memory too, see CFDSession.plasma_data
+                self.results = elen_run(self._elen_dict,self._case_files,self._case_dir)
+                if key:
+                    self._store_results(key)
+                self._create_CUDS()
         else:
             raise ValueError("Session not initialized")
 
+    def run_async(self):
+        """Start the simulation without blocking. Returns a RunHandle to poll
+        or cancel it, its result() gathers the results into the CUDS."""
+        self._async = True
+        try:
+            self.run()
+        finally:
+            self._async = False
+        return self._handle
+
+    def _join(self, proc, key=None):
+        proc.join()
+        if proc.exitcode != 0:
+            raise RuntimeError("Elenbaas solution failed with exit code %s" % proc.exitcode)
+        # Tables of the solver process, as returned by elen_run
+        self._load_results()
+        if key:
+            self._store_results(key)
+
+    def _apply_surrogate(self):
+        """Write the tables of the surrogate into the case, False outside of
+        its trust region"""
+        self.error_estimate = None
+        prediction = self._surrogate.predict(self._elen_dict) if self._surrogate else None
+        if prediction is None:
+            return False
+
+        self.results, self.error_estimate = prediction
+        for name, table in self.results.items():
+            np.savetxt(os.path.join(self._case_dir, name), table,
+                       delimiter=" " if name == "densRef" else ",")
+        return True
+
+    def _cache_key(self):
+        """Content hash of the operating point and of the solver"""
+        point = {name: float(value) for name, value in self._elen_dict.items()}
+        point["solver"] = solver_version(self._case_files)
+        return hashlib.sha256(json.dumps(point, sort_keys=True).encode()).hexdigest()
+
+    def _restore_results(self, key):
+        """Hardlink, or copy across filesystems, a cached solution into the
+        case and load its tables"""
+        entry = os.path.join(self._result_cache, key)
+        if not os.path.isdir(entry):
+            return False
+        # Most recently used entries are evicted last
+        os.utime(entry)
+
+        for name in RESULT_TABLES:
+            src = os.path.join(entry, name)
+            dst = os.path.join(self._case_dir, name)
+            try:
+                os.link(src, dst)
+            except FileExistsError:
+                pass
+            except OSError:
+                shutil.copy2(src, dst)
+        self._load_results()
+        return True
+
+    def _load_results(self):
+        """Read the tables written by elen_run in the case into results"""
+        results = dict()
+        for name in RESULT_TABLES:
+            results[name] = np.loadtxt(os.path.join(self._case_dir, name),
+                                       delimiter=None if name == "densRef" else ",", ndmin=2)
+        self.results = results
+
+    def _store_results(self, key):
+        """Add the case solution to the cache, entries appear atomically"""
+        entry = os.path.join(self._result_cache, key)
+        if os.path.isdir(entry):
+            return
+
+        tmp = tempfile.mkdtemp(dir=self._result_cache)
+        for name in RESULT_TABLES:
+            shutil.copy2(os.path.join(self._case_dir, name), os.path.join(tmp, name))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Stored meanwhile by a concurrent session
+            shutil.rmtree(tmp)
+
+        if self._cache_size is not None:
+            self._evict_results()
+
+    def _evict_results(self):
+        """Remove the least recently used solutions above the size limit"""
+        entries = []
+        for entry in os.scandir(self._result_cache):
+            if entry.is_dir() and len(entry.name) == 64:
+                size = sum(table.stat().st_size for table in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self._cache_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            size -= entry_size
+
     # OVERRIDE
     def _load_from_backend(self, uids,expired=None):
         """Loads the cuds object from the simulation engine"""
@@ -73,9 +228,7 @@ class ElenbaasSession(SimWrapperSession):
 
     def _initialize(self, root_cuds_object, buffer):
 
-        self._case_dir = os.path.join(os.getcwd(),
-                                "elenbaas-%s" % root_cuds_object.uid)
-        os.mkdir(self._case_dir, mode=0o777)
+        self._case_dir = self._workspace.create("elenbaas-%s" % root_cuds_object.uid)
 
         # Get the base CUDS
         self._source = root_cuds_object.get(oclass=onto.PlasmaSource)[0]
@@ -0,0 +1,182 @@
+"""
+@author: Giorgio La Civita, UNIBO DIN
+"""
+
+import os, json, shutil, tempfile, itertools, multiprocessing
+import numpy as np
+from scipy.interpolate import RegularGridInterpolator
+
+from .elenbaasengine import elen_run
+from .elenbaassession import RESULT_TABLES, solver_version
+
+# Operating point of the Elenbaas solver, see ElenbaasSession._elen_dict
+INPUTS = ["Ar", "H2", "N2", "O2", "Input Power", "Flow Rate", "Inlet Radius"]
+
+# Radial profiles, their radius scales with the inlet radius
+PROFILES = ["VR", "TR", "epsR", "kR"]
+
+
+def _sample(point, prop_dir):
+    """Elenbaas solution of one operating point in a scratch directory"""
+    out_dir = tempfile.mkdtemp(prefix="elenbaas-sample-")
+    try:
+        return elen_run(point, prop_dir, out_dir)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+class ElenbaasSurrogate:
+    """Interpolation of the Elenbaas solutions over a grid of operating points.
+
+    The operating space is sampled offline by fit(): the inputs in axes vary
+    over the grid of their values, the others are fixed. predict() returns
+    the tables of elen_run for a point by multilinear interpolation of the
+    samples, with an estimate of the absolute interpolation error of each
+    table from the second differences of the samples (h^2 f''/8 along each
+    axis of three or more values). The property and radiation tables are
+    linear in the gas fractions, so they are interpolated exactly.
+
+    The trust region is the box of the axes with the fixed inputs as they
+    are and, with max_error, an estimated error of the profiles within
+    max_error times their largest value. Outside of it predict() returns
+    None and the solver is to be run instead, as ElenbaasSession does.
+    """
+
+    def __init__(self, axes, fixed, columns, values, version=None, max_error=None):
+        self.axes = {name: np.asarray(points, dtype=float) for name, points in axes.items()}
+        self.fixed = {name: float(value) for name, value in fixed.items()}
+        self.version = version
+        self.max_error = max_error
+        missing = [name for name in INPUTS if name not in self.axes and name not in self.fixed]
+        if missing:
+            raise ValueError("Surrogate inputs %s neither sampled nor fixed" % missing)
+
+        # First column of each table, the radius of the profiles divided by
+        # the inlet radius, and the slice of its second column in values
+        self.columns = {name: np.asarray(columns[name], dtype=float) for name in RESULT_TABLES}
+        self._slices = dict()
+        start = 0
+        for name in RESULT_TABLES:
+            self._slices[name] = slice(start, start + len(self.columns[name]))
+            start += len(self.columns[name])
+
+        self.values = np.asarray(values, dtype=float)
+        errors = self._error_field(self.values)
+        # One interpolation gives both the tables and their errors
+        self._interpolator = RegularGridInterpolator(
+            tuple(self.axes.values()), np.concatenate((self.values, errors), axis=-1))
+
+    @classmethod
+    def from_samples(cls, axes, fixed, samples, version=None, max_error=None):
+        """Surrogate of the elen_run results in samples, ordered as
+        itertools.product of the axes"""
+        shape = tuple(len(points) for points in axes.values())
+        first = samples[0]
+        radius = float(fixed["Inlet Radius"] if "Inlet Radius" in fixed
+                       else axes["Inlet Radius"][0])
+        columns = dict()
+        for name in RESULT_TABLES:
+            columns[name] = np.asarray(first[name], dtype=float)[:, 0]
+            if name in PROFILES:
+                columns[name] = columns[name] / radius
+
+        values = np.empty(shape + (sum(len(column) for column in columns.values()),))
+        for idx, sample in zip(np.ndindex(shape), samples):
+            values[idx] = np.concatenate([np.asarray(sample[name], dtype=float)[:, 1]
+                                          for name in RESULT_TABLES])
+        return cls(axes, fixed, columns, values, version, max_error)
+
+    @classmethod
+    def fit(cls, axes, fixed, prop_dir=None, processes=None, max_error=None):
+        """Sample elen_run over the grid of the axes, in processes parallel
+        processes (all the CPUs by default, 1 to run in this process)"""
+        prop_dir = prop_dir or os.path.dirname(__file__)
+        axes = {name: np.unique(np.asarray(points, dtype=float)) for name, points in axes.items()}
+        points = [dict(fixed, **dict(zip(axes, values)))
+                  for values in itertools.product(*axes.values())]
+
+        if processes == 1:
+            samples = [_sample(point, prop_dir) for point in points]
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                samples = pool.starmap(_sample, [(point, prop_dir) for point in points])
+        return cls.from_samples(axes, fixed, samples, solver_version(prop_dir), max_error)
+
+    def save(self, path):
+        """Store the surrogate in the npz file at path"""
+        meta = {"axes": {name: points.tolist() for name, points in self.axes.items()},
+                "fixed": self.fixed, "version": self.version}
+        np.savez(path, meta=json.dumps(meta), values=self.values,
+                 **{"column_" + name: column for name, column in self.columns.items()})
+
+    @classmethod
+    def load(cls, path, prop_dir=None, max_error=None):
+        """Surrogate stored by save(), it must be sampled from the current
+        solver and property data"""
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            columns = {name: data["column_" + name] for name in RESULT_TABLES}
+            values = data["values"]
+
+        version = solver_version(prop_dir or os.path.dirname(__file__))
+        if meta["version"] is not None and meta["version"] != version:
+            raise ValueError("Surrogate %s sampled from another Elenbaas solver" % path)
+        return cls(meta["axes"], meta["fixed"], columns, values, meta["version"], max_error)
+
+    def inside(self, point):
+        """Whether point is in the box of the samples"""
+        for name, value in self.fixed.items():
+            if not np.isclose(float(point[name]), value, rtol=1e-9, atol=1e-12):
+                return False
+        for name, points in self.axes.items():
+            if not points[0] <= float(point[name]) <= points[-1]:
+                return False
+        return True
+
+    def predict(self, point):
+        """Tables of elen_run and their estimated absolute errors, both keyed
+        by table name, at point. None outside of the trust region."""
+        if not self.inside(point):
+            return None
+        interpolated = self._interpolator([float(point[name]) for name in self.axes])[0]
+        values = interpolated[:self.values.shape[-1]]
+        errors = dict(zip(RESULT_TABLES, interpolated[self.values.shape[-1]:]))
+
+        if self.max_error is not None:
+            for name in PROFILES:
+                scale = np.abs(values[self._slices[name]]).max()
+                if errors[name] > self.max_error * scale:
+                    return None
+
+        radius = float(point["Inlet Radius"])
+        results = dict()
+        for name in RESULT_TABLES:
+            column = self.columns[name] * radius if name in PROFILES else self.columns[name]
+            results[name] = np.c_[column, values[self._slices[name]]]
+        return results, errors
+
+    def _error_field(self, values):
+        """Largest estimated error of each table at the samples"""
+        error = np.zeros(values.shape)
+        for axis, points in enumerate(self.axes.values()):
+            if len(points) < 3:
+                # No curvature from two samples
+                continue
+            lower = np.take(values, range(0, len(points) - 2), axis=axis)
+            middle = np.take(values, range(1, len(points) - 1), axis=axis)
+            upper = np.take(values, range(2, len(points)), axis=axis)
+            # Second difference of unevenly spaced samples, scaled to the
+            # wider of the two neighbouring cells
+            step = np.diff(points)
+            left = step[:-1].reshape((-1,) + (1,) * (values.ndim - axis - 1))
+            right = step[1:].reshape((-1,) + (1,) * (values.ndim - axis - 1))
+            curvature = 2 * ((upper - middle) / right - (middle - lower) / left) / (left + right)
+            width = np.maximum(left, right)
+            local = np.abs(curvature) * width ** 2 / 8
+            # The boundary samples take the estimate of their neighbour
+            local = np.concatenate((np.take(local, [0], axis=axis), local,
+                                    np.take(local, [-1], axis=axis)), axis=axis)
+            error += local
+
+        return np.stack([error[..., self._slices[name]].max(axis=-1)
+                         for name in RESULT_TABLES], axis=-1)
@@ -17,7 +17,7 @@
 #You should have received a copy of the GNU General Public License
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, subprocess, shutil, time
+import os, subprocess, shutil, time, re, mmap, signal
 import numpy as np
 
 from osp.core.session import SimWrapperSession
@@ -25,9 +25,37 @@ from osp.core.utils import pretty_print
 from osp.core import ONTOLOGY_NAMESPACE_REGISTRY, get_entity
 from osp.core import force_cfd_ontology as onto
 from pyofi import Controller
-
-
-def CudsFinder(cuds, target_namespace, foam_concept):
+from osp.wrappers.workspace import DEFAULT_WORKSPACE
+
+# foam_chunk of the outputs referenced instead of inlined, see _read_output
+OUTPUT_REFERENCE = "@file:%s:%d:%d"
+REFERENCE_PATTERN = re.compile(r"^@file:(.*):(\d+):(\d+)$")
+
+# Dictionary of the obstacle set, see _write_obstacle_dict
+OBSTACLE_DICT = """FoamFile
+{
+    version     2.0;
+    format      ascii;
+    class       dictionary;
+    location    "%s";
+    object      %s;
+}
+
+obstacles
+{
+%s}
+"""
+OBSTACLE_ENTRY = """    "%s"
+    {
+        width       %s;
+        height      %s;
+        depth       %s;
+        position    (%s);
+    }
+"""
+
+
+def CudsFinder(cuds, target_namespace, foam_concept, paths=None):
     """
     Return the disred instance with an attribute `foam_concept`
     within the basal `cuds` of oclass `input_data` resulting
@@ -52,6 +80,10 @@ def CudsFinder(cuds, target_namespace, foam_concept):
     foam_concept : str
         Key or namespace in the dictionary of an OpenFoam file (e.g. "blocks",
         "deltaH", ...)
+    paths : dict, optional
+        Paths already found, per (ontology, target_namespace, foam_concept),
+        the path found is added to it. The ontology is scanned each time
+        if None
 
     Returns
     -------
@@ -60,13 +92,18 @@ def CudsFinder(cuds, target_namespace, foam_concept):
         attribute found during the scan of the `target_cuds`
     """
     target_entity = _return_entity(cuds, target_namespace)
-    for subclass in target_entity.subclasses:
-        if foam_concept in subclass.attributes.values():
-            path = subclass.superclasses
-    for superentity in target_entity.superclasses:
-        path.remove(superentity)
+    paths = dict() if paths is None else paths
+    key = (cuds.oclass.namespace.name, target_namespace, foam_concept)
+    if key not in paths:
+        for subclass in target_entity.subclasses:
+            if foam_concept in subclass.attributes.values():
+                path = list(subclass.superclasses)
+        for superentity in target_entity.superclasses:
+            path.remove(superentity)
+        paths[key] = path
     target_cuds = cuds.get(oclass=target_entity)[0]
-    return _trace_path(target_cuds, path)
+    # _trace_path consumes the path
+    return _trace_path(target_cuds, list(paths[key]))
 
 
 def _trace_path(target_cuds, path):
@@ -127,8 +164,35 @@ def _return_entity(cuds, namespace):
 
 class NanoDockerSession(SimWrapperSession):
 
-    def __init__(self, engine=None, **kwargs):
+    # Interval between the attempts to connect to the solver [s]
+    CONNECT_INTERVAL = 0.1
+
+    def __init__(self, engine=None, inline_limit=None, startup_timeout=60.,
+                 preprocess_timeout=600., workspace=None, obstacle_dict=None,
+                 **kwargs):
         super().__init__(engine, **kwargs)
+        # Workspace placing the case directory, see Workspace
+        self._workspace = workspace or DEFAULT_WORKSPACE
+        # Time allowed to PUFoam to accept the controller [s]
+        self._startup_timeout = startup_timeout
+        # Time allowed to each preprocessing tool [s]
+        self._preprocess_timeout = preprocess_timeout
+        # Output files larger than inline_limit bytes are referenced by
+        # path, offset and size in foam_chunk, None to inline all of them
+        self._inline_limit = inline_limit
+        # Pending obstacle changes, sent to the controller once per run
+        self._obstacles = dict()
+        # Case file, e.g. "constant/obstacleDict", holding the whole set of
+        # obstacles written once per run for the solvers reading it, None
+        # to send the changes to the controller one message per obstacle
+        self._obstacle_dict = obstacle_dict
+        # Obstacles sent so far {uid: (dimensions, position)}
+        self._obstacle_set = dict()
+        # Paths found in the ontology by CudsFinder, see CudsFinder
+        self._paths = dict()
+        # CUDS found in the input data per (uid, data_dict, namespace),
+        # cleared whenever CUDS other than obstacles change
+        self._found = dict()
         self._case_files=os.path.join(os.path.dirname(__file__),
                                       "cases", "dow_example")
         self._initialized = False
@@ -148,6 +212,7 @@ class NanoDockerSession(SimWrapperSession):
         dx = self._get_ofi_args(
             simulation, "cell_numbers", "MeshDictData"
         )
+        self._flush_obstacles()
         print(f"Run PUFoam until tmax={tmax} with dt={dt} and dx={dx}")
         self._ofi.run(
             float(tmax), float(dt), dx[0]
@@ -189,35 +254,79 @@ class NanoDockerSession(SimWrapperSession):
                 self._initialize_engine(isim)
         for cuds_object in buffer.values():
             if cuds_object.is_a(onto["Obstacle"]):
-                self._add_obstacle(cuds_object)              
+                self._add_obstacle(cuds_object)
+            else:
+                self._found.clear()              
 
     # OVERRIDE
     def _apply_updated(self, root_obj, buffer):
         for cuds_object in buffer.values():
             if cuds_object.is_a(onto.Obstacle):
                 self._update_obstacle(cuds_object)
+            else:
+                self._found.clear()
 
     # OVERRIDE
     def _apply_deleted(self, root_obj, buffer):
-        for cuds_object in buffer:
+        for cuds_object in buffer.values():
             if cuds_object.is_a(onto.Obstacle):
-                self._remove_obstacle(cuds_object)      
+                self._remove_obstacle(cuds_object)
+            else:
+                self._found.clear()      
 
     def _initialize_engine(self, simulation):
         self._process_input_data(simulation)
-        for proc in ["blockMesh", "setFields", "PUFoam"]:
-            cmd=f"/bin/bash -c  \"source $HOME/.bashrc && {proc}\""
-            self._ofi_process=subprocess.Popen(cmd, 
-                                               shell=True, 
-                                               cwd=self._case_dir)
-            time.sleep(1)
-        self._ofi = Controller()
+        # Preprocessing, each tool has to complete before the next one
+        for proc in ["blockMesh", "setFields"]:
+            self._preprocess(proc)
+        self._ofi_process=subprocess.Popen(self._command("PUFoam"),
+                                           shell=True,
+                                           cwd=self._case_dir)
+        self._ofi = self._connect()
         self._initialized = True
 
+    def _preprocess(self, proc):
+        """Runs a preprocessing tool in the case directory, killing it
+           past the preprocessing timeout"""
+        process = subprocess.Popen(self._command(proc),
+                                   shell=True,
+                                   cwd=self._case_dir,
+                                   start_new_session=True)
+        try:
+            returncode = process.wait(timeout=self._preprocess_timeout)
+        except subprocess.TimeoutExpired as error:
+            # The shell and the tool it started
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            raise TimeoutError(f"{proc} did not complete within "
+                               f"{self._preprocess_timeout} s") from error
+        if returncode != 0:
+            raise RuntimeError(f"{proc} failed with exit code {returncode}")
+
+    def _command(self, proc):
+        return f"/bin/bash -c  \"source $HOME/.bashrc && {proc}\""
+
+    def _connect(self):
+        """Connects the controller to the solver as soon as it is ready"""
+        deadline = time.monotonic() + self._startup_timeout
+        while True:
+            returncode = self._ofi_process.poll()
+            if returncode is not None:
+                raise RuntimeError(f"PUFoam exited with code {returncode} "
+                                   "before accepting the controller")
+            try:
+                return Controller()
+            # The solver is not listening yet
+            except OSError as error:
+                if time.monotonic() > deadline:
+                    self._ofi_process.kill()
+                    raise TimeoutError("PUFoam did not accept the controller "
+                                       f"within {self._startup_timeout} s") from error
+                time.sleep(self.CONNECT_INTERVAL)
+
     def _process_input_data(self, simulation):
-        self._case_dir = os.path.join(os.getcwd(), 
-                                      f"simulation-{simulation.uid}")
-        shutil.copytree(self._case_files, self._case_dir)
+        self._case_dir = self._workspace.create(f"simulation-{simulation.uid}")
+        shutil.copytree(self._case_files, self._case_dir, dirs_exist_ok=True)
         inputdata=simulation.get(oclass=onto["InputData"])[0]
         for dict_data in inputdata.iter():
             if dict_data.oclass in onto["InputData"].direct_subclasses:
@@ -247,8 +356,11 @@ class NanoDockerSession(SimWrapperSession):
         
     def _get_ofi_args(self, simulation, namespace, data_dict):
         inputdata = simulation.get(oclass=onto["InputData"]).pop()
-        found_cuds = CudsFinder(inputdata, data_dict, namespace)
-        attrs = found_cuds.get_attributes()
+        found_key = (inputdata.uid, data_dict, namespace)
+        if found_key not in self._found:
+            self._found[found_key] = CudsFinder(inputdata, data_dict, namespace,
+                                                self._paths)
+        attrs = self._found[found_key].get_attributes()
         common_key = [
             key for key in attrs.keys() \
                 if key in onto["Physical_foam_quantity"].attributes.keys()
@@ -263,51 +375,77 @@ class NanoDockerSession(SimWrapperSession):
 
     def _add_obstacle(self, obstacle):
         """Adds an obstacle"""
-        width, height, depth = self._extract_dimensions(obstacle)
-        position = self._extract_position(obstacle)
-        # Add the obstacle
-        self._ofi.updateObstacle(
-            str(obstacle.uid), width, height, depth, position
-        )
+        self._obstacles[str(obstacle.uid)] = (self._extract_dimensions(obstacle),
+                                              self._extract_position(obstacle))
 
     def _update_obstacle(self, obstacle):
         """Updates the properties of an existing obstacle"""
-        if not obstacle.get(rel=onto["IsPartOf"]):
-            self._remove_obstacle(obstacle)
-        # Extract obstacle properties
-        width, height, depth = self._extract_dimensions(obstacle)
-        position = self._extract_position(obstacle)
-        # Update an existing obstacle
-        self._ofi.updateObstacle(
-            str(obstacle.uid), width, height, depth, position
-        )
+        # The controller creates the obstacles it does not know, so removing
+        # and adding back a detached obstacle reduces to its update
+        self._add_obstacle(obstacle)
 
     def _remove_obstacle(self, obstacle):
         """Removes an existing obstacle"""
-        self._ofi.removeObstacle(str(obstacle.uid)) 
+        self._obstacles[str(obstacle.uid)] = None
+
+    def _flush_obstacles(self):
+        """Sends the obstacle changes collected since the last run, only
+           the last change of each obstacle is kept"""
+        if not self._obstacles:
+            return
+        updates, removals = [], []
+        for uid, change in self._obstacles.items():
+            if change is None:
+                removals.append(uid)
+                self._obstacle_set.pop(uid, None)
+            else:
+                (width, height, depth), position = change
+                updates.append((uid, width, height, depth, position))
+                self._obstacle_set[uid] = change
+        self._obstacles = dict()
+
+        if self._obstacle_dict:
+            self._write_obstacle_dict()
+            return
+
+        # The controller has no batched call, one message per obstacle
+        for uid in removals:
+            self._ofi.removeObstacle(uid)
+        for update in updates:
+            self._ofi.updateObstacle(*update)
+
+    def _write_obstacle_dict(self):
+        """Writes the whole set of obstacles in one dictionary, replaced
+           at once so that the solver never reads it half written"""
+        entries = []
+        for uid, ((width, height, depth), position) in self._obstacle_set.items():
+            entries.append(OBSTACLE_ENTRY % (uid, width, height, depth,
+                                             " ".join(str(x) for x in position)))
+        location, filename = os.path.split(self._obstacle_dict)
+        file_path = os.path.join(self._case_dir, self._obstacle_dict)
+        with open(file_path + ".tmp", "w") as dict_file:
+            dict_file.write(OBSTACLE_DICT % (location, filename, "".join(entries)))
+        os.replace(file_path + ".tmp", file_path)
 
     def _extract_dimensions(self, cuds_object):
         """Extracts width, depth and height from a CUDS object;
            default dimension value of 1 is set otherwise"""
-        width = depth = height = 1
+        dimensions = []
         # Get objects's dimensions
-        if cuds_object.get(oclass=onto.Width):
-            width = cuds_object.get(oclass=onto.Width)[0].value
-        if cuds_object.get(oclass=onto.Height):
-            height = cuds_object.get(oclass=onto.Height)[0].value
-        if cuds_object.get(oclass=onto.Depth):
-            depth = cuds_object.get(oclass=onto.Depth)[0].value
-        return width, height, depth
+        for oclass in (onto.Width, onto.Height, onto.Depth):
+            found = cuds_object.get(oclass=oclass)
+            dimensions.append(found[0].value if found else 1)
+        return tuple(dimensions)
 
     def _extract_position(self, cuds_object):
         """Extract a 3D position from a CUDS object;
            default position of (0,0,0) is set otherwise"""
         position = [0, 0, 0]
         # Get object's position
-        if cuds_object.get(oclass=onto.Position):
-            position[0] = cuds_object.get(oclass=onto.Position)[0].vector[0]
-            position[1] = cuds_object.get(oclass=onto.Position)[0].vector[1]
-            position[2] = cuds_object.get(oclass=onto.Position)[0].vector[2]
+        found = cuds_object.get(oclass=onto.Position)
+        if found:
+            vector = found[0].vector
+            position = [vector[0], vector[1], vector[2]]
         return position
 
     def _gather_output(self, simulation):
@@ -322,15 +460,38 @@ class NanoDockerSession(SimWrapperSession):
                     attrs[FoamDir],
                     attrs[FoamFileName]
                 )
-                with open(path, "r") as outputfile:
-                    filecontent=''
-                    for line in outputfile:
-                        filecontent+=line
                 outputfile_instance=entity(
-                    foam_chunk=filecontent
+                    foam_chunk=self._read_output(path)
                 )
                 output.add(
                     outputfile_instance, 
                     rel=onto["HasPart"]
                 )
         simulation.add(output, rel=onto["HasPart"])
+
+    def _read_output(self, path):
+        """Content of an output file, or its reference if larger than
+           the inline limit"""
+        size = os.path.getsize(path)
+        if self._inline_limit is not None and size > self._inline_limit:
+            return OUTPUT_REFERENCE % (path, 0, size)
+        with open(path, "r") as outputfile:
+            return outputfile.read()
+
+    def read_output(self, foam_chunk):
+        """Text of an output, resolving the referenced ones by
+           memory-mapping only the referenced part of the file"""
+        match = REFERENCE_PATTERN.match(foam_chunk)
+        if not match:
+            return foam_chunk
+        path = match.group(1)
+        offset, size = int(match.group(2)), int(match.group(3))
+        with open(path, "rb") as outputfile:
+            length = os.fstat(outputfile.fileno()).st_size
+            if offset + size > length:
+                raise ValueError(f"Output reference {foam_chunk} beyond the "
+                                 f"{length} bytes of the file")
+            if size == 0:
+                return ""
+            with mmap.mmap(outputfile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return data[offset:offset+size].decode()
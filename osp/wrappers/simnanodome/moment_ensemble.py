@@ -0,0 +1,319 @@
+"""
+@author: Giorgio La Civita, UNIBO DIN
+"""
+
+import numpy as np
+
+K_BOL = 1.380650524e-23 #[J/K]
+R_GAS = 8.3144621 #[J/mol/K]
+
+
+class StreamlineBundle:
+    """Piecewise linear temperature histories of M ensemble members.
+
+    The histories are padded to a common length and stored as 2D arrays,
+    so that temperature and temperature derivative are evaluated for all
+    members with a handful of NumPy operations. As in the nanoDOME engine
+    the derivative is zero outside the history and the temperature is
+    frozen once it drops below T_stop.
+    """
+
+    def __init__(self, times, temps, T_stop=300.):
+        self.size = len(times)
+        npoints = np.array([len(tt) for tt in times])
+        length = np.amax(npoints)
+
+        self.time = np.empty((self.size, length))
+        self.temp = np.empty((self.size, length))
+        for idx, (tt, TT) in enumerate(zip(times, temps)):
+            self.time[idx,:len(tt)] = tt
+            self.time[idx,len(tt):] = np.inf
+            self.temp[idx,:len(TT)] = TT
+            self.temp[idx,len(TT):] = TT[-1]
+
+        self.rows = np.arange(self.size)
+        self.last = npoints - 2
+        self.t_first = self.time[:,0]
+        self.t_last = self.time[self.rows,npoints-1]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.diff(self.temp, axis=1)/np.diff(self.time, axis=1)
+        self.slope = np.where(np.isfinite(slope), slope, 0.)
+
+        self.t_freeze = self._freeze_times(T_stop)
+        self._idx = np.zeros(self.size, dtype=int)
+
+    @classmethod
+    def from_gradients(cls, T_start, gradient, t_end, T_stop=300.):
+        """Members with a constant temperature gradient from t=0 to t_end"""
+        T_start, gradient = np.broadcast_arrays(np.atleast_1d(T_start).astype(float),
+                                                np.atleast_1d(gradient).astype(float))
+        times = [[0., t_end] for _ in range(len(T_start))]
+        temps = [[T0, T0 + dT*t_end] for T0, dT in zip(T_start, gradient)]
+        return cls(times, temps, T_stop)
+
+    def _freeze_times(self, T_stop):
+        """First time each history reaches T_stop, inf if never"""
+        t_freeze = np.full(self.size, np.inf)
+        for row in range(self.size):
+            TT = self.temp[row,:self.last[row]+2]
+            tt = self.time[row,:self.last[row]+2]
+            if TT[0] <= T_stop:
+                t_freeze[row] = tt[0]
+                continue
+            below = np.nonzero(TT <= T_stop)[0]
+            if len(below):
+                ii = below[0] - 1
+                t_freeze[row] = tt[ii] + (T_stop - TT[ii])/self.slope[row,ii]
+        return t_freeze
+
+    def _locate(self, t):
+        """Segment index of each member at time(s) t"""
+        idx = self._idx
+        rows = self.rows
+        while True:
+            back = (idx > 0) & (t < self.time[rows,idx])
+            fwd = (idx < self.last) & (t >= self.time[rows,idx+1])
+            if not (back.any() or fwd.any()):
+                break
+            idx = idx - back + fwd
+        self._idx = idx
+        return idx
+
+    def evaluate(self, t):
+        """Temperature and temperature derivative of all members at time t"""
+        t_eff = np.clip(np.minimum(t, self.t_freeze), self.t_first, self.t_last)
+        idx = self._locate(t_eff)
+        slope = self.slope[self.rows,idx]
+        T = self.temp[self.rows,idx] + slope*(t_eff - self.time[self.rows,idx])
+        active = (t > self.t_first) & (t < self.t_last) & (t < self.t_freeze)
+        return T, np.where(active, slope, 0.)
+
+
+class MomentEnsemble:
+    """Moment model (Pratsinis) advanced for M members at once.
+
+    NumPy port of the Low accuracy level: the state of each member is the
+    precursor monomer density n1 [#/m3] and the first three moments of the
+    particles volume distribution M0 [#/m3], M1 [m3/m3] and M2 [m6/m3],
+    closed with a lognormal distribution. Nucleation follows the
+    self-consistent classical theory (Girshick and Chiu), condensation and
+    coagulation the free molecular regime (Pratsinis, 1988). The gas is
+    expanded at constant pressure following the imposed temperature.
+    Being an independent implementation its results are close to, but not
+    identical with, the ones of the nanoDOME MomentModelPratsinis: the
+    regression test against nano_run Low (test_ensemble_regression) accepts
+    25% on the mean diameter and on the volume percentage and a factor 2 on
+    the number density. For this reason the ensemble is only used on
+    request, see NanoDOMESession(ensemble=True) and nano_engine.batch_steps,
+    and its results are written in Bins named BIN_NAME.
+    """
+
+    # Name of the Bins holding the results of the ensemble
+    BIN_NAME = "Approximate PSD bin"
+
+    # Smallest precursor density of the absolute error floor of
+    # run_adaptive, for members without precursor [#/m3]
+    N_MIN = 1.
+
+    def __init__(self, eng, prec, pressure, x_prec, histories):
+        self.histories = histories
+        self.size = histories.size
+
+        self.m1 = eng.get_prec_mass(prec)
+        self.rho = eng.get_bulk_liquid(prec)
+        self.T_melt = eng.get_melting_point(prec)
+        self.st_m, self.st_dT = eng.get_surface_tension(prec)
+        self.T_boil, self.H_vap = eng.get_vaporization(prec)
+
+        self.v1 = self.m1/self.rho
+        self.s1 = np.power(36*np.pi, 1/3.)*np.power(self.v1, 2/3.)
+
+        # Temperature independent factors of the kinetic coefficients
+        self.c_coag = np.power(3/(4*np.pi), 1/6.)*np.sqrt(6*K_BOL/self.rho)
+        self.c_beta11 = self.c_coag*np.sqrt(2/self.v1)*4*np.power(self.v1, 2/3.)
+        self.c_cond = self.v1*np.sqrt(K_BOL/(2*np.pi*self.m1))*np.power(36*np.pi, 1/3.)
+
+        T0, _ = histories.evaluate(0.)
+        pressure = np.broadcast_to(np.asarray(pressure, dtype=float), T0.shape)
+        x_prec = np.broadcast_to(np.asarray(x_prec, dtype=float), T0.shape)
+
+        self.t = 0.
+        self.y = np.zeros((4, self.size))
+        self.y[0] = x_prec*pressure/(K_BOL*T0)
+
+    def saturation_density(self, T):
+        """Precursor saturation number density (Clausius-Clapeyron) [#/m3]"""
+        p_sat = 101325.*np.exp(-self.H_vap/R_GAS*(1./T - 1./self.T_boil))
+        return p_sat/(K_BOL*T)
+
+    # Fractional moments required by condensation and coagulation
+    k_frac = np.array([2/3., 5/3., -1/2., 1/3., -1/6., 1/6., 1/2., 4/3., 5/6., 7/6.])[:,None]
+
+    def moments(self, y):
+        """Fractional moments M_k (k in k_frac) of the lognormal
+        distributions and their geometric standard deviation"""
+        M0, M1, M2 = y[1], y[2], y[3]
+        has = (M0 > 0.) & (M1 > 0.) & (M2 > 0.)
+        lnM0, lnM1, lnM2 = np.log(M0), np.log(M1), np.log(M2)
+        ln2s = np.where(has, np.maximum((lnM0 + lnM2 - 2*lnM1)/9., 0.), 0.)
+        lnvg = 2*lnM1 - 1.5*lnM0 - 0.5*lnM2
+        k = self.k_frac
+        Mk = np.where(has, np.exp(lnM0 + k*lnvg + 4.5*k*k*ln2s), 0.)
+        return Mk, np.exp(np.sqrt(ln2s))
+
+    def derivatives(self, t, y):
+        """Time derivatives of the state y at time t"""
+        n1, M0, M1 = y[0], y[1], y[2]
+        T, dTdt = self.histories.evaluate(t)
+        sqrtT = np.sqrt(T)
+        dy = np.empty_like(y)
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            # Nucleation
+            n_s = self.saturation_density(T)
+            S = n1/n_s
+            theta = (self.st_m - self.st_dT*(T - self.T_melt))*self.s1/(K_BOL*T)
+            nucl = S > 1.
+            lnS = np.log(np.where(nucl, S, 2.))
+            J = np.where(nucl, self.c_beta11*sqrtT*n_s*n1/12.*np.sqrt(theta/(2*np.pi)) \
+                         *np.exp(theta - 4*theta*theta*theta/(27*lnS*lnS)), 0.)
+            k_star = np.maximum(np.power(2*theta/(3*lnS), 3), 1.)
+            v_star = k_star*self.v1
+
+            (M_23, M_53, M_m12, M_13, M_m16, M_16, M_12, M_43, M_56, M_76), sg = \
+                self.moments(y)
+
+        # Condensation
+        B1 = self.c_cond*sqrtT*np.maximum(n1 - n_s, 0.)
+
+        # Coagulation
+        K_f = self.c_coag*sqrtT
+        b0 = 0.633 + 0.092*sg*sg - 0.022*sg*sg*sg
+        b2 = 0.39 + 0.5*sg - 0.214*sg*sg + 0.029*sg*sg*sg
+
+        dy[0] = -J*k_star - B1*M_23/self.v1
+        dy[1] = J - K_f*b0*(M_23*M_m12 + 2*M_13*M_m16 + M_16*M0)
+        dy[2] = J*v_star + B1*M_23
+        dy[3] = J*v_star*v_star + 2*B1*M_53 \
+                + 2*K_f*b2*(M_53*M_12 + 2*M_43*M_56 + M_76*M1)
+
+        # Gas expansion at constant pressure
+        dy -= y*(dTdt/T)
+
+        return dy
+
+    def advance(self, steps, dt=1e-9, t_end=np.inf):
+        """Advance all members by steps fixed explicit timesteps in one call,
+        stopping once past t_end. Returns the number of steps taken."""
+        y = self.y
+        t = self.t
+        derivatives = self.derivatives
+        taken = 0
+        while taken < steps and t <= t_end:
+            y = y + dt*derivatives(t, y)
+            np.maximum(y, 0., out=y)
+            t += dt
+            taken += 1
+        self.y = y
+        self.t = t
+        return taken
+
+    def run(self, t_end, dt=1e-9, monitor=None, check_every=1000):
+        """Advance all members to t_end with fixed explicit timesteps, in
+        calls of check_every steps. With a ConvergenceMonitor, checked
+        after each call, stop once all the members converged."""
+        while (self.t <= t_end):
+            self.advance(check_every, dt, t_end)
+            if monitor is not None and \
+               monitor.converged(self.t, lambda: self.monitored(self.t, self.y)):
+                break
+
+    def monitored(self, t, y):
+        """Temperature, number density and volume fraction of all members,
+        see ConvergenceMonitor"""
+        T, _ = self.histories.evaluate(t)
+        return np.concatenate((T, y[1], y[2]))
+
+    def run_adaptive(self, t_end, rtol=1e-3, atol=1e-6, dt=1e-9, dt_max=1e-6,
+                     dt_min=1e-18, monitor=None):
+        """Advance all members to t_end with the embedded Runge-Kutta 3(2)
+        pair of Bogacki and Shampine.
+
+        The step is shared by the members and chosen so that the estimated
+        local error stays below rtol relative to the state, with an absolute
+        floor of atol times the initial precursor density, at least N_MIN
+        (expressed in the units of each moment). Cold or frozen parts of the
+        histories are crossed with steps up to dt_max. Steps with a non
+        finite error estimate are rejected too, a RuntimeError is raised
+        when the step falls below dt_min. Accepted and rejected steps are
+        counted in self.steps and self.rejected. With a ConvergenceMonitor,
+        checked after every accepted step, stop once all members converged.
+        At rtol=1e-3 the results stay within 1e-3 of the fixed timestep ones,
+        so within the tolerances of the ensemble against nano_run Low (see
+        the class docstring), which test_ensemble_regression checks for
+        both. The engine MomentModelPratsinis cannot be rewound to reject a
+        step, nano_run Low has its own step selector instead, see
+        LowAccuracyStepper.run_adaptive.
+        """
+        y = self.y
+        t = self.t
+        derivatives = self.derivatives
+
+        n_ref = max(np.amax(y[0]), self.N_MIN)
+        floor = atol*n_ref*np.array([1., 1., self.v1, self.v1*self.v1])[:,None]
+
+        self.steps = 0
+        self.rejected = 0
+
+        k1 = derivatives(t, y)
+        while (t < t_end):
+            dt = min(dt, dt_max, t_end - t)
+
+            k2 = derivatives(t + dt/2, np.maximum(y + dt/2*k1, 0.))
+            k3 = derivatives(t + 3*dt/4, np.maximum(y + 3*dt/4*k2, 0.))
+            y_new = np.maximum(y + dt*(2/9.*k1 + 1/3.*k2 + 4/9.*k3), 0.)
+            k4 = derivatives(t + dt, y_new)
+
+            # Difference between the third and second order solutions
+            err = dt*(-5/72.*k1 + 1/12.*k2 + 1/9.*k3 - 1/8.*k4)
+            scale = rtol*np.maximum(np.abs(y), np.abs(y_new)) + floor
+            with np.errstate(invalid='ignore', over='ignore'):
+                err_norm = np.amax(np.abs(err)/scale)
+
+            if not np.isfinite(err_norm):
+                # e.g. overflow of the intermediate stages
+                self.rejected += 1
+                dt *= 0.2
+            elif err_norm <= 1.:
+                t += dt
+                y = y_new
+                k1 = k4
+                self.steps += 1
+                if monitor is not None and \
+                   monitor.converged(t, lambda: self.monitored(t, y)):
+                    break
+            else:
+                self.rejected += 1
+
+            # Standard controller for a third order method
+            if err_norm == 0.:
+                dt *= 5.
+            elif np.isfinite(err_norm):
+                dt *= min(5., max(0.2, 0.9*np.power(err_norm, -1/3.)))
+
+            if dt < dt_min and t < t_end:
+                raise RuntimeError("Adaptive timestep below %g s at t=%g s" % (dt_min, t))
+
+        self.y = y
+        self.t = t
+
+    def results(self):
+        """Mean diameter [nm], number density [#/m3] and volume percentage
+        of each member"""
+        M0, M1 = self.y[1], self.y[2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_diam = np.where(M0 > 0., np.cbrt(6*M1/(np.pi*M0)), 0.)
+        vol_frac = np.pi*np.power(mean_diam, 3)*M0/6.
+
+        return mean_diam*1e+9, M0, vol_frac*100
@@ -4,9 +4,30 @@
 
 import numpy as np, os, time, sys
 from osp.wrappers.simnanodome.nanolib import libontodome as nn
+from osp.wrappers.simnanodome.nano_steppers import STEPPERS, TemperatureDriver, \
+                                                 LowAccuracyStepper, ConvergenceMonitor
+from osp.wrappers.simnanodome.moment_ensemble import StreamlineBundle, MomentEnsemble
 
 class nano_engine:
 
+    # Accuracy level name -> stepper class, extend to add new models
+    steppers = STEPPERS
+
+    # Timesteps advanced per Python call by the Low accuracy nano_run, run
+    # by the vectorized moment model (MomentEnsemble, approximate) instead of
+    # the engine MomentModelPratsinis; None for the engine one step per call
+    batch_steps = None
+
+    # Relative tolerance of the adaptive timestep used by ensemble_run and
+    # by the Low accuracy nano_run, None to keep the fixed Low timestep
+    rtol = None
+
+    # Relative change of the temperature and of the particle quantities over
+    # freeze_window seconds below which nano_run and ensemble_run are
+    # stopped, None to disable
+    freeze_tol = None
+    freeze_window = 1e-5
+
     def PSD_post(self,psd,voll):
 
         if (len(psd)==0):
@@ -69,6 +90,14 @@ class nano_engine:
                 raise ValueError('File not found.')
 
     def stream_evo(self,TimeTemp_stream, index):
+        # In memory streamlines, see NanoDOMESession.stream_data
+        if isinstance(TimeTemp_stream, np.ndarray):
+            return TimeTemp_stream[:,index].tolist()
+
+        # Binary streamlines exported by the CFD session
+        if TimeTemp_stream.endswith(".npy"):
+            return np.load(TimeTemp_stream)[:,index].tolist()
+
         readert = self.DataReader(TimeTemp_stream,',')
 
         data = []
@@ -199,15 +228,81 @@ class nano_engine:
         else:
             return ret
 
-    def nano_run(self,dictio):
+    def get_surface_tension(self,spec):
+        """Liquid surface tension at the melting point [N/m]
+        and its temperature coefficient [N/m/K]"""
 
-        vals = []
-        units = []
+        masses = [ ((0.732, 8.6e-5),"Si"),
+                  ((1.872, 4.9e-4),"Fe"),
+                  ((1.303, 2.3e-4),"Cu"),
+                  ((1.650, 2.6e-4),"Ti"),
+                  ((0.914, 3.5e-4),"Al"),
+                  ((0.903, 1.6e-4),"Ag")]
 
+        ret = None
+        for ms in masses:
+            if ms[1] == spec:
+                ret = ms[0]
+                break
+
+        if ret is None:
+            print ("Species", spec, "not found in current database.")
+            raise ValueError
+        else:
+            return ret
+
+    def get_vaporization(self,spec):
+        """Normal boiling point [K] and enthalpy of vaporization [J/mol]"""
+
+        masses = [ ((3538., 359e+3),"Si"),
+                  ((3134., 340e+3),"Fe"),
+                  ((2835., 300e+3),"Cu"),
+                  ((3560., 425e+3),"Ti"),
+                  ((2743., 294e+3),"Al"),
+                  ((2435., 255e+3),"Ag")]
+
+        ret = None
+        for ms in masses:
+            if ms[1] == spec:
+                ret = ms[0]
+                break
+
+        if ret is None:
+            print ("Species", spec, "not found in current database.")
+            raise ValueError
+        else:
+            return ret
+
+    def mole_fractions(self,dictio):
+        """Molar fractions of the precursor and of the carrier gases"""
         AMU = 1.660538921e-27 #[kg]
-        K_BOL = 1.380650524e-23 #[J/K]
 
-        clock = nano_engine.WallClock()
+        MM = 0.
+        for idx,gas_m in enumerate(dictio._gas_fractions,start = 1):
+            MM += gas_m*self.get_gas_mass(dictio.species[idx])
+
+        prec_mass = self.get_prec_mass(dictio.species[0])
+
+        nm_prec = dictio._feedrate/(prec_mass/AMU)
+        nm_gas = 0.
+
+        nm_gases = []
+        for idx,gf in enumerate(dictio._gas_fractions,start=1):
+            val = (gf*self.get_gas_mass(dictio.species[idx])/AMU/(MM/AMU))*dictio._flowrate*dictio._dens_ref/60000.
+            nm_gases.append(val)
+            nm_gas += val
+
+        ntot = nm_prec + nm_gas
+
+        return np.true_divide([nm_prec] + nm_gases, ntot)
+
+    def nano_run(self,dictio):
+
+        if dictio._acc_level == "Low" and self.batch_steps:
+            return self.batched_run(dictio)
+
+        vals = []
+        units = []
 
         gas = nn.GasMixture()
 
@@ -304,28 +399,13 @@ class nano_engine:
         melp = nn.MeltingPoint(vals[-1],units[-1])
         species[0].create_relation_to(melp)
 
-        MM = 0.
         for idx,gas_m in enumerate(dictio._gas_fractions,start = 1):
-            MM += gas_m*self.get_gas_mass(dictio.species[idx])
             vals.append(nn.Real(self.get_gas_mass(dictio.species[idx])))
             units.append(nn.Unit("kg"))
             masses.append(nn.Mass(vals[-1],units[-1]))
             species[idx].create_relation_to(masses[-1])
 
-        prec_mass = self.get_prec_mass(dictio.species[0])
-
-        nm_prec = dictio._feedrate/(prec_mass/AMU)
-        nm_gas = 0.
-
-        nm_gases = []
-        for idx,gf in enumerate(dictio._gas_fractions,start=1):
-            val = (gf*self.get_gas_mass(dictio.species[idx])/AMU/(MM/AMU))*dictio._flowrate*dictio._dens_ref/60000.
-            nm_gases.append(val)
-            nm_gas += val
-
-        ntot = nm_prec + nm_gas
-
-        mols_n = np.true_divide([nm_prec] + nm_gases, ntot)
+        mols_n = self.mole_fractions(dictio)
         for idx,sp in enumerate(species):
             sp.get_related_objects(mols[0])[0].value = mols_n[idx]
 
@@ -336,304 +416,87 @@ class nano_engine:
         cnt.create_relation_to(species[0])
 
         # Overall end time
-        iter = 0
         try:
             self.tf
         except:
             self.tf = 7e-4
+        t_end = self.tf
 
-        # NanoDOME settings based on accuracy level
-        if dictio._acc_level == "Low":
-            if dictio._bool_stream:
-                t_end = self.tf #time_evo[-1]
-            else:
-                t_end = self.tf
-
-            dt = 1e-9
-            SAVE_EVERY = 1000
-
-            if dictio._delete_simulation_files is False:
-                lognormal_path = os.path.join(dictio._case_dir, "MOMENTS_Lognormal_plot.dat")
-                plot_data = os.path.join(dictio._case_dir, "MOMENTS_plot.dat")
-                with open(plot_data,"w") as plot:
-                    print("Time[sec]" , '\t'
-                        , "Temp[K]" , '\t'
-                        , "Nucl_Rate" , '\t'
-                        , "Species_#_density" , '\t'
-                        , "Stable_cluster_size[m]" , '\t'
-                        , "AVG_diameter[m]" , '\t'
-                        , "Agg_density[#/m3]" , '\t'
-                        ,file=plot)
-                plot.close()
-
-            part = nn.MomentModelPratsinis()
-            part.create_relation_to(species[0])
-            T_stop = 300.
-
-        elif dictio._acc_level == "Medium":
-            if dictio._bool_stream:
-                t_end = self.tf #time_evo[-1]
-            else:
-                t_end = self.tf
-
-            Df = 1.6 #based on NanoDOME D3.4
-            vol = np.power(1e-4, 3)
-
-            part = nn.PBMFractalParticlePhase(Df,vol)
-            part.create_relation_to(species[0])
-
-            SAVE_EVERY = 1500
-            PSD_DATA = 2.5e-5
-            save_step = 0.
-
-            if dictio._delete_simulation_files is False:
-                plot_data = os.path.join(dictio._case_dir, "PBM_plot.dat")
-                with open(plot_data,"w") as plot:
-                    print("Time[sec]" , '\t'
-                        , "Temp[K]" , '\t'
-                        , "Nucl_Rate" , '\t'
-                        , "Species_#_density" , '\t'
-                        , "Stable_cluster_diameter[m]" , '\t'
-                        , "AVG_Part_Num[#]: " , '\t'
-                        , "Sint_level[%]" , '\t'
-                        , "AVG_diameter[m]" , '\t'
-                        , "Agg._#[#]" , '\t'
-                        , "Agg_density[#/m3]" , '\t'
-                        , "Volume[m]" , '\t'
-                        , "AVG_fract_dim" , '\t'
-                        , "Part._mean_dim" , '\t'
-                        , "ts_exec_time" ,file=plot)
-                plot.close()
-
-                part_sizes_file = os.path.join(dictio._case_dir, "PBM_particles_sizes.dat")
-                agg_sizes_file = os.path.join(dictio._case_dir, "PBM_aggregates_sizes.dat")
-
-            clock.start()
-            T_stop = 520.
-
-        elif dictio._acc_level == "High":
-            if dictio._bool_stream:
-                t_end = self.tf #time_evo[-1]
-            else:
-                t_end = self.tf
-
-            T_melt = self.get_melting_point(dictio.species[0])
-            bliq = self.get_bulk_liquid(dictio.species[0])
-            bsol = self.get_bulk_solid(dictio.species[0])
-
-            dt = 1e-10
-            SAVE_EVERY = 5000
-            SAVE_SNAPSHOT = 1e-5
-            snap_count = 0.
-            PSD_DATA = 2.5e-5
-            save_step = 0.
-
-            V_start = 9e-18
-
-            part = nn.ConstrainedLangevinParticlePhase(V_start)
-            part.create_relation_to(species[0])
-
-            if not dictio._delete_simulation_files:
-                plot_data = os.path.join(dictio._case_dir, "CGMD_plot.dat")
-                with open(plot_data,"w") as plot:
-                    print("Time[sec]" , '\t'
-                        , "Temp[K]" , '\t'
-                        , "Nucl_Rate" , '\t'
-                        , "Species_#_density" , '\t'
-                        , "Stable_cluster_size[m]" , '\t'
-                        , "AVG_Part_Num[#]: " , '\t'
-                        , "Sint_level[%]" , '\t'
-                        , "AVG_diameter[m]" , '\t'
-                        , "Agg._#[#]" , '\t'
-                        , "Agg_density[#/m3]" , '\t'
-                        , "Volume[m]" , '\t'
-                        , "AVG_fract_dim" , '\t'
-                        , "Part._mean_dim" , '\t'
-                        , "ts_exec_time" ,file=plot)
-                plot.close()
-
-                part_sizes_file = os.path.join(dictio._case_dir, "CGMD_particles_sizes.dat")
-                agg_sizes_file = os.path.join(dictio._case_dir, "CGMD_aggregates_sizes.dat")
-
-                vtk_path = os.path.join(dictio._case_dir, "CGMD_vtk/")
-                os.mkdir(vtk_path, mode=0o777)
-
-            T_stop = 520.
-
-
-        while (t.value <= t_end):
-
-            if dictio._bool_stream:
-                dTdt.value = self.Temp_gradient(t.value,time_evo,temp_evo)
-            if T_start.value <= T_stop:
-                dTdt.value = 0.
-
-            if dictio._acc_level == "Low":
-                g_prec = part.timestep(dt)
-                gp.timestep(dt, [g_prec,0.,0.,0.,0.])
-
-                if (self.counter_trigger(iter,SAVE_EVERY)):
-
-                    if dictio._delete_simulation_files is False:
-                        # save lognormal values
-                        part.print_lognormal_val(lognormal_path)
-
-                        # save simulation data
-                        with open(plot_data,"a") as plot:
-                            print(
-                                t.value , '\t'
-                                , T_start.value , '\t'
-                                , cnt.nucleation_rate() , '\t'
-                                , gp.get_n() , '\t'
-                                , cnt.stable_cluster_diameter() , '\t'
-                                , 10*part.get_mean_diameter() , '\t'
-                                , part.get_n_density() , '\t'
-                                , file=plot)
-
-                        plot.close()
-
-            elif dictio._acc_level == "Medium":
-
-                dt = part.calc_dt()
-
-                gp.timestep(dt/2.,[0.,0.,0.,0.,0.])
-                part.volume_expansion(dt/2.)
-
-                g_prec = part.timestep(dt)
-                gp.timestep(dt,[-g_prec,0.,0.,0.,0.])
-
-                gp.timestep(dt/2.,[0.,0.,0.,0.,0.])
-                part.volume_expansion(dt/2.)
-
-                save_step += dt
-
-            elif dictio._acc_level == "High":
-
-                d_min = part.get_particles_smallest_diameter()
-
-                prec_bulk = (bsol if (T_start.value < T_melt) else bliq)
-
-                dt_max_lang = d_min * prec_bulk / gp.get_gas_flux()
-
-                dt_max_coll = np.sqrt(np.pi*prec_bulk*np.power(d_min,5) / (24*3*K_BOL*T_start.value))
-
-                if (part.get_aggregates_number() >= 1):
-                    dt = np.amin([dt_max_coll,dt_max_lang])
-                    if (dt >1e-10):
-                        dt = 1e-10
-
-                g_prec = part.timestep(dt)
-
-                gp.timestep(dt, [-g_prec,0.,0.,0.,0.])
-
-                snap_count += dt
-                save_step += dt
+        # NanoDOME stepper based on accuracy level
+        stepper = self.steppers[dictio._acc_level](self, dictio, gp, cnt,
+                                                   species[0], T_start)
 
-            # Save agglomerates and particles datas for PSD
-            # Only for Medium and High accuracy levels
-            if dictio._delete_simulation_files is False:
-                if dictio._acc_level == "Medium" or dictio._acc_level == "High":
-                    if self.counter_trigger(iter, SAVE_EVERY):
-                        clock.stop()
-
-                        # save simulation data
-                        with open(plot_data,"a") as plot:
-                            print( t.value , '\t'
-                                , T_start.value , '\t'
-                                , cnt.nucleation_rate() , '\t'
-                                , gp.get_n() , '\t'
-                                , cnt.stable_cluster_diameter() , '\t'
-                                , part.get_mean_particles_number() , '\t'
-                                , part.get_mean_sintering_level() , '\t'
-                                , 10*part.get_aggregates_mean_spherical_diameter() , '\t'
-                                , part.get_aggregates_number() , '\t'
-                                , part.get_aggregates_density() , '\t'
-                                , part.get_volume() , '\t'
-                                , part.get_mean_fractal_dimension() , '\t'
-                                , part.get_particles_mean_diameter() , '\t'
-                                , clock.interval() / float(SAVE_EVERY) , file=plot)
-
-                        plot.close()
-                        clock.start()
-
-                    # Save particles and aggregates sizes for PSD
-                    if (save_step>=PSD_DATA):
-                        clock.stop()
-
-                        particles_sizes = part.get_particles_sizes()
-                        aggregates_sizes = part.get_aggregates_sizes()
-
-                        # print particles sizes
-                        with open(part_sizes_file,"w") as psd:
-                            print(10*particles_sizes,file=psd)
-                        psd.close()
-
-                        # print aggregates sizes
-                        with open(agg_sizes_file,"w") as asd:
-                            print(10*aggregates_sizes,file=asd)
-                        asd.close()
-
-                        save_step = 0.
-                        clock.start()
-
-                    # Save VTK only for High accuracy level
-                    if dictio._acc_level == "High":
-                        if snap_count >= SAVE_SNAPSHOT and \
-                                        part.get_aggregates_number() > 0:
+        if dictio._bool_stream:
+            driver = TemperatureDriver(T_start, dTdt, stepper.T_stop,
+                                       time_evo, temp_evo)
+        else:
+            driver = TemperatureDriver(T_start, dTdt, stepper.T_stop)
 
-                            part.save_vtk(iter, vtk_path)
-                            snap_count = 0.
+        stepper.run(t, t_end, driver)
+        stepper.close()
 
-            iter += 1
-            t.value+=dt
+        return stepper.results()
 
-        # Save last computed agglomerates and particles datas for PSD
-        # Only for Medium and High accuracy levels
-        if dictio._delete_simulation_files is False:
-            if dictio._acc_level == "Medium" or dictio._acc_level == "High":
-                particles_sizes = part.get_particles_sizes()
-                aggregates_sizes = part.get_aggregates_sizes()
+    def ensemble_run(self,dictio):
+        """Low accuracy moment model run at once on all the streamlines
+        in dictio._streams. Returns one (mean diameter, number density,
+        volume percentage) tuple per streamline."""
 
-                # print particles sizes
-                with open(part_sizes_file,"w") as psd:
-                    print(particles_sizes,file=psd)
-                psd.close()
+        times = [self.stream_evo(stream,0) for stream in dictio._streams]
+        temps = [self.stream_evo(stream,1) for stream in dictio._streams]
 
-                # print aggregates sizes
-                with open(agg_sizes_file,"w") as asd:
-                    print(aggregates_sizes,file=asd)
-                asd.close()
+        histories = StreamlineBundle(times, temps, LowAccuracyStepper.T_stop)
 
+        return self._moment_run(dictio, histories, LowAccuracyStepper.SAVE_EVERY)
 
-        if dictio._acc_level == "Low":
-            mean_diam = 10*part.get_mean_diameter()
-            numb_dens = part.get_n_density()
-            vol_frac = np.pi*np.power(mean_diam, 3)*numb_dens/6.
+    def batched_run(self,dictio):
+        """Low accuracy run of the streamline or temperature gradient of
+        dictio by the vectorized moment model, batch_steps timesteps per
+        call. Returns the (mean diameter, number density, volume
+        percentage) of nano_run, within the tolerances of MomentEnsemble."""
 
-            return mean_diam*1e+9, numb_dens, vol_frac*100
+        # Overall end time
+        try:
+            self.tf
+        except:
+            self.tf = 7e-4
 
+        if dictio._bool_stream:
+            histories = StreamlineBundle([self.stream_evo(dictio._stream,0)],
+                                         [self.stream_evo(dictio._stream,1)],
+                                         LowAccuracyStepper.T_stop)
         else:
+            histories = StreamlineBundle.from_gradients(dictio._temp_start,
+                                                        dictio._temp_gradient,
+                                                        self.tf, LowAccuracyStepper.T_stop)
 
-            part_size_class, part_size_dist = self.PSD_post( \
-                                 part.get_aggregates_sizes(),part.get_volume())
-
-            prim_size_class, prim_size_dist = self.PSD_post( \
-                                 part.get_particles_sizes(),part.get_volume())
-
-            particles = []
-            primaries = []
+        return self._moment_run(dictio, histories, self.batch_steps)[0]
 
-            # Create  and fill bins then add them to the SizeDistribution CUDS
-            for parti in range(0, len(part_size_dist)):
+    def _moment_run(self, dictio, histories, check_every):
+        """Results of the MomentEnsemble of the histories, advanced
+        check_every fixed timesteps per call or adaptively with rtol"""
+        mols_n = self.mole_fractions(dictio)
 
-                particles.append([part_size_class[parti]*1e+9*10, part_size_dist[parti], \
-                                  part.get_mean_fractal_dimension()])
+        # Overall end time
+        try:
+            self.tf
+        except:
+            self.tf = 7e-4
 
-            for prim in range(0, len(prim_size_dist)):
+        ensemble = MomentEnsemble(self, dictio.species[0], dictio._pressure,
+                                  mols_n[0], histories)
+        monitor = None
+        if self.freeze_tol is not None:
+            monitor = ConvergenceMonitor(self.freeze_tol, self.freeze_window)
 
-                primaries.append([prim_size_class[prim]*1e+9*10, prim_size_dist[prim]])
+        if self.rtol is None:
+            ensemble.run(self.tf, LowAccuracyStepper.dt, monitor, check_every)
+        else:
+            ensemble.run_adaptive(self.tf, rtol=self.rtol, dt=LowAccuracyStepper.dt,
+                                  monitor=monitor)
 
-            return particles, primaries
+        return [tuple(float(value) for value in member) \
+                for member in zip(*ensemble.results())]
 
 
     def set_network(self,specs,pp,TT,cs, mass, bulk_l):
@@ -0,0 +1,568 @@
+"""
+@author: Giorgio La Civita, UNIBO DIN
+"""
+
+import numpy as np, os, time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from osp.wrappers.simnanodome.nanolib import libontodome as nn
+
+K_BOL = 1.380650524e-23 #[J/K]
+
+
+class TemperatureDriver:
+    """Updates the gas temperature derivative during a nanoDOME run.
+
+    The temperature evolution is either imposed by a CFD streamline
+    (time_evo, temp_evo) or by the constant gradient already stored in dTdt.
+    Once the temperature drops below T_stop the derivative is zeroed and,
+    being the temperature no longer able to change, the driver is frozen.
+    """
+
+    def __init__(self, T, dTdt, T_stop, time_evo=None, temp_evo=None):
+        self.T = T
+        self.dTdt = dTdt
+        self.T_stop = T_stop
+        self.time_evo = time_evo
+        self.temp_evo = temp_evo
+
+    def gradient(self, t):
+        """Temperature derivative along the streamline at time t"""
+        time_evo = self.time_evo
+        if t <= time_evo[0] or t >= time_evo[-1]:
+            return 0.
+        ii = bisect_left(time_evo, t) - 1
+        temp_evo = self.temp_evo
+        val = temp_evo[ii] + (t - time_evo[ii])*(temp_evo[ii+1]-temp_evo[ii])/(time_evo[ii+1]-time_evo[ii])
+        return (val - temp_evo[ii])/(t - time_evo[ii])
+
+    def update(self, t):
+        """Set dT/dt at time t, returns True once the temperature is frozen"""
+        if self.time_evo is not None:
+            self.dTdt.value = self.gradient(t)
+        if self.T.value <= self.T_stop:
+            self.dTdt.value = 0.
+            return True
+        return False
+
+
+class ConvergenceMonitor:
+    """Detects when the particle dynamics have frozen out.
+
+    The monitored quantities are sampled once every window seconds of
+    simulated time, the run is converged when none of them changed more
+    than tol (relative) since the previous sample.
+    """
+
+    def __init__(self, tol, window):
+        self.tol = tol
+        self.window = window
+        self.t_ref = -np.inf
+        self.ref = None
+
+    def converged(self, t, monitored):
+        """monitored is called, only when a sample is due, to get the values"""
+        if t - self.t_ref < self.window:
+            return False
+
+        values = np.asarray(monitored(), dtype=float)
+        if self.ref is not None and \
+           np.all(np.abs(values - self.ref) <= self.tol*np.abs(self.ref)):
+            return True
+
+        self.t_ref = t
+        self.ref = values
+        return False
+
+
+class MomentsOutput:
+    """Lognormal and moments history files for the Low accuracy level."""
+
+    def __init__(self, case_dir):
+        self.lognormal_path = os.path.join(case_dir, "MOMENTS_Lognormal_plot.dat")
+        self.plot_data = os.path.join(case_dir, "MOMENTS_plot.dat")
+        with open(self.plot_data,"w") as plot:
+            print("Time[sec]" , '\t'
+                , "Temp[K]" , '\t'
+                , "Nucl_Rate" , '\t'
+                , "Species_#_density" , '\t'
+                , "Stable_cluster_size[m]" , '\t'
+                , "AVG_diameter[m]" , '\t'
+                , "Agg_density[#/m3]" , '\t'
+                ,file=plot)
+
+    def save(self, stepper, t, iter):
+        part = stepper.part
+
+        # save lognormal values
+        part.print_lognormal_val(self.lognormal_path)
+
+        # save simulation data
+        with open(self.plot_data,"a") as plot:
+            print(
+                t , '\t'
+                , stepper.T.value , '\t'
+                , stepper.cnt.nucleation_rate() , '\t'
+                , stepper.gp.get_n() , '\t'
+                , stepper.cnt.stable_cluster_diameter() , '\t'
+                , 10*part.get_mean_diameter() , '\t'
+                , part.get_n_density() , '\t'
+                , file=plot)
+
+    def close(self, stepper):
+        pass
+
+
+class ParticlePhaseOutput:
+    """Simulation history and PSD files for the Medium and High accuracy levels."""
+
+    PSD_DATA = 2.5e-5
+
+    def __init__(self, case_dir, prefix, save_every):
+        self.save_every = save_every
+        self.psd_step = 0.
+
+        self.plot_data = os.path.join(case_dir, prefix + "_plot.dat")
+        with open(self.plot_data,"w") as plot:
+            print("Time[sec]" , '\t'
+                , "Temp[K]" , '\t'
+                , "Nucl_Rate" , '\t'
+                , "Species_#_density" , '\t'
+                , "Stable_cluster_diameter[m]" , '\t'
+                , "AVG_Part_Num[#]: " , '\t'
+                , "Sint_level[%]" , '\t'
+                , "AVG_diameter[m]" , '\t'
+                , "Agg._#[#]" , '\t'
+                , "Agg_density[#/m3]" , '\t'
+                , "Volume[m]" , '\t'
+                , "AVG_fract_dim" , '\t'
+                , "Part._mean_dim" , '\t'
+                , "ts_exec_time" ,file=plot)
+
+        self.part_sizes_file = os.path.join(case_dir, prefix + "_particles_sizes.dat")
+        self.agg_sizes_file = os.path.join(case_dir, prefix + "_aggregates_sizes.dat")
+
+        self.clock = time.time()
+
+    def save(self, stepper, t, iter):
+        part = stepper.part
+        interval = time.time() - self.clock
+
+        # save simulation data
+        with open(self.plot_data,"a") as plot:
+            print( t , '\t'
+                , stepper.T.value , '\t'
+                , stepper.cnt.nucleation_rate() , '\t'
+                , stepper.gp.get_n() , '\t'
+                , stepper.cnt.stable_cluster_diameter() , '\t'
+                , part.get_mean_particles_number() , '\t'
+                , part.get_mean_sintering_level() , '\t'
+                , 10*part.get_aggregates_mean_spherical_diameter() , '\t'
+                , part.get_aggregates_number() , '\t'
+                , part.get_aggregates_density() , '\t'
+                , part.get_volume() , '\t'
+                , part.get_mean_fractal_dimension() , '\t'
+                , part.get_particles_mean_diameter() , '\t'
+                , interval / float(self.save_every) , file=plot)
+
+        self.clock = time.time()
+
+    def check(self, stepper, dt, iter):
+        # Save particles and aggregates sizes for PSD
+        self.psd_step += dt
+        if self.psd_step >= self.PSD_DATA:
+            start = time.time()
+            self._save_sizes(10*stepper.part.get_particles_sizes(),
+                             10*stepper.part.get_aggregates_sizes())
+            self.psd_step = 0.
+            # Not part of the timestep execution time
+            self.clock += time.time() - start
+
+    def close(self, stepper):
+        # Save last computed agglomerates and particles datas for PSD
+        self._save_sizes(stepper.part.get_particles_sizes(),
+                         stepper.part.get_aggregates_sizes())
+
+    def _save_sizes(self, particles_sizes, aggregates_sizes):
+        # print particles sizes
+        with open(self.part_sizes_file,"w") as psd:
+            print(particles_sizes,file=psd)
+
+        # print aggregates sizes
+        with open(self.agg_sizes_file,"w") as asd:
+            print(aggregates_sizes,file=asd)
+
+
+class SnapshotOutput:
+    """VTK snapshots of the aggregates for the High accuracy level."""
+
+    SAVE_SNAPSHOT = 1e-5
+
+    def __init__(self, case_dir):
+        self.vtk_path = os.path.join(case_dir, "CGMD_vtk/")
+        os.mkdir(self.vtk_path, mode=0o777)
+        self.snap_step = 0.
+
+    def save(self, stepper, t, iter):
+        pass
+
+    def check(self, stepper, dt, iter):
+        self.snap_step += dt
+        if self.snap_step >= self.SAVE_SNAPSHOT and \
+                        stepper.part.get_aggregates_number() > 0:
+            stepper.part.save_vtk(iter, self.vtk_path)
+            self.snap_step = 0.
+
+    def close(self, stepper):
+        pass
+
+
+class Stepper(ABC):
+    """Base class of the nanoDOME accuracy level steppers.
+
+    A stepper owns the particle phase model of its accuracy level and
+    advances it, together with the gas phase, with a specialized loop.
+    Outputs are objects exposing save(stepper, t, iter) and close(stepper),
+    save is called every SAVE_EVERY iterations only. Outputs written on
+    their own schedule (PSD, snapshots) also expose check(stepper, dt, iter),
+    called every iteration with its timestep.
+    When eng.freeze_tol is set the convergence monitor is checked every
+    SAVE_EVERY iterations too, whatever the temperature: the run stops early
+    once the monitored() quantities, the temperature among them, stopped
+    changing, e.g. on streamlines ending above T_stop.
+    """
+
+    T_stop = 520.
+    SAVE_EVERY = 1000
+
+    def __init__(self, eng, dictio, gp, cnt, precursor, T):
+        self.eng = eng
+        self.gp = gp
+        self.cnt = cnt
+        self.T = T
+
+        self.part = self.create_particle_phase(dictio)
+        self.part.create_relation_to(precursor)
+
+        self.outputs = []
+        if not dictio._delete_simulation_files:
+            self.outputs = self.create_outputs(dictio._case_dir)
+        self.checks = [out.check for out in self.outputs if hasattr(out, "check")]
+
+        self.monitor = None
+        if eng.freeze_tol is not None:
+            self.monitor = ConvergenceMonitor(eng.freeze_tol, eng.freeze_window)
+
+    @abstractmethod
+    def create_particle_phase(self, dictio):
+        pass
+
+    def create_outputs(self, case_dir):
+        return []
+
+    @abstractmethod
+    def run(self, t, t_end, driver):
+        """Advance the particle and gas phases from t.value to t_end"""
+
+    @abstractmethod
+    def monitored(self):
+        """Quantities checked by the convergence monitor, the temperature
+        first so that a cooling gas is never converged"""
+
+    def converged(self, now, iter):
+        return self.monitor is not None and iter % self.SAVE_EVERY == 0 and \
+               self.monitor.converged(now, self.monitored)
+
+    def close(self):
+        for out in self.outputs:
+            out.close(self)
+
+    @abstractmethod
+    def results(self):
+        pass
+
+
+class LowAccuracyStepper(Stepper):
+    """Moment model (Pratsinis) with a fixed timestep, or an adaptive one
+    with the engine rtol set (see run_adaptive)."""
+
+    T_stop = 300.
+    SAVE_EVERY = 1000
+    dt = 1e-9
+
+    # Longest adaptive timestep [s]
+    dt_max = 1e-6
+    # Particles nucleated per step below which the step is quiet [#/m3]
+    N_MIN = 1.
+
+    def create_particle_phase(self, dictio):
+        return nn.MomentModelPratsinis()
+
+    def create_outputs(self, case_dir):
+        return [MomentsOutput(case_dir)]
+
+    def run(self, t, t_end, driver):
+        if self.eng.rtol is not None:
+            return self.run_adaptive(t, t_end, driver, self.eng.rtol)
+
+        part_timestep = self.part.timestep
+        gp_timestep = self.gp.timestep
+        outputs = self.outputs
+        save_every = self.SAVE_EVERY
+        dt = self.dt
+
+        iter = 0
+        now = t.value
+        frozen = False
+        while (now <= t_end):
+
+            if not frozen:
+                frozen = driver.update(now)
+
+            g_prec = part_timestep(dt)
+            gp_timestep(dt, [g_prec,0.,0.,0.,0.])
+
+            if outputs and iter % save_every == 0:
+                for out in outputs:
+                    out.save(self, now, iter)
+
+            iter += 1
+            now += dt
+            t.value = now
+
+            if self.converged(now, iter):
+                break
+
+    def run_adaptive(self, t, t_end, driver, rtol):
+        """As run, with the timestep doubled up to dt_max over the quiet parts
+        of the history and back to dt as soon as something happens.
+
+        The engine cannot rewind a step, so the next one is chosen from the
+        last one: a step is quiet when it nucleated less than rtol times the
+        number density (at least N_MIN) and changed the number density and
+        the mean diameter by less than rtol/2. The temperature change over a
+        step is kept below rtol/2 too. This skips the hot part before the
+        nucleation and the cold tail after the growth, at rtol=1e-3 the
+        results stay within 1e-2 of the fixed timestep ones, as
+        test_nano_run_system_low_adaptive checks. The timesteps taken are
+        counted in self.steps.
+        """
+        part = self.part
+        part_timestep = part.timestep
+        gp_timestep = self.gp.timestep
+        nucleation_rate = self.cnt.nucleation_rate
+        T = self.T
+        dTdt = driver.dTdt
+        outputs = self.outputs
+        save_every = self.SAVE_EVERY
+        dt = dt0 = self.dt
+        dt_max = self.dt_max
+        n_min = self.N_MIN
+
+        state = (part.get_n_density(), part.get_mean_diameter())
+        iter = 0
+        now = t.value
+        frozen = False
+        while (now <= t_end):
+
+            if not frozen:
+                frozen = driver.update(now)
+
+            g_prec = part_timestep(dt)
+            gp_timestep(dt, [g_prec,0.,0.,0.,0.])
+
+            if outputs and iter % save_every == 0:
+                for out in outputs:
+                    out.save(self, now, iter)
+
+            iter += 1
+            now += dt
+            t.value = now
+
+            if self.converged(now, iter):
+                break
+
+            new = (part.get_n_density(), part.get_mean_diameter())
+            quiet = nucleation_rate()*dt <= rtol*max(new[0], n_min) and \
+                    all(abs(b - a) <= rtol/2*max(abs(a), abs(b))
+                        for a, b in zip(state, new))
+            state = new
+
+            if quiet:
+                dt = min(2*dt, dt_max)
+                if dTdt.value != 0.:
+                    dt = max(min(dt, rtol/2*T.value/abs(dTdt.value)), dt0)
+            else:
+                dt = dt0
+
+        self.steps = iter
+
+    def monitored(self):
+        return self.T.value, self.part.get_n_density(), self.part.get_mean_diameter()
+
+    def results(self):
+        mean_diam = 10*self.part.get_mean_diameter()
+        numb_dens = self.part.get_n_density()
+        vol_frac = np.pi*np.power(mean_diam, 3)*numb_dens/6.
+
+        return mean_diam*1e+9, numb_dens, vol_frac*100
+
+
+class ParticlePhaseStepper(Stepper):
+    """Common results post-processing of the Medium and High accuracy levels."""
+
+    def monitored(self):
+        part = self.part
+        return self.T.value, part.get_aggregates_density(), \
+               part.get_aggregates_mean_spherical_diameter(), \
+               part.get_particles_mean_diameter()
+
+    def results(self):
+        part = self.part
+
+        part_size_class, part_size_dist = self.eng.PSD_post( \
+                             part.get_aggregates_sizes(),part.get_volume())
+
+        prim_size_class, prim_size_dist = self.eng.PSD_post( \
+                             part.get_particles_sizes(),part.get_volume())
+
+        particles = []
+        primaries = []
+
+        for parti in range(0, len(part_size_dist)):
+
+            particles.append([part_size_class[parti]*1e+9*10, part_size_dist[parti], \
+                              part.get_mean_fractal_dimension()])
+
+        for prim in range(0, len(prim_size_dist)):
+
+            primaries.append([prim_size_class[prim]*1e+9*10, prim_size_dist[prim]])
+
+        return particles, primaries
+
+
+class MediumAccuracyStepper(ParticlePhaseStepper):
+    """Population balance model with fractal aggregates."""
+
+    SAVE_EVERY = 1500
+    Df = 1.6 #based on NanoDOME D3.4
+    vol = np.power(1e-4, 3)
+
+    def create_particle_phase(self, dictio):
+        return nn.PBMFractalParticlePhase(self.Df,self.vol)
+
+    def create_outputs(self, case_dir):
+        return [ParticlePhaseOutput(case_dir, "PBM", self.SAVE_EVERY)]
+
+    def run(self, t, t_end, driver):
+        part = self.part
+        gp_timestep = self.gp.timestep
+        outputs = self.outputs
+        save_every = self.SAVE_EVERY
+        checks = self.checks
+
+        iter = 0
+        now = t.value
+        frozen = False
+        while (now <= t_end):
+
+            if not frozen:
+                frozen = driver.update(now)
+
+            dt = part.calc_dt()
+
+            gp_timestep(dt/2.,[0.,0.,0.,0.,0.])
+            part.volume_expansion(dt/2.)
+
+            g_prec = part.timestep(dt)
+            gp_timestep(dt,[-g_prec,0.,0.,0.,0.])
+
+            gp_timestep(dt/2.,[0.,0.,0.,0.,0.])
+            part.volume_expansion(dt/2.)
+
+            if outputs and iter % save_every == 0:
+                for out in outputs:
+                    out.save(self, now, iter)
+            for check in checks:
+                check(self, dt, iter)
+
+            iter += 1
+            now += dt
+            t.value = now
+
+            if self.converged(now, iter):
+                break
+
+
+class HighAccuracyStepper(ParticlePhaseStepper):
+    """Constrained Langevin dynamics of the aggregates (CGMD)."""
+
+    SAVE_EVERY = 5000
+    dt = 1e-10
+    V_start = 9e-18
+
+    def create_particle_phase(self, dictio):
+        self.T_melt = self.eng.get_melting_point(dictio.species[0])
+        self.bliq = self.eng.get_bulk_liquid(dictio.species[0])
+        self.bsol = self.eng.get_bulk_solid(dictio.species[0])
+        return nn.ConstrainedLangevinParticlePhase(self.V_start)
+
+    def create_outputs(self, case_dir):
+        return [ParticlePhaseOutput(case_dir, "CGMD", self.SAVE_EVERY),
+                SnapshotOutput(case_dir)]
+
+    def run(self, t, t_end, driver):
+        part = self.part
+        gp = self.gp
+        T = self.T
+        T_melt, bliq, bsol = self.T_melt, self.bliq, self.bsol
+        outputs = self.outputs
+        save_every = self.SAVE_EVERY
+        checks = self.checks
+        dt = self.dt
+
+        iter = 0
+        now = t.value
+        frozen = False
+        while (now <= t_end):
+
+            if not frozen:
+                frozen = driver.update(now)
+
+            d_min = part.get_particles_smallest_diameter()
+
+            prec_bulk = (bsol if (T.value < T_melt) else bliq)
+
+            dt_max_lang = d_min * prec_bulk / gp.get_gas_flux()
+
+            dt_max_coll = np.sqrt(np.pi*prec_bulk*np.power(d_min,5) / (24*3*K_BOL*T.value))
+
+            if (part.get_aggregates_number() >= 1):
+                dt = min(dt_max_coll,dt_max_lang)
+                if (dt >1e-10):
+                    dt = 1e-10
+
+            g_prec = part.timestep(dt)
+
+            gp.timestep(dt, [-g_prec,0.,0.,0.,0.])
+
+            if outputs and iter % save_every == 0:
+                for out in outputs:
+                    out.save(self, now, iter)
+            for check in checks:
+                check(self, dt, iter)
+
+            iter += 1
+            now += dt
+            t.value = now
+
+            if self.converged(now, iter):
+                break
+
+
+# Steppers available for each accuracy level
+STEPPERS = {
+    "Low": LowAccuracyStepper,
+    "Medium": MediumAccuracyStepper,
+    "High": HighAccuracyStepper,
+    }
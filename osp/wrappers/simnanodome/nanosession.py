@@ -2,12 +2,15 @@
 @author: Giorgio La Civita, UNIBO DIN
 """
 
-import os
-from distutils import dir_util
+import os, hashlib
+import numpy as np
 
 from osp.core.session import SimWrapperSession
 from osp.core.namespaces import nanofoam as onto
+from osp.wrappers.workspace import DEFAULT_WORKSPACE
 from .nano_engine import nano_engine as eng
+from .moment_ensemble import MomentEnsemble
+from .result_cache import ResultCache, engine_version
 
 class NanoDOMESession(SimWrapperSession):
     """
@@ -15,10 +18,25 @@ class NanoDOMESession(SimWrapperSession):
     """
 
     def __init__(self, engine="nanodome", case="nanodome",
-    delete_simulation_files=True, **kwargs):
+    delete_simulation_files=True, ensemble=False, workspace=None,
+    result_cache=None, cache_size=None, **kwargs):
         super().__init__(engine, **kwargs)
         # Whether or not to store the generated files by the simulation engine
         self._delete_simulation_files = delete_simulation_files
+        # Whether or not to run the Low accuracy model on all the
+        # streamlines at once, one result Bin per streamline
+        self._ensemble = ensemble
+        # Workspace placing and removing the case directory, see Workspace
+        self._workspace = workspace or DEFAULT_WORKSPACE
+        # In memory streamlines {path: array}, e.g. CFDSession.stream_data,
+        # and plasma tables {file name: array}, e.g. the elen_run results,
+        # replacing the files of the TemperatureStreamline and Plasma CUDS
+        self.stream_data = {}
+        self.plasma_data = {}
+        # Directory of the results of previous runs with identical inputs,
+        # None to disable, and its size limit in bytes
+        self._result_cache = ResultCache(result_cache, cache_size) \
+                             if result_cache else None
 
         # Engine specific initializations
         self._initialized = False
@@ -31,10 +49,7 @@ class NanoDOMESession(SimWrapperSession):
     def close(self):
         """Invoked, when the session is being closed"""
         if self._delete_simulation_files and self._case_dir:
-            try:
-                dir_util.remove_tree(self._case_dir)
-            except:
-                pass
+            self._workspace.release(self._case_dir)
         # Close the running instance of the nanoDOME
         if self._initialized:
             self._initialized = False
@@ -87,11 +102,10 @@ class NanoDOMESession(SimWrapperSession):
 
     def _initialize(self, root_cuds_object, buffer):
 
-        self._case_dir = os.path.join(os.getcwd(),
-                                "nanodome-%s" % root_cuds_object.uid)
-
         if not self._delete_simulation_files:
-            os.mkdir(self._case_dir, mode=0o777)
+            self._case_dir = self._workspace.create("nanodome-%s" % root_cuds_object.uid)
+        else:
+            self._case_dir = self._workspace.path("nanodome-%s" % root_cuds_object.uid)
 
         # Get the base CUDS
         self._source = root_cuds_object.get(oclass=onto.PlasmaSource)[0]
@@ -133,14 +147,24 @@ class NanoDOMESession(SimWrapperSession):
 
                 self._flowrate = self._get_property(self._source,["Flow Rate"])
 
-                self._stream = self._get_property(self._reactor.get(oclass= \
+                if self._ensemble and self._acc_level == "Low":
+                    self._stream_objs = self._reactor.get(oclass= \
+                                 onto.ThermoCond)[0].get(oclass=onto.TemperatureStreamline)
+                    self._streams = [self.stream_data.get(ts.path, ts.path) \
+                                     for ts in self._stream_objs]
+                else:
+                    self._stream = self._get_property(self._reactor.get(oclass= \
                                  onto.ThermoCond)[0],[str(root_cuds_object.uid)])
+                    self._stream = self.stream_data.get(self._stream, self._stream)
 
-                plasma = self._source.get(oclass=onto.Plasma)[0]
-                dens_file = self._get_property(plasma,["Reference density"])
-                with open(dens_file,"r") as file:
-                    for line in file:
-                        self._dens_ref = float(line.split()[1])
+                if "densRef" in self.plasma_data:
+                    self._dens_ref = float(np.atleast_2d(self.plasma_data["densRef"])[-1,1])
+                else:
+                    plasma = self._source.get(oclass=onto.Plasma)[0]
+                    dens_file = self._get_property(plasma,["Reference density"])
+                    with open(dens_file,"r") as file:
+                        for line in file:
+                            self._dens_ref = float(line.split()[1])
 
             else:
                 self._bool_stream = False
@@ -298,9 +322,32 @@ class NanoDOMESession(SimWrapperSession):
                 raise ValueError("Distributions can be named Particles or Primaries. \
                                  Please check the name attribute of your CUDS")
 
-        if self._acc_level == "Low":
+        if self._ensemble and self._bool_stream and self._acc_level == "Low":
+
+            results = self._cached_run(self.eng.ensemble_run)
+
+            # One Bin per streamline, tagged with a copy of its streamline
+            for ts, (mean_diam, numb_dens, vol_frac) in zip(self._stream_objs, results):
+                mean_prim_size = onto.ParticleDiameter(
+                    value=mean_diam, unit='nm', name='Mean particles diameter')
+                prim_numb_dens = onto.ParticleNumberDensity(
+                    value=numb_dens, unit='#/m3', name='Mean particles number density')
+                prim_vol_perc = onto.ParticleVolumePercentage(
+                    value=vol_frac, unit='m3/m3', name='Mean particles volume percentage')
+                stream = onto.TemperatureStreamline(path=ts.path, name=ts.name, unit='K')
+                # Inlet area fraction of the streamline, to weight its Bin
+                for weight in ts.get(rel=onto.hasProperty, oclass=onto.PhysicalQuantity):
+                    stream.add(onto.PhysicalQuantity(value=weight.value, unit=weight.unit,
+                                                     name=weight.name), rel=onto.hasProperty)
+                # Approximate results of the vectorized moment model
+                result = onto.Bin(name=MomentEnsemble.BIN_NAME)
+                result.add(mean_prim_size, prim_numb_dens, prim_vol_perc, stream,
+                            rel=onto.hasProperty)
+                self._part_res.add(result, rel=onto.hasPart)
+
+        elif self._acc_level == "Low":
 
-            mean_diam, numb_dens, vol_frac = self.eng.nano_run(self)
+            mean_diam, numb_dens, vol_frac = self._cached_run(self.eng.nano_run)
 
             mean_prim_size = onto.ParticleDiameter(
                 value=mean_diam, unit='nm', name='Mean particles diameter')
@@ -308,14 +355,16 @@ class NanoDOMESession(SimWrapperSession):
                 value=numb_dens, unit='#/m3', name='Mean particles number density')
             prim_vol_perc = onto.ParticleVolumePercentage(
                 value=vol_frac, unit='m3/m3', name='Mean particles volume percentage')
-            result = onto.Bin(name="PSD bin")
+            # Batched runs come from the vectorized moment model
+            result = onto.Bin(name=MomentEnsemble.BIN_NAME if self.eng.batch_steps \
+                              else "PSD bin")
             result.add(mean_prim_size, prim_numb_dens, prim_vol_perc,
                         rel=onto.hasProperty)
             self._part_res.add(result, rel=onto.hasPart)
 
         else:
 
-            particles, primaries = self.eng.nano_run(self)
+            particles, primaries = self._cached_run(self.eng.nano_run)
 
             # Create  and fill bins then add them to the SizeDistribution CUDS
             for parti in range(0, len(particles)):
@@ -343,6 +392,53 @@ class NanoDOMESession(SimWrapperSession):
                 self._prim_res.add(result, rel=onto.hasPart)
 
 
+    def _cached_run(self, run):
+        """Result of run(self), from the result cache if enabled"""
+        if self._result_cache is None:
+            return run(self)
+
+        key = self._result_cache.key(self._run_inputs(run.__name__))
+        result = self._result_cache.get(key)
+        if result is None:
+            result = run(self)
+            self._result_cache.put(key, result)
+        return result
+
+    def _run_inputs(self, run_name):
+        """Canonical description of the inputs of a streamline or
+        temperature gradient run"""
+        stepper = self.eng.steppers[self._acc_level]
+        settings = dict()
+        for cls in reversed(stepper.__mro__):
+            settings.update({name: value for name, value in vars(cls).items() \
+                             if isinstance(value, (int, float, str)) and not name.startswith("_")})
+        for name in ("batch_steps", "rtol", "freeze_tol", "freeze_window"):
+            settings[name] = getattr(self.eng, name)
+        settings["tf"] = getattr(self.eng, "tf", 7e-4)
+
+        inputs = {"engine": engine_version(), "run": run_name,
+                  "stepper": stepper.__name__, "settings": settings,
+                  "accuracy": self._acc_level, "species": self.species,
+                  "gas_fractions": [float(gf) for gf in self._gas_fractions],
+                  "feedrate": float(self._feedrate), "flowrate": float(self._flowrate),
+                  "pressure": float(self._pressure), "dens_ref": float(self._dens_ref)}
+
+        if self._bool_stream:
+            streams = self._streams if run_name == "ensemble_run" else [self._stream]
+            inputs["streams"] = [self._stream_hash(stream) for stream in streams]
+        else:
+            inputs["temperature"] = float(self._temp_start)
+            inputs["gradient"] = float(self._temp_gradient)
+        return inputs
+
+    @staticmethod
+    def _stream_hash(stream):
+        """Content hash of an in memory or file streamline"""
+        if isinstance(stream, np.ndarray):
+            return hashlib.sha256(np.ascontiguousarray(stream, dtype=float).tobytes()).hexdigest()
+        with open(stream, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
     def _nano_coupled_run(self,root_cuds_object):
 
         pp = []
@@ -0,0 +1,93 @@
+"""
+@author: Giorgio La Civita, UNIBO DIN
+"""
+
+import os, json, hashlib, tempfile, functools
+import numpy as np
+
+
+@functools.lru_cache(maxsize=None)
+def engine_version():
+    """Hash of the nanoDOME engine sources, any change invalidates the
+    cached results"""
+    from osp.wrappers.simnanodome import nano_engine, nano_steppers, moment_ensemble
+    from osp.wrappers.simnanodome.nanolib import libontodome
+
+    version = hashlib.sha256()
+    for module in (nano_engine, nano_steppers, moment_ensemble, libontodome):
+        path = getattr(module, "__file__", None)
+        if path and os.path.isfile(path):
+            with open(path, "rb") as file:
+                version.update(file.read())
+    return version.hexdigest()
+
+
+class ResultCache:
+    """Persistent cache of nanoDOME results, one JSON file per input hash.
+
+    Keys are the SHA-256 of the canonical JSON of the run inputs, see key().
+    Hits refresh the modification time of their entry, and once the entries
+    exceed max_size bytes the least recently used ones are evicted.
+    The directory can be shared by concurrent sessions.
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(inputs):
+        """Hash of a JSON serializable dictionary of the inputs"""
+        text = json.dumps(inputs, sort_keys=True, default=ResultCache._plain)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key):
+        """Stored result, None if missing"""
+        path = os.path.join(self.directory, key + ".json")
+        try:
+            with open(path, "r") as file:
+                result = json.load(file)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def put(self, key, result):
+        """Store a result, entries appear atomically"""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(result, file, default=self._plain)
+        os.replace(tmp, os.path.join(self.directory, key + ".json"))
+
+        if self.max_size is not None:
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+    @staticmethod
+    def _plain(value):
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError("%s is not JSON serializable" % type(value).__name__)
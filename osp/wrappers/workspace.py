@@ -0,0 +1,164 @@
+"""
+@author: Giorgio La Civita, UNIBO DIN
+"""
+
+import os, shutil, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Workspace:
+    """Places, recycles and removes the case directories of the sessions.
+
+    The case directories are created in root, the current working directory
+    by default, e.g. a local scratch or a tmpfs mount for large batches.
+    Released directories are renamed at once, so their name can be reused,
+    and removed by a background thread if asynchronous. Up to pool of them
+    are emptied instead of removed and handed out again by create(). With a
+    quota [bytes] create() waits for the pending removals and raises an
+    OSError if the case directories in use still exceed it. Their size is
+    measured again at most every quota_interval seconds, in between create()
+    checks the sizes last measured.
+    A Workspace can be shared by any number of sessions.
+    """
+
+    def __init__(self, root=None, asynchronous=False, pool=0, quota=None,
+                 quota_interval=10.):
+        self.root = root
+        if root and not os.path.exists(root):
+            os.makedirs(root)
+        self.quota = quota
+        self.quota_interval = quota_interval
+        self.pool = pool
+
+        self._lock = threading.Lock()
+        self._in_use = set()
+        self._free = []
+        self._pending = []
+        # Size of the case directories in use when last measured [bytes]
+        self._sizes = dict()
+        self._measured = None
+        self._cleaner = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+
+    def path(self, name):
+        """Path of the case directory name, without creating it"""
+        return os.path.join(self.root or os.getcwd(), name)
+
+    def create(self, name):
+        """Create the empty case directory name and return its path"""
+        path = self.path(name)
+        if self.quota is not None:
+            self._check_quota()
+
+        with self._lock:
+            free = self._free.pop() if self._free else None
+            self._in_use.add(path)
+            self._sizes[path] = 0
+        if free is not None:
+            try:
+                os.rename(free, path)
+                return path
+            except OSError:
+                # e.g. a pooled directory on another filesystem
+                shutil.rmtree(free, ignore_errors=True)
+        os.mkdir(path, mode=0o777)
+        return path
+
+    def release(self, path):
+        """Remove the case directory at path, if any"""
+        with self._lock:
+            self._in_use.discard(path)
+            self._sizes.pop(path, None)
+        if not path or not os.path.isdir(path):
+            return
+
+        # Renamed next to the original to stay on the same filesystem
+        trash = os.path.join(os.path.dirname(path), ".trash-%s" % uuid.uuid4().hex)
+        os.rename(path, trash)
+
+        if self._cleaner is None:
+            self._recycle(trash)
+        else:
+            with self._lock:
+                self._pending = [job for job in self._pending if not job.done()]
+                self._pending.append(self._cleaner.submit(self._recycle, trash))
+
+    def flush(self):
+        """Wait for the pending removals"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for job in pending:
+            job.result()
+
+    def usage(self):
+        """Size of the case directories in use [bytes]"""
+        with self._lock:
+            paths = list(self._in_use)
+        return sum(self._size(path) for path in paths)
+
+    def close(self):
+        """Complete the removals and delete the pooled directories"""
+        self.flush()
+        with self._lock:
+            free, self._free = self._free, []
+        for path in free:
+            shutil.rmtree(path, ignore_errors=True)
+        if self._cleaner is not None:
+            self._cleaner.shutdown()
+
+    def _recycle(self, trash):
+        with self._lock:
+            keep = len(self._free) < self.pool
+        if not keep:
+            shutil.rmtree(trash, ignore_errors=True)
+            return
+
+        for entry in os.scandir(trash):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+        with self._lock:
+            self._free.append(trash)
+
+    def _check_quota(self):
+        now = time.monotonic()
+        if self._measured is None or now - self._measured >= self.quota_interval:
+            self._measure()
+        with self._lock:
+            usage = sum(self._sizes.values())
+        if usage <= self.quota:
+            return
+        self.flush()
+        usage = self._measure()
+        if usage > self.quota:
+            raise OSError("Workspace quota exceeded: %d of %d bytes in use"
+                          % (usage, self.quota))
+
+    def _measure(self):
+        """Measure the case directories in use, return their total size"""
+        with self._lock:
+            paths = list(self._in_use)
+        sizes = {path: self._size(path) for path in paths}
+        with self._lock:
+            # Only the directories still in use
+            for path, size in sizes.items():
+                if path in self._sizes:
+                    self._sizes[path] = size
+            self._measured = time.monotonic()
+            return sum(self._sizes.values())
+
+    @staticmethod
+    def _size(path):
+        size = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return size
+
+
+# Workspace of the sessions created without one: case directories in the
+# current working directory, removed on close
+DEFAULT_WORKSPACE = Workspace()
@@ -1,6 +1,8 @@
 """Unit test examples, both at the "system" level and the "method" level."""
 
-import unittest, os, filecmp, shutil
+import unittest, unittest.mock, os, re, filecmp, shutil, threading, hashlib
+from concurrent.futures import CancelledError
+from types import SimpleNamespace
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -10,6 +12,10 @@ from osp.core.cuds import Cuds
 from osp.core.namespaces import nanofoam as onto
 
 from osp.wrappers.simcfd.cfdsession import CFDSession
+from osp.wrappers.simcfd import dockersession
+from osp.wrappers.simcfd.dockersession import ForceDockerSession, CudsFinder
+from osp.wrappers.simcfd.residuals import ResidualMonitor
+from osp.wrappers.simcfd.templates import Template, load_template
 
 
 class TestCFDSession(unittest.TestCase):
@@ -78,6 +84,33 @@ class TestCFDSession(unittest.TestCase):
             os.remove(os.path.dirname(os.path.realpath(__file__))+"/res")
 
 
+    def test_write_properties(self):
+        """Tests the `_write_properties` method from file and from memory."""
+        with CFDSession(delete_simulation_files=True) as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+
+            os.makedirs(os.path.dirname(os.path.realpath(__file__))+"/tmp/constant")
+            session._case_dir = os.path.dirname(os.path.realpath(__file__))+"/tmp"
+
+            plasma = onto.Plasma()
+            plasma.add(onto.PlasmaProperty(path=os.path.dirname(os.path.realpath(__file__))+"/data/entropy",
+                                           name='Specific entropy', unit='J/kg/K'))
+            wrapper.add(plasma)
+
+            session._write_properties(plasma)
+            self.assertTrue(filecmp.cmp(os.path.dirname(os.path.realpath(__file__))+"/validation/dSdT",
+                                        session._case_dir+"/constant/dSdT"))
+            with open(session._case_dir+"/constant/S","r") as file:
+                from_file = file.read()
+
+            session.plasma_data["entropy"] = np.loadtxt(os.path.dirname(os.path.realpath(__file__))+"/data/entropy",
+                                                        delimiter=",")
+            session._write_properties(plasma)
+            self.assertTrue(filecmp.cmp(os.path.dirname(os.path.realpath(__file__))+"/validation/dSdT",
+                                        session._case_dir+"/constant/dSdT"))
+            with open(session._case_dir+"/constant/S","r") as file:
+                self.assertEqual(from_file, file.read())
+
     def test_create_launcher(self):
         """Tests the `_create_launcher` method."""
         with CFDSession(delete_simulation_files=True) as session:
@@ -144,6 +177,65 @@ class TestCFDSession(unittest.TestCase):
                                 os.path.dirname(os.path.realpath(__file__))+"/validation/"+"streamline_"+str(idx)+".csv"))
 
 
+    def test_create_stream_files_pool(self):
+        """Tests the `_create_stream_files` method on a process pool."""
+        received, threads = [], threading.active_count()
+
+        def on_stream(path, data):
+            # The threads of the pool are joined
+            self.assertEqual(threads, threading.active_count())
+            received.append(path)
+
+        with CFDSession(delete_simulation_files=True, stream_workers=2,
+                        on_stream=on_stream) as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+
+            os.makedirs(os.path.dirname(os.path.realpath(__file__))+"/tmp")
+            session._case_dir = os.path.dirname(os.path.realpath(__file__))+"/tmp"
+            session.POOL_MIN_TRACKS = 1
+            session._seeds_weights = np.array([0.1, 0.15, 0.2, 0.25, 0.3])
+
+            paths = session._create_stream_files(os.path.dirname(os.path.realpath(__file__))+"/data/",session._case_dir)
+            self.assertListEqual(paths, received)
+            # Weight of the seed of each streamline
+            self.assertListEqual([0.1, 0.15, 0.2, 0.25, 0.3],
+                                 [session.stream_weights[path] for path in paths])
+
+            for idx in range(1,6):
+                self.assertEqual(session._case_dir+"/streamline_"+str(idx)+".csv", paths[idx-1])
+                self.assertTrue(filecmp.cmp(paths[idx-1],
+                                os.path.dirname(os.path.realpath(__file__))+"/validation/"+"streamline_"+str(idx)+".csv"))
+
+    def test_create_stream_files_npy(self):
+        """Tests the `_create_stream_files` method with binary output."""
+        with CFDSession(delete_simulation_files=True, stream_format="npy") as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+
+            os.makedirs(os.path.dirname(os.path.realpath(__file__))+"/tmp")
+            session._case_dir = os.path.dirname(os.path.realpath(__file__))+"/tmp"
+
+            paths = session._create_stream_files(os.path.dirname(os.path.realpath(__file__))+"/data/",session._case_dir)
+
+            self.assertEqual(5, len(paths))
+            for path in paths:
+                streamline = np.load(path)
+                self.assertEqual(2, streamline.shape[1])
+                self.assertEqual(0., streamline[0,0])
+                self.assertTrue(np.all(np.diff(streamline[:,0]) > 0.))
+                # Same data kept in memory
+                np.testing.assert_array_equal(streamline, session.stream_data[path])
+
+    def test_time_of_flight(self):
+        """Tests the `_time_of_flight` method."""
+        # distance [m], Ux, Uy, Uz [m/s]
+        Udat = np.array([[0., 1., 0., 0.],
+                         [1., 3., 0., 0.],
+                         [2., 0., 0., 0.],
+                         [2., 0., 0., 0.],
+                         [3., 0., 4., 0.]])
+        tof = CFDSession._time_of_flight(Udat)
+        np.testing.assert_allclose([0., 0.5, 0.5 + 2/3., 0.5 + 2/3., 0.5 + 2/3. + 0.5], tof)
+
     def test_create_stream_sets(self):
         """Tests the `_create_stream_sets` method."""
         with CFDSession(delete_simulation_files=True) as session:
@@ -160,6 +252,199 @@ class TestCFDSession(unittest.TestCase):
             self.assertTrue(filecmp.cmp(os.path.dirname(os.path.realpath(__file__))+"/validation/streamSets",
                                             session._case_dir+"/system/streamSets"))
 
+    def test_decomposition(self):
+        """Tests the `_decomposition` method."""
+        with CFDSession(delete_simulation_files=True) as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+
+            session._mesh_cells = 1000
+            session._zcells = 100
+            self.assertTupleEqual((1, "simple"), session._decomposition())
+
+            session._nprocs = 4
+            self.assertTupleEqual((4, "simple"), session._decomposition())
+
+            session._nprocs = 64
+            self.assertTupleEqual((64, "scotch"), session._decomposition())
+
+    def test_mesh_cache(self):
+        """Tests the `_store_mesh` and `_restore_mesh` methods."""
+        base = os.path.dirname(os.path.realpath(__file__))+"/tmp"
+        with CFDSession(delete_simulation_files=True, mesh_cache=base+"/cache") as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+
+            for case in ["/case1", "/case2"]:
+                os.makedirs(base+case+"/system")
+                os.makedirs(base+case+"/constant")
+                shutil.copyfile(os.path.dirname(os.path.realpath(__file__))+"/validation/blockMeshDict",
+                                base+case+"/system/blockMeshDict")
+            os.makedirs(base+"/case1/constant/polyMesh")
+            with open(base+"/case1/constant/polyMesh/points","w") as points:
+                points.write("()")
+
+            session._case_dir = base+"/case1"
+            mesh_key = session._mesh_key(0)
+            self.assertFalse(session._restore_mesh(mesh_key))
+            session._store_mesh(mesh_key)
+
+            session._case_dir = base+"/case2"
+            self.assertEqual(mesh_key, session._mesh_key(0))
+            self.assertTrue(session._restore_mesh(mesh_key))
+            self.assertTrue(filecmp.cmp(base+"/case1/constant/polyMesh/points",
+                                        base+"/case2/constant/polyMesh/points"))
+
+        shutil.rmtree(base)
+
+    def test_warm_start(self):
+        """Tests the `_store_fields`, `_closest_case` and `_evict_fields` methods."""
+        base = os.path.dirname(os.path.realpath(__file__))+"/tmp"
+        with CFDSession(delete_simulation_files=True, warm_start=base+"/fields",
+                        warm_start_cases=2) as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+            session._par_switch = 0
+
+            entries = []
+            for idx, power in enumerate([10000., 20000., 10000., 30000.]):
+                session._case_dir = base+"/case"+str(idx)
+                for folder in ["/system", "/constant/polyMesh", "/0", "/2500"]:
+                    os.makedirs(session._case_dir+folder)
+                shutil.copyfile(os.path.dirname(os.path.realpath(__file__))+"/validation/p",
+                                session._case_dir+"/2500/p")
+                session._point = np.array([0.3, 1.5, 13e-3, 101325., power, 60., 1., 0., 0., 0.])
+                session._store_fields()
+                entries.append(base+"/fields/"+hashlib.sha256(session._point.tobytes()).hexdigest())
+                os.utime(entries[-1], (idx, idx))
+
+                if idx == 1:
+                    # Same operating point, same entry
+                    session._point = np.array([0.3, 1.5, 13e-3, 101325., 18000., 60., 1., 0., 0., 0.])
+                    self.assertEqual(entries[1], session._closest_case())
+                    self.assertTrue(os.path.isfile(entries[1]+"/2500/p"))
+                    self.assertEqual(2, len(session._warm_points))
+
+            # The least recently used entry is evicted above 2 cases
+            self.assertEqual(entries[0], entries[2])
+            self.assertEqual(sorted(entries[1::2]), sorted(base+"/fields/"+name
+                             for name in os.listdir(base+"/fields")))
+
+            # Points read once, evicted ones forgotten
+            session._point = np.array([0.3, 1.5, 13e-3, 101325., 18000., 60., 1., 0., 0., 0.])
+            with unittest.mock.patch("numpy.loadtxt", wraps=np.loadtxt) as loadtxt:
+                self.assertEqual(entries[1], session._closest_case())
+                self.assertEqual(1, loadtxt.call_count)
+            self.assertEqual(2, len(session._warm_points))
+
+        shutil.rmtree(base)
+
+    def test_cancel(self):
+        """Tests that cancelled and failed runs are not post-processed."""
+        base = os.path.dirname(os.path.realpath(__file__))+"/tmp"
+        with CFDSession(delete_simulation_files=True, warm_start=base+"/fields") as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+            session._case_dir = base+"/case"
+            os.makedirs(session._case_dir)
+            session._initialized = True
+            stored = []
+            session._store_fields = lambda: stored.append(True)
+
+            with open(session._case_dir+"/Allrun", "w") as script:
+                script.write("#!/bin/sh\nsleep 30\n")
+            session._async = True
+            session._run(wrapper)
+            session._async = False
+            handle = session._handle
+            self.assertTrue(handle.cancel())
+            with self.assertRaises(CancelledError):
+                handle.result(timeout=10)
+            self.assertListEqual([], stored)
+            self.assertFalse(os.path.exists(session._case_dir+"/streams"))
+
+            with open(session._case_dir+"/Allrun", "w") as script:
+                script.write("#!/bin/sh\nexit 3\n")
+            with self.assertRaises(RuntimeError):
+                session._run(wrapper)
+            self.assertListEqual([], stored)
+
+            # Cancelled after the end of Allrun, while storing the fields
+            storing, release = threading.Event(), threading.Event()
+            def store_fields():
+                storing.set()
+                release.wait(10)
+                stored.append(True)
+            session._store_fields = store_fields
+            streams = []
+            session._create_stream_files = lambda *args: streams.append(args)
+
+            with open(session._case_dir+"/Allrun", "w") as script:
+                script.write("#!/bin/sh\nexit 0\n")
+            session._async = True
+            session._run(wrapper)
+            session._async = False
+            handle = session._handle
+            self.assertTrue(storing.wait(10))
+            self.assertTrue(handle.cancel())
+            release.set()
+            with self.assertRaises(CancelledError):
+                handle.result(timeout=10)
+            self.assertListEqual([True], stored)
+            self.assertListEqual([], streams)
+
+        shutil.rmtree(base)
+
+    def test_residual_monitor(self):
+        """Tests the `ResidualMonitor` class on a growing solver log."""
+        base = os.path.dirname(os.path.realpath(__file__))+"/tmp"
+        os.makedirs(base)
+        log_path = base+"/log.rhoSimpleFoam"
+
+        progress = []
+        monitor = ResidualMonitor(log_path, {"Ux": 1e-3, "p": 1e-4},
+                                  lambda time, res: progress.append(time))
+        monitor.poll()
+
+        with open(log_path, "w") as log:
+            log.write("Time = 1\n\n"
+                      "smoothSolver:  Solving for Ux, Initial residual = 0.1, Final residual = 0.001, No Iterations 2\n"
+                      "GAMG:  Solving for p, Initial residual = 0.5, Final residual = 0.01, No Iterations 4\n"
+                      "GAMG:  Solving for p, Initial residual = 0.05, Final residual = 0.001, No Iterations 4\n"
+                      "ExecutionTime = 0.5 s  ClockTime = 1 s\n\n"
+                      "Time = 2\n\n"
+                      "smoothSolver:  Solving for Ux, Initial res")
+        monitor.poll()
+        self.assertListEqual([1.], progress)
+        self.assertFalse(monitor.converged)
+
+        with open(log_path, "a") as log:
+            log.write("idual = 1e-4, Final residual = 1e-6, No Iterations 2\n"
+                      "GAMG:  Solving for p, Initial residual = 5e-5, Final residual = 1e-7, No Iterations 4\n")
+        monitor.close()
+        self.assertListEqual([1., 2.], progress)
+        self.assertDictEqual({"Ux": 0.1, "p": 0.5}, monitor.history[0][1])
+        self.assertTrue(monitor.converged)
+
+        monitor.write(base+"/residuals.csv")
+        res = np.loadtxt(base+"/residuals.csv", delimiter=",", skiprows=1)
+        np.testing.assert_allclose([[1., 0.1, 0.5], [2., 1e-4, 5e-5]], res)
+
+        shutil.rmtree(base)
+
+    def test_seed_points(self):
+        """Tests the `_seed_points` method."""
+        with CFDSession(delete_simulation_files=True, seeds=100, seeds_pattern="area") as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+
+            radii, weights = session._seed_points(13e-3)
+            self.assertEqual(100, len(radii))
+            self.assertTrue(np.all(np.diff(radii) > 0.))
+            self.assertLess(radii[-1], 0.5*13e-3)
+            self.assertAlmostEqual(1., np.sum(weights))
+            self.assertAlmostEqual(0.01, weights[0])
+
+            session._seeds_pattern = [(1e-3, 0.), (0., -2e-3), (3e-3, 4e-3)]
+            radii, weights = session._seed_points(13e-3)
+            np.testing.assert_allclose([1e-3, 2e-3, 5e-3], radii)
+            self.assertAlmostEqual(1., np.sum(weights))
+
     def test_write_script(self):
         """Tests the `_write_script` method."""
         with CFDSession(delete_simulation_files=True) as session:
@@ -193,32 +478,257 @@ class TestCFDSession(unittest.TestCase):
             self.assertTrue(filecmp.cmp(os.path.dirname(os.path.realpath(__file__))+"/validation/p",
                                             session._case_dir+"/0/p"))
 
-    def test_write_set(self):
-        """Tests the `_write_set` method."""
-        with CFDSession(delete_simulation_files=True) as session:
-            wrapper = onto.NanoFOAMWrapper(session=session)
-
-            os.makedirs(os.path.dirname(os.path.realpath(__file__))+"/tmp/templates")
-            os.makedirs(os.path.dirname(os.path.realpath(__file__))+"/tmp/system")
-            session._case_dir = os.path.dirname(os.path.realpath(__file__))+"/tmp"
-            shutil.copyfile(os.path.dirname(os.path.realpath(__file__))+"/data/streamSets_template",session._case_dir+"/templates/streamSets_template")
-
-            coords = np.linspace(1e-6,0.5*13e-3-1e-6,num=5)
-            for ii,xcoo in enumerate(coords, start=1):
-                point = str((xcoo, 0, 1e-6)).replace(',', '')
-                # Parameters for streamSets file
-                stream_params = dict()
-                stream_params["stream"] = "stream" + str(ii)
-                stream_params["points"] = "(" + point + ")"
-
-                # Write the streamSets input file
-                session._write_set(stream_params,
-                                "streamSets_template",
-                                "streamSets",
-                                "system")
-
-            self.assertTrue(filecmp.cmp(os.path.dirname(os.path.realpath(__file__))+"/validation/streamSets",
-                                            session._case_dir+"/system/streamSets"))
+    def test_template(self):
+        """Tests the parsed templates."""
+        template = Template("a 1;\nb 2;\n\nb 3;\n")
+        self.assertEqual("a 1;\nb 5;\n\nb 3;\nc 6;\n", template.render({"b": 5, "c": 6}))
+        self.assertEqual("x\nb 2;\n\nb 3;\n", template.render({"a": "x"}, bare=("a",)))
+        self.assertEqual("a 1;\nb 2;\n\nb 3;\n", template.render({}))
+
+        path = os.path.dirname(os.path.realpath(__file__))+"/data/p_template"
+        template = load_template(path)
+        # Not read again while unchanged
+        with unittest.mock.patch("builtins.open", side_effect=AssertionError):
+            self.assertIs(template, load_template(path))
+
+        # Same name, size and modification time, different directories
+        base = os.path.dirname(os.path.realpath(__file__))+"/tmp"
+        for name, text in [("/a/t", "a 1;\n"), ("/b/t", "b 1;\n")]:
+            os.makedirs(os.path.dirname(base+name))
+            with open(base+name, "w") as file:
+                file.write(text)
+            os.utime(base+name, ns=(0, 0))
+        self.assertEqual(["a 1;"], load_template(base+"/a/t").lines)
+        self.assertEqual(["b 1;"], load_template(base+"/b/t").lines)
+
+        # Modified in place
+        with open(base+"/a/t", "w") as file:
+            file.write("c 1;\n")
+        os.utime(base+"/a/t", ns=(1, 1))
+        self.assertEqual(["c 1;"], load_template(base+"/a/t").lines)
+        shutil.rmtree(base)
+
+
+class Controller:
+    """Stand-in of the pyofi Controller recording the messages sent."""
+
+    def __init__(self):
+        self.messages = []
+
+    def updateObstacle(self, *args):
+        self.messages.append(("updateObstacle",) + args)
+
+    def removeObstacle(self, uid):
+        self.messages.append(("removeObstacle", uid))
+
+
+class Process:
+    """Stand-in of the PUFoam process, exited with returncode if not None."""
+
+    def __init__(self, returncode=None):
+        self.returncode = returncode
+        self.killed = False
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        self.killed = True
+
+
+class Obstacle:
+    """Stand-in of an Obstacle CUDS without dimensions and position."""
+
+    def __init__(self, uid, obstacle=True):
+        self.uid = uid
+        self.obstacle = obstacle
+
+    def is_a(self, oclass):
+        return self.obstacle
+
+    def get(self, oclass):
+        return []
+
+
+class TestForceDockerSession(unittest.TestCase):
+    """Tests the ForceDockerSession methods that do not need PUFoam."""
+
+    def setUp(self):
+        self.dir = os.path.dirname(os.path.realpath(__file__))+"/tmp_docker"
+        os.makedirs(self.dir)
+        self.path = self.dir+"/output"
+        with open(self.path, "w") as file:
+            file.write("internalField uniform 0;\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_output(self):
+        """Tests the `_read_output` and `read_output` methods."""
+        session = ForceDockerSession()
+        self.assertEqual("internalField uniform 0;\n", session._read_output(self.path))
+
+        session = ForceDockerSession(inline_limit=8)
+        chunk = session._read_output(self.path)
+        self.assertEqual("@file:%s:0:25" % self.path, chunk)
+        self.assertEqual("internalField uniform 0;\n", session.read_output(chunk))
+        self.assertEqual("uniform", session.read_output("@file:%s:14:7" % self.path))
+        self.assertEqual("", session.read_output("@file:%s:25:0" % self.path))
+        # Inlined outputs are returned as they are
+        self.assertEqual("a 1;", session.read_output("a 1;"))
+
+        # References beyond the end of the file
+        for offset, size in [(26, 0), (20, 6), (0, 100)]:
+            with self.assertRaises(ValueError):
+                session.read_output("@file:%s:%d:%d" % (self.path, offset, size))
+        # Negative and missing values are not references
+        self.assertEqual("@file:%s:-1:3" % self.path,
+                         session.read_output("@file:%s:-1:3" % self.path))
+        self.assertEqual("@file:%s:0" % self.path,
+                         session.read_output("@file:%s:0" % self.path))
+
+    def test_obstacles(self):
+        """Tests the obstacle changes sent once per run."""
+        session = ForceDockerSession()
+        session._ofi = Controller()
+        a, b, c = Obstacle("a"), Obstacle("b"), Obstacle("c")
+
+        session._apply_updated(None, {"a": a, "b": b})
+        session._apply_updated(None, {"a": a})
+        session._apply_deleted(None, {"c": c})
+        # Deleted and then added back
+        session._apply_deleted(None, {"b": b})
+        session._apply_updated(None, {"b": b})
+        self.assertEqual([], session._ofi.messages)
+
+        # The last change of each obstacle, removals first
+        session._flush_obstacles()
+        self.assertEqual([("removeObstacle", "c"),
+                          ("updateObstacle", "a", 1, 1, 1, [0, 0, 0]),
+                          ("updateObstacle", "b", 1, 1, 1, [0, 0, 0])],
+                         session._ofi.messages)
+        session._flush_obstacles()
+        self.assertEqual(3, len(session._ofi.messages))
+
+    def test_obstacle_dict(self):
+        """Tests the obstacle set written in one dictionary per run."""
+        session = ForceDockerSession(obstacle_dict="constant/obstacleDict")
+        session._ofi = Controller()
+        session._case_dir = self.dir
+        os.makedirs(self.dir+"/constant")
+        a, b, c = Obstacle("a"), Obstacle("b"), Obstacle("c")
+
+        session._apply_updated(None, {"a": a, "b": b, "c": c})
+        session._flush_obstacles()
+        session._apply_deleted(None, {"c": c})
+        session._apply_updated(None, {"a": a})
+        session._flush_obstacles()
+        self.assertEqual([], session._ofi.messages)
+
+        with open(self.dir+"/constant/obstacleDict") as dict_file:
+            text = dict_file.read()
+        self.assertIn("object      obstacleDict;", text)
+        self.assertEqual(['"a"', '"b"'], re.findall(r'^    ("\w+")$', text, flags=re.M))
+        self.assertEqual(2, text.count("position    (0 0 0);"))
+        self.assertEqual(["obstacleDict"], os.listdir(self.dir+"/constant"))
+
+    def test_connect(self):
+        """Tests the `_connect` method against a stand-in controller."""
+        attempts = []
+
+        def connect(failures, error):
+            def controller():
+                attempts.append(None)
+                if len(attempts) <= failures:
+                    raise error
+                return Controller()
+            return controller
+
+        self.addCleanup(setattr, dockersession, "Controller", dockersession.Controller)
+        session = ForceDockerSession(startup_timeout=5.)
+        session.CONNECT_INTERVAL = 0.
+
+        # Connected once the solver listens
+        dockersession.Controller = connect(3, ConnectionRefusedError())
+        session._ofi_process = Process()
+        self.assertIsInstance(session._connect(), Controller)
+        self.assertEqual(4, len(attempts))
+
+        # Errors other than the connection ones are not retried
+        attempts.clear()
+        dockersession.Controller = connect(1, ValueError())
+        with self.assertRaises(ValueError):
+            session._connect()
+        self.assertEqual(1, len(attempts))
+
+        # The solver exited
+        session._ofi_process = Process(returncode=1)
+        with self.assertRaises(RuntimeError):
+            session._connect()
+
+        # The solver never listens
+        dockersession.Controller = connect(float("inf"), ConnectionRefusedError())
+        session._startup_timeout = 0.
+        session._ofi_process = Process()
+        with self.assertRaises(TimeoutError):
+            session._connect()
+        self.assertTrue(session._ofi_process.killed)
+
+    def test_preprocess(self):
+        """Tests the `_preprocess` method."""
+        session = ForceDockerSession(preprocess_timeout=0.5)
+        session._case_dir = self.dir
+        session._command = lambda proc: proc
+
+        session._preprocess("touch mesh")
+        self.assertTrue(os.path.exists(self.dir+"/mesh"))
+        with self.assertRaises(RuntimeError):
+            session._preprocess("exit 3")
+        with self.assertRaises(TimeoutError):
+            session._preprocess("sleep 30")
+
+    def test_cuds_finder(self):
+        """Tests the paths and CUDS found in the input data."""
+        # ControlDictData > Time > EndTime holding endTime
+        base, data = SimpleNamespace(), SimpleNamespace()
+        time, end = SimpleNamespace(), SimpleNamespace(attributes={"value": "endTime"})
+        data.superclasses, data.subclasses = [data, base], [time, end]
+        time.attributes = {"value": "startTime"}
+        end.superclasses = [end, time, data, base]
+
+        class Node:
+            def __init__(self, children):
+                self.children = children
+                self.oclass = SimpleNamespace(namespace=SimpleNamespace(name="foam"))
+
+            def get(self, oclass):
+                return [self.children[id(oclass)]]
+
+        leaf = Node({})
+        inputdata = Node({id(data): Node({id(time): Node({id(end): leaf})})})
+        self.addCleanup(setattr, dockersession, "get_entity", dockersession.get_entity)
+        dockersession.get_entity = {"foam.ControlDictData": data}.get
+
+        paths = dict()
+        self.assertIs(leaf, CudsFinder(inputdata, "ControlDictData", "endTime", paths))
+        self.assertEqual({("foam", "ControlDictData", "endTime"): [end, time]}, paths)
+        # The ontology is not scanned again
+        data.subclasses = []
+        self.assertIs(leaf, CudsFinder(inputdata, "ControlDictData", "endTime", paths))
+        self.assertEqual(2, len(paths[("foam", "ControlDictData", "endTime")]))
+
+        # Each session has its own paths, the CUDS found are forgotten
+        # when the input data changes
+        session = ForceDockerSession()
+        self.assertEqual({}, session._paths)
+        session._found["key"] = leaf
+        session._apply_updated(None, {"a": Obstacle("a")})
+        self.assertIn("key", session._found)
+        session._apply_updated(None, {"b": Obstacle("b", obstacle=False)})
+        self.assertEqual({}, session._found)
+        session._found["key"] = leaf
+        session._apply_deleted(None, {"b": Obstacle("b", obstacle=False)})
+        self.assertEqual({}, session._found)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,11 @@
 """Unit test examples, both at the "system" level and the "method" level."""
 
 import csv
+import filecmp
 import os
 import shutil
 import unittest
+from types import SimpleNamespace
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -12,7 +14,8 @@ from scipy import io as io
 from osp.core.cuds import Cuds
 from osp.core.namespaces import nanofoam as onto
 
-from osp.wrappers.simelenbaas.elenbaassession import ElenbaasSession
+from osp.wrappers.simelenbaas.elenbaassession import ElenbaasSession, RESULT_TABLES
+from osp.wrappers.simelenbaas.surrogate import ElenbaasSurrogate, PROFILES
 import osp.wrappers.simelenbaas.elenbaasengine as elen_engine
 
 
@@ -164,7 +167,112 @@ class TestElenbaasSession(unittest.TestCase):
                 [x for x in res]
             )
 
-
+    def test_join(self):
+        """Tests that the asynchronous run loads the tables of the solver."""
+        base = os.path.dirname(os.path.realpath(__file__))
+        with ElenbaasSession(delete_simulation_files=False) as session:
+            session._case_dir = base+"/validation"
+            proc = SimpleNamespace(join=lambda: None, exitcode=0)
+            session._join(proc)
+            self.assertSetEqual(set(RESULT_TABLES), set(session.results))
+            np.testing.assert_array_equal(np.loadtxt(base+"/validation/TR", delimiter=","),
+                                          session.results["TR"])
+
+            proc.exitcode = 1
+            with self.assertRaises(RuntimeError):
+                session._join(proc)
+
+    def test_result_cache(self):
+        """Tests the cache of the Elenbaas solutions."""
+        base = os.path.dirname(os.path.realpath(__file__))
+        with ElenbaasSession(delete_simulation_files=True,
+                             result_cache=base+"/tmp_cache") as session:
+            session._elen_dict = {"Ar": 1., "H2": 0., "N2": 0., "O2": 0.,
+                                  "Input Power": 15000, "Flow Rate": 60,
+                                  "Inlet Radius": 0.5*13e-3}
+            key = session._cache_key()
+            session._elen_dict["Input Power"] = 15000.
+            self.assertEqual(key, session._cache_key())
+            session._elen_dict["Input Power"] = 16000.
+            self.assertNotEqual(key, session._cache_key())
+
+            session._case_dir = base+"/validation"
+            session._store_results(key)
+
+            os.mkdir(base+"/tmp")
+            session._case_dir = base+"/tmp"
+            self.assertFalse(session._restore_results("0"*64))
+            self.assertTrue(session._restore_results(key))
+            for name in os.listdir(base+"/validation"):
+                self.assertTrue(filecmp.cmp(base+"/validation/"+name, base+"/tmp/"+name))
+            self.assertEqual((1, 2), session.results["densRef"].shape)
+            self.assertEqual(2, session.results["rho"].shape[1])
+
+            # Evicted above the size limit
+            session._cache_size = 0
+            session._evict_results()
+            self.assertFalse(session._restore_results(key))
+
+        shutil.rmtree(base+"/tmp_cache")
+
+    def test_surrogate(self):
+        """Tests the `ElenbaasSurrogate` and its use by the session."""
+        base = os.path.dirname(os.path.realpath(__file__))
+        tables = dict()
+        for name in RESULT_TABLES:
+            tables[name] = np.loadtxt(base+"/validation/"+name, ndmin=2,
+                                      delimiter=None if name == "densRef" else ",")
+
+        # Profiles quadratic in the input power
+        powers = [10000., 15000., 20000.]
+        samples = []
+        for power in powers:
+            sample = dict(tables)
+            for name in PROFILES:
+                sample[name] = tables[name]*[1., (power/15000.)**2]
+            samples.append(sample)
+        fixed = {"Ar": 1., "H2": 0., "N2": 0., "O2": 0., "Flow Rate": 60,
+                 "Inlet Radius": 0.5*13e-3}
+        surrogate = ElenbaasSurrogate.from_samples({"Input Power": powers}, fixed, samples)
+
+        results, errors = surrogate.predict(dict(fixed, **{"Input Power": 15000}))
+        for name in RESULT_TABLES:
+            self.assertTrue(np.allclose(tables[name], results[name]))
+
+        # Error estimate of the interpolation between the samples
+        results, errors = surrogate.predict(dict(fixed, **{"Input Power": 12500}))
+        actual = np.abs(results["TR"][:,1] - tables["TR"][:,1]*(12500/15000)**2).max()
+        self.assertGreater(actual, 0.)
+        self.assertLessEqual(actual, errors["TR"]*(1 + 1e-6))
+        self.assertAlmostEqual(0., errors["rho"])
+        self.assertTrue(np.allclose(tables["rho"], results["rho"]))
+
+        # Outside of the trust region
+        self.assertIsNone(surrogate.predict(dict(fixed, **{"Input Power": 25000})))
+        self.assertIsNone(surrogate.predict(dict(fixed, **{"Input Power": 15000, "Ar": 0.5})))
+        surrogate.max_error = 1e-6
+        self.assertIsNone(surrogate.predict(dict(fixed, **{"Input Power": 12500})))
+        surrogate.max_error = None
+
+        surrogate.save(base+"/tmp_surrogate.npz")
+        loaded = ElenbaasSurrogate.load(base+"/tmp_surrogate.npz")
+        os.remove(base+"/tmp_surrogate.npz")
+        self.assertTrue(np.allclose(results["TR"],
+                        loaded.predict(dict(fixed, **{"Input Power": 12500}))[0]["TR"]))
+
+        # Tables written into the case instead of solving
+        with ElenbaasSession(delete_simulation_files=True, surrogate=surrogate) as session:
+            os.mkdir(base+"/tmp")
+            session._case_dir = base+"/tmp"
+            session._elen_dict = dict(fixed, **{"Input Power": 15000})
+            self.assertTrue(session._apply_surrogate())
+            self.assertEqual(set(RESULT_TABLES), set(os.listdir(base+"/tmp")))
+            self.assertTrue(np.allclose(tables["TR"], np.loadtxt(base+"/tmp/TR", delimiter=",")))
+            self.assertIn("TR", session.error_estimate)
+
+            session._elen_dict["Input Power"] = 25000
+            self.assertFalse(session._apply_surrogate())
+            self.assertIsNone(session.error_estimate)
 
 
 if __name__ == '__main__':
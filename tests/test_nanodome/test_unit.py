@@ -1,6 +1,7 @@
 """Unit test examples, both at the "system" level and the "method" level."""
 
-import unittest, os
+import unittest, os, shutil
+from types import SimpleNamespace
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -10,6 +11,11 @@ from osp.core.namespaces import nanofoam as onto
 from .common import generate_cuds, get_key_simulation_cuds
 from osp.wrappers.simnanodome.nanosession import NanoDOMESession
 from osp.wrappers.simnanodome.nano_engine import nano_engine
+from osp.wrappers.simnanodome.nano_steppers import STEPPERS, TemperatureDriver, \
+                                                 ConvergenceMonitor, Stepper, \
+                                                 ParticlePhaseOutput
+from osp.wrappers.simnanodome.moment_ensemble import StreamlineBundle, MomentEnsemble
+from osp.wrappers.simnanodome.result_cache import ResultCache
 
 
 class TestNanoEngine(unittest.TestCase):
@@ -74,6 +80,211 @@ class TestNanoEngine(unittest.TestCase):
 
         self.assertEqual(-175614.67614668683, der)
 
+    def test_TemperatureDriver(self):
+        """Tests the `TemperatureDriver` class and methods."""
+        time = nano_engine.stream_evo(nano_engine,os.path.dirname(os.path.realpath(__file__))+"/data/streamline_1.csv",0)
+        temp = nano_engine.stream_evo(nano_engine,os.path.dirname(os.path.realpath(__file__))+"/data/streamline_1.csv",1)
+        T = SimpleNamespace(value=2000.)
+        dTdt = SimpleNamespace(value=0.)
+
+        driver = TemperatureDriver(T, dTdt, 300., time, temp)
+        for tt in np.linspace(0., time[-1], 50):
+            self.assertEqual(nano_engine.Temp_gradient(None,tt,time,temp),
+                             driver.gradient(tt))
+
+        self.assertFalse(driver.update(0.001))
+        self.assertEqual(-175614.67614668683, dTdt.value)
+
+        T.value = 250.
+        self.assertTrue(driver.update(0.001))
+        self.assertEqual(0., dTdt.value)
+
+    def test_ConvergenceMonitor(self):
+        """Tests the `ConvergenceMonitor` class."""
+        values = [1., 2.]
+        monitor = ConvergenceMonitor(1e-3, 1e-5)
+
+        self.assertFalse(monitor.converged(0., lambda: values))
+        # Samples are taken once per window only
+        values = [5., 5.]
+        self.assertFalse(monitor.converged(5e-6, lambda: values))
+        self.assertFalse(monitor.converged(1e-5, lambda: values))
+        values = [5.001, 5.]
+        self.assertTrue(monitor.converged(2e-5, lambda: values))
+
+    def test_StreamlineBundle(self):
+        """Tests the vectorized temperature histories."""
+        time_evo = [0., 1., 3.]
+        temp_evo = [2000., 1000., 500.]
+        bundle = StreamlineBundle([time_evo, time_evo[:2]],
+                                  [temp_evo, temp_evo[:2]], T_stop=600.)
+
+        for t in [0., 0.5, 1.5, 2.5, 4.]:
+            T, dTdt = bundle.evaluate(t)
+            self.assertAlmostEqual(dTdt[0], nano_engine.Temp_gradient(None,t,
+                                   time_evo,temp_evo))
+            self.assertAlmostEqual(dTdt[1], nano_engine.Temp_gradient(None,t,
+                                   time_evo[:2],temp_evo[:2]))
+
+        # Frozen below T_stop
+        T, dTdt = bundle.evaluate(4.)
+        self.assertAlmostEqual(T[0], 600.)
+        self.assertEqual(dTdt[0], 0.)
+        self.assertAlmostEqual(T[1], 1000.)
+
+    def test_MomentEnsemble_adaptive(self):
+        """Tests the adaptive timestep against the fixed timestep reference."""
+        eng = nano_engine()
+        res = []
+        for adaptive in [False, True]:
+            histories = StreamlineBundle.from_gradients([2000., 1900.], -1e+7, 7e-4)
+            ensemble = MomentEnsemble(eng, "Si", 101325., 1.8e-3, histories)
+            if adaptive:
+                ensemble.run_adaptive(2e-5, rtol=1e-3)
+                self.assertLess(ensemble.steps + ensemble.rejected, 2e+4/100)
+            else:
+                ensemble.run(2e-5, 1e-9)
+            res.append(ensemble.results())
+
+        for fixed, adaptive in zip(res[0], res[1]):
+            np.testing.assert_allclose(adaptive, fixed, rtol=1e-2)
+
+    def test_MomentEnsemble_adaptive_no_precursor(self):
+        """Tests the adaptive timestep without precursor and with a failing step."""
+        eng = nano_engine()
+        histories = StreamlineBundle.from_gradients(2000., -1e+7, 7e-4)
+        ensemble = MomentEnsemble(eng, "Si", 101325., 0., histories)
+        ensemble.run_adaptive(1e-6)
+        self.assertEqual(0, ensemble.rejected)
+        self.assertLess(ensemble.steps, 100)
+        np.testing.assert_array_equal(ensemble.y, 0.)
+
+        # Non finite derivatives shrink the step until dt_min
+        ensemble = MomentEnsemble(eng, "Si", 101325., 1.8e-3, histories)
+        ensemble.derivatives = lambda t, y: np.full_like(y, np.nan)
+        with self.assertRaises(RuntimeError):
+            ensemble.run_adaptive(1e-6)
+        self.assertEqual(0, ensemble.steps)
+
+    def test_MomentEnsemble_advance(self):
+        """Tests the fixed timesteps advanced in one call."""
+        eng = nano_engine()
+        histories = StreamlineBundle.from_gradients([2000., 1900.], -1e+7, 7e-4)
+        ensemble = MomentEnsemble(eng, "Si", 101325., 1.8e-3, histories)
+        self.assertEqual(500, ensemble.advance(500, 1e-9))
+        self.assertAlmostEqual(5e-7, ensemble.t)
+        # Stopped once past t_end
+        self.assertLess(ensemble.advance(500, 1e-9, 6e-7), 500)
+        self.assertGreater(ensemble.t, 6e-7)
+
+        reference = MomentEnsemble(eng, "Si", 101325., 1.8e-3, histories)
+        reference.run(6e-7, 1e-9, check_every=1)
+        self.assertEqual(reference.t, ensemble.t)
+        np.testing.assert_array_equal(reference.y, ensemble.y)
+
+    def test_batched_run(self):
+        """Tests the Low accuracy `nano_run` of the vectorized moment model."""
+        eng = nano_engine()
+        eng.tf = 2e-6
+        dictio = SimpleNamespace(_acc_level="Low", _bool_stream=False,
+                                 _temp_start=2000., _temp_gradient=-1e+7,
+                                 _pressure=101325., species=["Si", "Ar", "H2", "N2", "O2"],
+                                 _gas_fractions=[0.94, 0.04, 0., 0.],
+                                 _feedrate=125/1000/3600, _flowrate=40., _dens_ref=1.02)
+
+        res = []
+        for batch_steps in [1, 500]:
+            eng.batch_steps = batch_steps
+            res.append(eng.nano_run(dictio))
+        self.assertEqual(res[0], res[1])
+        self.assertIsInstance(res[0][0], float)
+
+        # The one member ensemble of the temperature gradient
+        histories = StreamlineBundle.from_gradients(2000., -1e+7, 2e-6)
+        ensemble = MomentEnsemble(eng, "Si", 101325., eng.mole_fractions(dictio)[0],
+                                  histories)
+        ensemble.run(2e-6, 1e-9)
+        np.testing.assert_allclose(res[0], [value[0] for value in ensemble.results()])
+
+    def test_MomentEnsemble_monitor(self):
+        """Tests the early stop of histories ending above T_stop."""
+        eng = nano_engine()
+        res = []
+        for monitor in [None, ConvergenceMonitor(1e-3, 1e-5)]:
+            # Hot gas, without nucleation once the histories end
+            histories = StreamlineBundle.from_gradients([4500., 4000.], -1e+7, 1e-5)
+            ensemble = MomentEnsemble(eng, "Si", 101325., 1.8e-3, histories)
+            ensemble.run(1e-4, 1e-9, monitor)
+            res.append(ensemble)
+
+        self.assertLess(res[1].t, 3e-5)
+        self.assertGreater(res[0].t, 1e-4)
+        np.testing.assert_allclose(res[1].y, res[0].y)
+
+        # Particles still coagulating at constant temperature
+        histories = StreamlineBundle.from_gradients([2000., 1900.], -1e+8, 1e-5)
+        ensemble = MomentEnsemble(eng, "Si", 101325., 1.8e-3, histories)
+        ensemble.run(4e-5, 1e-9, ConvergenceMonitor(1e-3, 1e-5))
+        self.assertGreater(ensemble.t, 4e-5)
+
+    def test_ResultCache(self):
+        """Tests the persistent result cache and its eviction."""
+        path = os.path.dirname(os.path.realpath(__file__))+"/tmp_cache"
+        cache = ResultCache(path, max_size=100)
+
+        key = cache.key({"pressure": 101325., "species": ["Si", "Ar"]})
+        self.assertEqual(key, cache.key({"species": ["Si", "Ar"], "pressure": 101325.}))
+        self.assertNotEqual(key, cache.key({"pressure": 101326., "species": ["Si", "Ar"]}))
+
+        self.assertIsNone(cache.get(key))
+        result = [[1.5, np.float64(2e+18), np.array([0.1, 0.2])]]
+        cache.put(key, result)
+        self.assertListEqual([[1.5, 2e+18, [0.1, 0.2]]], cache.get(key))
+
+        # The least recently used entries are evicted
+        os.utime(os.path.join(path, key + ".json"), (0, 0))
+        for idx in range(4):
+            cache.put(cache.key({"idx": idx}), [idx]*10)
+        self.assertIsNone(cache.get(key))
+        self.assertListEqual([3]*10, cache.get(cache.key({"idx": 3})))
+
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+
+    def test_steppers(self):
+        """Tests the accuracy level steppers registry."""
+        self.assertListEqual(["Low", "Medium", "High"], list(STEPPERS))
+        self.assertIs(STEPPERS, nano_engine.steppers)
+        self.assertEqual(300., STEPPERS["Low"].T_stop)
+        self.assertEqual(520., STEPPERS["Medium"].T_stop)
+        self.assertEqual(520., STEPPERS["High"].T_stop)
+
+    def test_stepper_outputs(self):
+        """Tests the steppers interface and the outputs checked every iteration."""
+        class Incomplete(Stepper):
+            def create_particle_phase(self, dictio):
+                return None
+
+        with self.assertRaises(TypeError):
+            Incomplete(None, None, None, None, None, None)
+
+        case_dir = os.path.dirname(os.path.realpath(__file__))+"/tmp"
+        os.makedirs(case_dir)
+        output = ParticlePhaseOutput(case_dir, "PBM", 1500)
+        part = SimpleNamespace(get_particles_sizes=lambda: np.array([1.]),
+                               get_aggregates_sizes=lambda: np.array([2.]))
+        stepper = SimpleNamespace(part=part)
+
+        # PSD written once PSD_DATA of simulated time elapsed
+        output.check(stepper, 1e-5, 0)
+        output.check(stepper, 1e-5, 1)
+        self.assertFalse(os.path.exists(output.part_sizes_file))
+        output.check(stepper, 1e-5, 2)
+        self.assertTrue(os.path.exists(output.part_sizes_file))
+        self.assertEqual(0., output.psd_step)
+        shutil.rmtree(case_dir)
+
     def test_get_prec_mass(self):
         """Tests the `get_prec_mass` method."""
         fin = 1.660538921e-27 * 55.845
@@ -177,6 +388,59 @@ class TestNanoEngine(unittest.TestCase):
             self.assertGreater(numb,0)
             self.assertGreater(vol,0)
 
+    def test_nano_run_system_low_batched(self):
+        """Compares the batched Low accuracy `nano_run` with the engine one.
+
+        Mean diameter and volume percentage within 25%, number density
+        within a factor 2, see MomentEnsemble.
+        """
+        res = []
+        for batch_steps in [None, 1000]:
+            with NanoDOMESession(delete_simulation_files=True) as session:
+                wrapper = onto.NanoFOAMWrapper(session=session)
+                session._pressure = 101325.
+                session.species = ["Si", "Ar", "H2", "N2", "O2"]
+                session._bool_stream = True
+                session._stream = os.path.dirname(os.path.realpath(__file__))+"/data/streamline_1.csv"
+                session.eng.tf = 2.5e-4
+                session.eng.batch_steps = batch_steps
+                session._gas_fractions = [0.94, 0.01, 0.02, 0.03]
+                session._feedrate = 125/1000/3600
+                session._flowrate = 40.
+                session._dens_ref = 1.02
+                session._acc_level = "Low"
+                session._delete_simulation_files = True
+
+                res.append(session.eng.nano_run(session))
+
+        (ref_diam, ref_numb, ref_vol), (diam, numb, vol) = res
+        self.assertAlmostEqual(ref_diam, diam, delta=0.25*ref_diam)
+        self.assertAlmostEqual(ref_vol, vol, delta=0.25*ref_vol)
+        self.assertLessEqual(max(numb/ref_numb, ref_numb/numb), 2.)
+
+    def test_nano_run_system_low_adaptive(self):
+        """Compares the adaptive Low accuracy `nano_run` with the fixed one."""
+        res = []
+        for rtol in [None, 1e-3]:
+            with NanoDOMESession(delete_simulation_files=True) as session:
+                wrapper = onto.NanoFOAMWrapper(session=session)
+                session._pressure = 101325.
+                session.species = ["Si", "Ar", "H2", "N2", "O2"]
+                session._bool_stream = True
+                session._stream = os.path.dirname(os.path.realpath(__file__))+"/data/streamline_1.csv"
+                session.eng.tf = 2.5e-4
+                session.eng.rtol = rtol
+                session._gas_fractions = [0.94, 0.01, 0.02, 0.03]
+                session._feedrate = 125/1000/3600
+                session._flowrate = 40.
+                session._dens_ref = 1.02
+                session._acc_level = "Low"
+                session._delete_simulation_files = True
+
+                res.append(session.eng.nano_run(session))
+
+        np.testing.assert_allclose(res[1], res[0], rtol=1e-2)
+
     def test_nano_run_system_medium(self):
         """Tests the `nano_run` method with Medium accuracy."""
         with NanoDOMESession(delete_simulation_files=True) as session:
@@ -223,6 +487,70 @@ class TestNanoEngine(unittest.TestCase):
             self.assertGreater(numb,0)
             self.assertGreater(vol,0)
 
+    def test_ensemble_run(self):
+        """Tests the `ensemble_run` method on several streamlines."""
+        with NanoDOMESession(delete_simulation_files=True) as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+            stream = os.path.dirname(os.path.realpath(__file__))+"/data/streamline_1.csv"
+            session._pressure = 101325.
+            session.species = ["Si", "Ar", "H2", "N2", "O2"]
+            session._streams = [stream, stream]
+            session.eng.tf = 2.5e-4
+            session._gas_fractions = [0.94, 0.01, 0.02, 0.03]
+            session._feedrate = 125/1000/3600
+            session._flowrate = 40.
+            session._dens_ref = 1.02
+
+            res = session.eng.ensemble_run(session)
+
+            self.assertEqual(2, len(res))
+            self.assertTupleEqual(res[0], res[1])
+            for val in res[0]:
+                self.assertGreater(val,0)
+
+    def test_ensemble_regression(self):
+        """Compares the `ensemble_run` results, with fixed and adaptive
+        timestep, with the `nano_run` Low ones.
+
+        Mean diameter and volume percentage within 25%, number density
+        within a factor 2, see MomentEnsemble.
+        """
+        path = os.path.dirname(os.path.realpath(__file__))+"/data/streamline_1.csv"
+        base = np.loadtxt(path, delimiter=",")
+        # Streamlines cooling slower and faster than the original one
+        streams = [base, base*[1.5, 1.], base*[0.75, 1.]]
+
+        with NanoDOMESession(delete_simulation_files=True) as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+            session._pressure = 101325.
+            session.species = ["Si", "Ar", "H2", "N2", "O2"]
+            session.eng.tf = 2.5e-4
+            session._gas_fractions = [0.94, 0.01, 0.02, 0.03]
+            session._feedrate = 125/1000/3600
+            session._flowrate = 40.
+            session._dens_ref = 1.02
+            session._acc_level = "Low"
+            session._delete_simulation_files = True
+            session._bool_stream = True
+
+            # Fixed and adaptive timestep
+            session._streams = streams
+            ensembles = []
+            for rtol in [None, 1e-3]:
+                session.eng.rtol = rtol
+                ensembles.append(session.eng.ensemble_run(session))
+            session.eng.rtol = None
+
+            for idx, stream in enumerate(streams):
+                session._stream = stream
+                ref_diam, ref_numb, ref_vol = session.eng.nano_run(session)
+
+                for ensemble in ensembles:
+                    diam, numb, vol = ensemble[idx]
+                    self.assertAlmostEqual(ref_diam, diam, delta=0.25*ref_diam)
+                    self.assertAlmostEqual(ref_vol, vol, delta=0.25*ref_vol)
+                    self.assertLessEqual(max(numb/ref_numb, ref_numb/numb), 2.)
+
 class TestNanoSession(unittest.TestCase):
     """Tests the NanoSession.
 
@@ -335,6 +663,41 @@ class TestNanoSession(unittest.TestCase):
             session.run()
 
 
+    def test_nano_run_ensemble(self):
+        """Tests the Bins of the `_nano_run` method with the ensemble."""
+
+        key_cuds = get_key_simulation_cuds(self.template_wrapper)
+
+        with NanoDOMESession(delete_simulation_files=True, ensemble=True) as session:
+            wrapper = onto.NanoFOAMWrapper(session=session)
+
+            reactor = key_cuds['reactor']
+            source = key_cuds['source']
+
+            # Two streamlines
+            path = os.path.dirname(os.path.realpath(__file__))+"/data/streamline_1.csv"
+            tcond = reactor.get(oclass=onto.ThermoCond)[0]
+            tcond.add(onto.TemperatureStreamline(path=path, name='1', unit='K'),
+                      onto.TemperatureStreamline(path=path, name='2', unit='K'),
+                      rel=onto.hasProperty)
+            session.plasma_data = {"densRef": np.array([[0., 1.02]])}
+
+            accuracy_level = onto.LowAccuracyLevel()
+            particles = [dist for dist in reactor.get(oclass=onto.NanoParticleSizeDistribution) \
+                         if dist.name == 'Particles'][0]
+            wrapper.add(source, accuracy_level)
+
+            session.test = True
+            session.eng.tf = 1e-7
+            session.run()
+
+            # Labelled as approximate
+            bins = wrapper.get(source.uid).get(reactor.uid).get(particles.uid) \
+                          .get(oclass=onto.Bin)
+            self.assertEqual(2, len(bins))
+            for item in bins:
+                self.assertEqual(MomentEnsemble.BIN_NAME, item.name)
+
     def test_nano_coupled_run(self):
         """Tests the `_nano_coupled_run` method."""
         with NanoDOMESession(delete_simulation_files=True) as session:
@@ -0,0 +1 @@
+"""Test suite for the modules shared by the wrappers."""
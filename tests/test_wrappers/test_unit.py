@@ -0,0 +1,133 @@
+"""Unit tests of the modules shared by the wrappers."""
+
+import os
+import shutil
+import threading
+import unittest
+from concurrent.futures import CancelledError
+
+import numpy as np
+
+from osp.wrappers.pipeline import NanoFOAMPipeline
+from osp.wrappers.run_handle import RunHandle
+from osp.wrappers.workspace import Workspace
+
+
+class TestNanoFOAMPipeline(unittest.TestCase):
+    """Tests the NanoFOAMPipeline methods that do not run the sessions."""
+
+    def test_aggregate(self):
+        """Tests the `aggregate` method."""
+        pipeline = NanoFOAMPipeline.__new__(NanoFOAMPipeline)
+        pipeline.results = [{"Particles": np.array([[10., 1e+16, 5.]]),
+                             "Primaries": np.empty((0, 3))},
+                            {"Particles": np.array([[20., 2e+16, 5.],
+                                                    [30., 4e+16, 5.]]),
+                             "Primaries": np.array([[5., 1e+17, np.nan]])}]
+        pipeline.weights = np.array([0.25, 0.75])
+
+        aggregated = pipeline.aggregate()
+        np.testing.assert_allclose([[10., 0.25e+16, 5.],
+                                    [20., 1.5e+16, 5.],
+                                    [30., 3e+16, 5.]], aggregated["Particles"])
+        self.assertEqual((1, 3), aggregated["Primaries"].shape)
+        self.assertEqual(0.75e+17, aggregated["Primaries"][0,1])
+
+    def test_clear_streams(self):
+        """Tests that the streamlines of the previous run are removed."""
+        class ThermoCond:
+            def __init__(self):
+                self.removed = []
+
+            def remove(self, *args):
+                self.removed.extend(args)
+
+        pipeline = NanoFOAMPipeline.__new__(NanoFOAMPipeline)
+        pipeline.tcond = ThermoCond()
+        pipeline.streams = ["stream1", "stream2"]
+        pipeline.stream_data = {"stream1": None, "stream2": None}
+
+        pipeline._clear_streams()
+        self.assertListEqual(["stream1", "stream2"], pipeline.tcond.removed)
+        self.assertListEqual([], pipeline.streams)
+        self.assertDictEqual({}, pipeline.stream_data)
+        pipeline._clear_streams()
+        self.assertEqual(2, len(pipeline.tcond.removed))
+
+
+class TestRunHandle(unittest.TestCase):
+    """Tests the RunHandle of the asynchronous runs."""
+
+    def test_run_handle(self):
+        """Tests the `RunHandle` returned by `run_async`."""
+        finished = []
+        stop = threading.Event()
+
+        handle = RunHandle(stop.wait, lambda: finished.append(True), stop.set)
+        self.assertFalse(handle.poll())
+        with self.assertRaises(TimeoutError):
+            handle.result(timeout=0.01)
+        stop.set()
+        handle.result()
+        handle.result()
+        self.assertTrue(handle.poll())
+        self.assertListEqual([True], finished)
+        self.assertFalse(handle.cancel())
+
+        stop = threading.Event()
+        handle = RunHandle(stop.wait, lambda: finished.append(True), stop.set)
+        self.assertTrue(handle.cancel())
+        self.assertTrue(handle.cancelled())
+        with self.assertRaises(CancelledError):
+            handle.result()
+        self.assertListEqual([True], finished)
+
+
+class TestWorkspace(unittest.TestCase):
+    """Tests the Workspace of the case directories."""
+
+    def test_workspace(self):
+        """Tests the `Workspace` of the case directories."""
+        root = os.path.dirname(os.path.realpath(__file__))+"/tmp"
+        workspace = Workspace(root, asynchronous=True, pool=1, quota=100,
+                              quota_interval=0.)
+
+        path = workspace.create("case-1")
+        self.assertEqual(root+"/case-1", path)
+        with open(path+"/data", "w") as file:
+            file.write("x"*200)
+        with self.assertRaises(OSError):
+            workspace.create("case-2")
+
+        # The name is available as soon as the directory is released
+        workspace.release(path)
+        self.assertFalse(os.path.exists(path))
+        workspace.flush()
+
+        # Emptied and handed out again
+        path = workspace.create("case-1")
+        self.assertListEqual([], os.listdir(path))
+        self.assertListEqual(["case-1"], os.listdir(root))
+
+        workspace.release(path)
+        workspace.close()
+        self.assertListEqual([], os.listdir(root))
+        shutil.rmtree(root)
+
+        # Measured again only past the interval
+        workspace = Workspace(root, quota=100, quota_interval=3600.)
+        path = workspace.create("case-1")
+        with open(path+"/data", "w") as file:
+            file.write("x"*200)
+        other = workspace.create("case-2")
+        workspace._measured -= 3600.
+        with self.assertRaises(OSError):
+            workspace.create("case-3")
+        workspace.release(path)
+        workspace.release(other)
+        workspace.close()
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    unittest.main()